@@ -1,44 +1,67 @@
 import os
 import logging
 import configparser
-from flask import Flask, g, abort
-from psycopg2 import pool
+from pathlib import Path
+from flask import Flask, g
 
 from .routes import register_routes
+from app.db.db_utils import get_db_pool
+from app.db.db_cards import get_store_pickled_cards
+from app.db.db_search import get_search_page_size
+from app.db.db_pool import create_connection_pool_from_config
+from app.db.db_annotation_queue import DEFAULT_CLAIM_TIMEOUT_MINUTES
+from app.classes.lru_cache import create_cache_from_config
+from app.setup.vectorize_cards import get_archetype_output_labels, get_feature_matrix_path
+from app.classes.card_object import get_card_template
+from app.functions.predict_archetypes import get_archetype_model, get_card_feature_matrix, get_weights_path
+
+# The config file of the web app, it can be changed with the MTG_ARCHETYPE_CONFIG environment variable
+APP_CONFIG_FILE = os.environ.get("MTG_ARCHETYPE_CONFIG", "test_config.ini")
+
+
+def read_app_config():
+    config = configparser.ConfigParser()
+    if not config.read(APP_CONFIG_FILE):
+        raise RuntimeError(f"Configuration file '{APP_CONFIG_FILE}' not found or unreadable.")
+    return config
+
 
 def create_app():
     app = Flask(__name__, static_folder='static')
 
     # Load config
-    config = configparser.ConfigParser()
-    if not config.read("test_config.ini"):
-        raise RuntimeError("Configuration file 'config.ini' not found or unreadable.")
+    config = read_app_config()
 
     # Secret key
     app.secret_key = config['appdata']['secret']
     if not app.secret_key:
         raise RuntimeError("SECRET_KEY is not set. Please set it in the environment.")
 
-    # Create a DB pool
-    app.config['DB_POOL'] = pool.SimpleConnectionPool(
-        minconn=1,
-        maxconn=10,
-        host=config["postgresql"]["host"],
-        database=config["postgresql"]["database"],
-        user=config["database_user"]["user"],
-        password=config["database_user"]["password"],
-    )
-
-    # Before request: attach connection
-    @app.before_request
-    def before_request():
-        try:
-            g.db_conn = app.config['DB_POOL'].getconn()
-        except Exception as e:
-            logging.error(f"Database connection error: {e}")
-            abort(500)
-
-    # Teardown request: release connection
+    # The cards are rebuilt from the typed columns of the cards table with these settings
+    app.config['ARCHETYPE_LABELS'] = get_archetype_output_labels(config)
+    app.config['STORE_PICKLED_CARDS'] = get_store_pickled_cards(config)
+
+    # Search results are paginated, the total number of results is only estimated if enabled
+    app.config['SEARCH_PAGE_SIZE'] = get_search_page_size(config)
+    app.config['SEARCH_APPROXIMATE_COUNT'] = config.getboolean("search", "approximate_count", fallback=False)
+
+    # A card handed out to an annotator is reserved for them for this long
+    app.config['ANNOTATION_CLAIM_TIMEOUT_MINUTES'] = config.getint("annotation_queue", "claim_timeout_minutes",
+                                                                   fallback=DEFAULT_CLAIM_TIMEOUT_MINUTES)
+
+    # Caches of this worker, keyed by card id. An entry is only returned if the card was not written since it was
+    # cached, by this worker or any other process (see get_card_version)
+    app.config['CARD_CACHE'] = create_cache_from_config(config, "card_cache", 2048, 600)
+    app.config['ANNOTATE_VIEW_CACHE'] = create_cache_from_config(config, "annotate_view_cache", 256, 300)
+    # Rendered search result pages, keyed by the normalized filters and the generation of the search results stored in
+    # the database (see create_cache_generations_table)
+    app.config['SEARCH_RESULT_CACHE'] = create_cache_from_config(config, "search_result_cache", 256, 120)
+
+    # The DB pool is created by every process the first time it needs it (see get_db_pool), so the web workers
+    # forked by the WSGI server don't share the connections of the process that created the app
+    app.config['DB_POOL_FACTORY'] = lambda: create_connection_pool_from_config(config)
+
+    # Teardown request: release the connection, if the request ran a query (see get_db_connection)
     @app.teardown_request
     def teardown_request(exception):
         db_conn = g.pop('db_conn', None)
@@ -51,9 +74,34 @@ def create_app():
             except Exception as e:
                 logging.error(f"Commit/Rollback error in teardown: {e}")
             finally:
-                app.config['DB_POOL'].putconn(db_conn)
+                get_db_pool().putconn(db_conn)
 
     # Register routes
     register_routes(app,config)
 
-    return app
\ No newline at end of file
+    return app
+
+
+def warm_up_app(app):
+    """
+    Loads what the first requests would otherwise load: the compiled page templates, the card template and, when
+    they exist, the model weights and the memory mapped feature matrix. Run before the workers accept traffic, with the
+    app preloaded by the WSGI server it is done once and the forked workers share it.
+    """
+    config = read_app_config()
+    for template_name in app.jinja_env.list_templates(extensions=["html"]):
+        app.jinja_env.get_template(template_name)
+    get_card_template()
+
+    weights_path = Path(config.get("model", "weights_filepath", fallback=""))
+    if weights_path.is_file():
+        get_archetype_model(str(get_weights_path(config)))
+    else:
+        logging.info(f"No model weights to preload in {weights_path}")
+    # The feature matrix carries the layout of the vocabulary it was built with, the model is checked against it
+    feature_matrix_path = get_feature_matrix_path(config)
+    if (feature_matrix_path / "shape.json").exists():
+        get_card_feature_matrix(str(feature_matrix_path))
+    else:
+        logging.info(f"No card feature matrix to preload in {feature_matrix_path}")
+    logging.info(f"Warmed up the app in process {os.getpid()}")
\ No newline at end of file
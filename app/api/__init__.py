@@ -0,0 +1,47 @@
+import asyncio
+import logging
+from pathlib import Path
+from quart import Quart
+from app import read_app_config
+from app.api.db import create_api_db_pool
+from app.api.routes import register_api_routes, load_prediction_model
+from app.db.db_search import get_search_page_size
+from app.setup.vectorize_cards import get_archetype_output_labels, get_feature_matrix_path
+
+
+def create_api_app():
+    """
+    JSON API (/api/v1) served by an ASGI server, next to the HTML app: the requests wait on PostgreSQL through an
+    asyncpg pool without holding a thread, so one process serves many clients at the same time.
+
+    An annotation sent through the API changes the version of the card, the caches of the web workers see it on the
+    next request (see get_card_version).
+    """
+    api_app = Quart(__name__)
+    config = read_app_config()
+    api_app.config["ARCHETYPE_LABELS"] = get_archetype_output_labels(config)
+    api_app.config["SEARCH_PAGE_SIZE"] = get_search_page_size(config)
+
+    @api_app.before_serving
+    async def open_db_pool():
+        api_app.config["API_DB_POOL"] = await create_api_db_pool(config)
+        logging.info("Opened the database pool of the API.")
+
+    @api_app.before_serving
+    async def preload_prediction_model():
+        # Loaded in a thread before the first request, like warm_up_app does for the web workers
+        if (Path(config.get("model", "weights_filepath", fallback="")).is_file()
+                and (get_feature_matrix_path(config) / "shape.json").exists()):
+            await asyncio.get_running_loop().run_in_executor(None, load_prediction_model, config)
+            logging.info("Loaded the model of the API.")
+
+    @api_app.after_serving
+    async def close_db_pool():
+        await api_app.config["API_DB_POOL"].close()
+
+    @api_app.route("/api/health")
+    async def health():
+        return {"status": "ok"}
+
+    register_api_routes(api_app, config)
+    return api_app
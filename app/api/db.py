@@ -0,0 +1,57 @@
+import itertools
+import json
+import re
+import asyncpg
+
+DEFAULT_API_POOL_MIN_CONNECTIONS = 1
+DEFAULT_API_POOL_MAX_CONNECTIONS = 10
+
+_PSYCOPG2_PLACEHOLDER = re.compile(r"%%|%s")
+
+
+def to_asyncpg_query(query: str) -> str:
+    """
+    Converts a query written for psycopg2 (%s placeholders, %% for a literal %) to the numbered placeholders of
+    asyncpg ($1, $2...), so the API runs the same queries as the web app.
+    """
+    placeholder_numbers = itertools.count(1)
+    return _PSYCOPG2_PLACEHOLDER.sub(lambda match: "%" if match.group(0) == "%%" else f"${next(placeholder_numbers)}",
+                                     query)
+
+
+async def init_api_connection(connection):
+    # The archetype scores of card_predictions are returned as dicts, as psycopg2 does
+    await connection.set_type_codec("jsonb", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+
+
+async def create_api_db_pool(config):
+    """
+    asyncpg pool of the API process, sized with [api] min_connections and max_connections.
+    """
+    return await asyncpg.create_pool(
+        min_size=config.getint("api", "min_connections", fallback=DEFAULT_API_POOL_MIN_CONNECTIONS),
+        max_size=config.getint("api", "max_connections", fallback=DEFAULT_API_POOL_MAX_CONNECTIONS),
+        host=config["postgresql"]["host"],
+        port=config.get("postgresql", "port", fallback="5432"),
+        database=config["postgresql"]["database"],
+        user=config["database_user"]["user"],
+        password=config["database_user"]["password"],
+        init=init_api_connection,
+    )
+
+
+async def fetch_latest_card_predictions(pool, card_ids):
+    """
+    The most recent archetype scores of every card of card_ids that was scored.
+
+    :return: dict card_id -> dict with model_version, archetype_scores and scored_at
+    """
+    rows = await pool.fetch("""
+        SELECT DISTINCT ON (card_id) card_id, model_version, archetype_scores, scored_at
+        FROM card_predictions
+        WHERE card_id = ANY($1::int[])
+        ORDER BY card_id, scored_at DESC
+    """, list(card_ids))
+    return {row["card_id"]: {"model_version": row["model_version"],
+                             "archetype_scores": row["archetype_scores"],
+                             "scored_at": row["scored_at"].isoformat()} for row in rows}
@@ -0,0 +1,141 @@
+import asyncio
+import hmac
+import logging
+from pathlib import Path
+from quart import Blueprint, current_app, jsonify, request
+from app.api.db import to_asyncpg_query, fetch_latest_card_predictions
+from app.classes.card_object import ARCHETYPE_OUTPUT_PREFIX, pack_archetype_vector
+from app.db.db_annotation_statistics import ANNOTATED_CARDS_COUNTER, ANNOTATION_CHANGES_COUNTER
+from app.db.db_cards import UPDATE_CARD_ANNOTATION_QUERY
+from app.db.db_search import (SEARCH_RESULT_COLUMNS, MAX_SEARCH_PAGE_SIZE, get_search_filters, build_search_query,
+                              get_search_result_row, get_next_search_cursor, decode_search_cursor,
+                              is_search_cursor_of_filters)
+from app.functions.predict_archetypes import (get_archetype_model, get_card_feature_matrix, get_weights_path,
+                                              predict_cards)
+from app.functions.update_archetypes import get_annotation_of_labels
+from app.setup.vectorize_cards import get_feature_matrix_path
+
+DEFAULT_MAX_PREDICTION_BATCH_SIZE = 500
+
+
+def api_error(message, status):
+    return jsonify({"error": message}), status
+
+
+def get_card_json(row):
+    card = get_search_result_row(row)
+    card.pop("rank")
+    return card
+
+
+def load_prediction_model(config):
+    """
+    The model and the memory mapped feature matrix, loaded the first time and cached by the process (the matrix is
+    mapped again when it is saved again). Reading the weights blocks, it is called in a thread of the executor, never
+    on the event loop.
+
+    :return: (model, matrix)
+    """
+    return (get_archetype_model(str(get_weights_path(config))),
+            get_card_feature_matrix(str(get_feature_matrix_path(config))))
+
+
+def predict_cards_with_saved_model(config, card_ids):
+    """
+    :return: (model version, dict card_id -> archetype scores), runs in a thread of the executor
+    """
+    model, matrix = load_prediction_model(config)
+    return model.model_version, predict_cards(card_ids, model, matrix)
+
+
+def register_api_routes(api_app, config):
+    api = Blueprint("api_v1", __name__, url_prefix="/api/v1")
+    api_token = config.get("api", "token", fallback="")
+    max_prediction_batch_size = config.getint("api", "max_prediction_batch_size",
+                                              fallback=DEFAULT_MAX_PREDICTION_BATCH_SIZE)
+
+    @api.before_request
+    async def check_api_token():
+        # Without a token in the config file the API is closed
+        authorization = request.headers.get("Authorization", "")
+        if not api_token or not hmac.compare_digest(authorization, f"Bearer {api_token}"):
+            return api_error("A valid API token is required", 401)
+
+    @api.route("/cards/<int:card_id>", methods=["GET"])
+    async def get_card(card_id):
+        row = await current_app.config["API_DB_POOL"].fetchrow(
+            f"SELECT {SEARCH_RESULT_COLUMNS} FROM cards WHERE id = $1", card_id)
+        if row is None:
+            return api_error(f"The card {card_id} doesn't exist", 404)
+        return jsonify(get_card_json(row))
+
+    @api.route("/cards", methods=["GET"])
+    async def search():
+        """
+        Same filters and keyset pagination as the /cards page: the next page is requested with after=<next_cursor>.
+        """
+        filters = get_search_filters(request.args)
+        after = decode_search_cursor(request.args.get("after"))
+        if request.args.get("after") and (after is None or not is_search_cursor_of_filters(filters, after)):
+            return api_error("after has to be the next_cursor of a page of the same search", 400)
+        page_size = request.args.get("page_size", current_app.config["SEARCH_PAGE_SIZE"], type=int)
+        page_size = max(1, min(page_size, MAX_SEARCH_PAGE_SIZE))
+        # One more row than the page size tells if there is a next page
+        query, params = build_search_query(filters, after, page_size + 1)
+        rows = await current_app.config["API_DB_POOL"].fetch(to_asyncpg_query(query), *params)
+        results = [get_search_result_row(row) for row in rows[:page_size]]
+        next_cursor = get_next_search_cursor(filters, results[-1]) if len(rows) > page_size else None
+        return jsonify({"results": results, "next_cursor": next_cursor, "page_size": page_size})
+
+    @api.route("/predictions", methods=["POST"])
+    async def batch_predictions():
+        """
+        Archetype scores of a list of cards ({"card_ids": [...]}): the ones stored by the last scoring job, and for
+        the cards scored after it, computed with the model loaded in the process.
+        """
+        body = await request.get_json(silent=True) or {}
+        card_ids = body.get("card_ids")
+        if not isinstance(card_ids, list) or not all(isinstance(card_id, int) for card_id in card_ids):
+            return api_error("card_ids has to be a list of card ids", 400)
+        if len(card_ids) > max_prediction_batch_size:
+            return api_error(f"At most {max_prediction_batch_size} cards can be predicted per request", 400)
+
+        predictions = await fetch_latest_card_predictions(current_app.config["API_DB_POOL"], card_ids)
+        cards_not_scored = [card_id for card_id in card_ids if card_id not in predictions]
+        if cards_not_scored and Path(config.get("model", "weights_filepath", fallback="")).is_file():
+            # The model is loaded and runs in a thread, the event loop keeps serving the other requests meanwhile
+            model_version, live_predictions = await asyncio.get_running_loop().run_in_executor(
+                None, predict_cards_with_saved_model, config, cards_not_scored)
+            for card_id, archetype_scores in live_predictions.items():
+                predictions[card_id] = {"model_version": model_version, "archetype_scores": archetype_scores,
+                                        "scored_at": None}
+        return jsonify({"predictions": {str(card_id): predictions.get(card_id) for card_id in card_ids}})
+
+    @api.route("/cards/<int:card_id>/annotation", methods=["POST"])
+    async def submit_annotation(card_id):
+        """
+        Annotates a card with a list of archetype names ({"archetypes": [...]}), with the same statement as the
+        annotate page (history, dashboard counters and annotation queue included).
+        """
+        body = await request.get_json(silent=True) or {}
+        archetypes = body.get("archetypes")
+        archetype_labels = current_app.config["ARCHETYPE_LABELS"]
+        if not isinstance(archetypes, list) or not all(isinstance(archetype, str) for archetype in archetypes):
+            return api_error("archetypes has to be a list of archetype names", 400)
+        unknown_archetypes = sorted(set(ARCHETYPE_OUTPUT_PREFIX + archetype for archetype in archetypes)
+                                    - set(archetype_labels))
+        if unknown_archetypes:
+            return api_error(f"Unknown archetypes: {[label[len(ARCHETYPE_OUTPUT_PREFIX):] for label in unknown_archetypes]}",
+                             400)
+
+        vector_output, annotated_archetypes = get_annotation_of_labels(
+            {ARCHETYPE_OUTPUT_PREFIX + archetype for archetype in archetypes}, archetype_labels)
+        number_of_cards_updated = await current_app.config["API_DB_POOL"].fetchval(
+            to_asyncpg_query(UPDATE_CARD_ANNOTATION_QUERY), card_id, annotated_archetypes,
+            pack_archetype_vector(vector_output), ANNOTATION_CHANGES_COUNTER, ANNOTATED_CARDS_COUNTER)
+        if not number_of_cards_updated:
+            return api_error(f"The card {card_id} doesn't exist", 404)
+        logging.info(f"Updated the annotation of the card {card_id} through the API")
+        return jsonify({"id": card_id, "annotated_archetypes": annotated_archetypes})
+
+    api_app.register_blueprint(api)
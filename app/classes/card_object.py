@@ -34,12 +34,35 @@ CARD_COLOR_MAPPING = {
 }
 
 from dataclasses import dataclass, field, asdict
-from typing import List, Optional, Dict
+from functools import lru_cache
+from typing import List, Optional, Dict, Iterable
 from pathlib import Path
 from jinja2 import Environment, FileSystemLoader
 import re
 import numpy as np
 
+# Path to the folder containing the templates
+TEMPLATE_DIRECTORY = Path(__file__).resolve().parent.parent / "templates"
+DISPLAY_HTML_NOT_RENDERED = "<div><p>Render not available</p></div>"
+# Prefix of the labels of the output vector, the rest of the label is the archetype name
+ARCHETYPE_OUTPUT_PREFIX = "output_archetype_"
+
+
+@lru_cache(maxsize=1)
+def get_template_environment() -> Environment:
+    """
+    Jinja2 environment shared by the whole process, the templates compiled by it are cached and reused.
+    """
+    return Environment(loader=FileSystemLoader(TEMPLATE_DIRECTORY))
+
+
+@lru_cache(maxsize=None)
+def get_card_template(template_name: str = "card_template.html"):
+    """
+    Compiled card template, it is read and compiled only once per process.
+    """
+    return get_template_environment().get_template(template_name)
+
 @dataclass
 class MagicCard:
     id: int
@@ -57,9 +80,9 @@ class MagicCard:
     mcm_meta_id: int
     card_market_link: str
     tcg_player_link: str
-    vector_input: Optional[np.ndarray] = field(default=None, init=False, repr=False, compare=False)
+    # Row of the card in the CardFeatureMatrix of the catalogue, the input features are not stored in the card
+    feature_row: Optional[int] = field(default=None, init=False, repr=False, compare=False)
     vector_output: Optional[np.ndarray] = field(default=None, init=False, repr=False, compare=False)
-    vector_input_labels: List[str] = field(default_factory=list, init=False, repr=False, compare=False)
     vector_output_labels: List[str] = field(default_factory=list, init=False, repr=False, compare=False)
     predicted_archetypes: List[str] = field(default_factory=list)
     annotated_archetypes: List[str] = field(default_factory=list)
@@ -70,39 +93,89 @@ class MagicCard:
     display_color: str = ""
     display_card_type: str = ""
     display_card_subtype: str = ""
-    display_html: str = "<div><p>Render not available</p></div>"
+    display_html: str = DISPLAY_HTML_NOT_RENDERED
 
     @classmethod
-    def create(cls, **kwargs) -> "MagicCard":
+    def create(cls, render_html: bool = True, **kwargs) -> "MagicCard":
+        """
+        Creates the card computing its display attributes.
+
+        :param render_html: if False the display_html is not rendered now, it is rendered on the first call to
+        get_display_html or in bulk with render_cards_display_html
+        """
         kwargs["display_color"] = get_display_color(kwargs.get("color", []))
         kwargs["display_mana_cost"] = get_display_mana_cost(kwargs.get("mana_cost", ""))
         kwargs["display_card_type"] = get_display_card_type_or_subtype(kwargs.get("card_type", []))
         kwargs["display_card_subtype"] = get_display_card_type_or_subtype(kwargs.get("subtypes", []))
-        # Path to the folder containing your templates
-        template_dir = Path(__file__).resolve().parent.parent / "templates"
-        env = Environment(loader=FileSystemLoader(template_dir))
-        template = env.get_template("card_template.html")
         card = cls(**kwargs)
-        card.display_html = template.render(card=card)
+        if render_html:
+            card.render_display_html()
         return card
 
-    def update_vectors(self, input_vector_dict: Dict[str, float],
+    def render_display_html(self, template=None) -> str:
+        if template is None:
+            template = get_card_template()
+        self.display_html = template.render(card=self)
+        return self.display_html
+
+    def get_display_html(self) -> str:
+        """
+        Returns the display_html, rendering it first if it wasn't rendered yet.
+        """
+        if self.display_html == DISPLAY_HTML_NOT_RENDERED:
+            return self.render_display_html()
+        return self.display_html
+
+    def update_vectors(self, feature_row: int,
                        output_vector_dict: Optional[Dict[str, float]] = None):
         """
-        Update MagicCard object with input/output vectors and their labels.
+        Update MagicCard object with its row in the feature matrix and the output vector and its labels.
 
-        :param input_vector_dict: dict {label: value} for input features
+        :param feature_row: row of the card in the CardFeatureMatrix
         :param output_vector_dict: dict {label: value} for output targets (optional)
         """
-        # Store labels and values for input vector
-        self.vector_input_labels = list(input_vector_dict.keys())
-        self.vector_input = np.array(list(input_vector_dict.values()), dtype=float)
+        self.feature_row = feature_row
 
         # If output vector is provided
         if output_vector_dict is not None:
             self.vector_output_labels = list(output_vector_dict.keys())
             self.vector_output = np.array(list(output_vector_dict.values()), dtype=float)
 
+def render_cards_display_html(cards: Iterable[MagicCard], only_missing: bool = True) -> None:
+    """
+    Renders the display_html of a list of cards with the shared compiled template.
+
+    :param cards: iterable of MagicCard
+    :param only_missing: if True the cards that already have their display_html rendered are skipped
+    """
+    template = get_card_template()
+    for card in cards:
+        if only_missing and card.display_html != DISPLAY_HTML_NOT_RENDERED:
+            continue
+        card.render_display_html(template)
+
+
+def pack_archetype_vector(vector_output) -> Optional[bytes]:
+    """
+    Stores the output vector as a packed bit array, one bit per archetype (8 archetypes per byte).
+
+    :return: bytes for the archetype_bits column, None if the card has no output vector
+    """
+    if vector_output is None:
+        return None
+    return np.packbits(np.asarray(vector_output) >= 0.5).tobytes()
+
+
+def unpack_archetype_bits(archetype_bits, number_of_archetypes: int) -> np.ndarray:
+    """
+    Inverse of pack_archetype_vector, archetypes missing in the bit array (labels added after it was stored) are 0.
+    """
+    bits = np.unpackbits(np.frombuffer(bytes(archetype_bits), dtype=np.uint8))[:number_of_archetypes]
+    vector_output = np.zeros(number_of_archetypes, dtype=float)
+    vector_output[:len(bits)] = bits
+    return vector_output
+
+
 def get_display_color(entry):
     if len(entry) > 1:
         return CARD_COLOR_MAPPING["multicolor"]
@@ -0,0 +1,318 @@
+import json
+import logging
+import os
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+
+NUMERIC_FEATURE_PREFIX = "input_"
+COLOR_FEATURE_PREFIX = "input_color_"
+CARDTYPE_FEATURE_PREFIX = "input_cardtypes_"
+SUPERTYPE_FEATURE_PREFIX = "input_supertypes_"
+SUBTYPE_FEATURE_PREFIX = "input_subtypes_"
+WORD_FEATURE_PREFIX = "input_word_"
+
+# Numeric features, label -> MagicCard attribute
+NON_CATEGORICAL_FEATURES = {"input_cost": "converted_mana_cost",
+                            "input_power": "power",
+                            "input_toughness": "toughness"}
+
+
+@dataclass
+class FeatureVocabulary:
+    """
+    Labels of the columns of the card feature matrix. It is shared by all the cards.
+
+    The layout is append only: extending the vocabulary adds columns at the end and bumps the version, the columns
+    that already existed never move, so the rows vectorized with an older version stay valid. A vocabulary built
+    from scratch gets a new layout_id, vectors of different layouts can't be mixed.
+    """
+    labels: List[str]
+    # When bigger than 0 the words are not in the labels, they are hashed into this number of columns placed after
+    # the labels that existed when the vocabulary was built (hashing trick)
+    word_hash_buckets: int = 0
+    word_hash_first_column: Optional[int] = None
+    version: int = 1
+    layout_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    index: Dict[str, int] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        if self.word_hash_first_column is None:
+            self.word_hash_first_column = len(self.labels)
+        self._build_index()
+
+    def _build_index(self):
+        # The labels appended after the hashed columns are placed after them
+        self.index = {label: position if position < self.word_hash_first_column else position + self.word_hash_buckets
+                      for position, label in enumerate(self.labels)}
+
+    def __len__(self):
+        return len(self.labels) + self.word_hash_buckets
+
+    @classmethod
+    def from_categories(cls, colors, card_types, super_types, subtypes, words, word_hash_buckets=0) -> "FeatureVocabulary":
+        return cls(get_category_labels(colors, card_types, super_types, subtypes, words if not word_hash_buckets else []),
+                   word_hash_buckets)
+
+    def extend(self, colors, card_types, super_types, subtypes, words) -> int:
+        """
+        Appends the labels of the categories given that are not in the vocabulary yet.
+
+        :return: number of columns added, the version is bumped when it is bigger than 0
+        """
+        new_labels = [label for label in get_category_labels(colors, card_types, super_types, subtypes,
+                                                              words if not self.word_hash_buckets else [])
+                      if label not in self.index]
+        if new_labels:
+            self.labels.extend(new_labels)
+            self.version += 1
+            self._build_index()
+        return len(new_labels)
+
+    def to_dict(self) -> dict:
+        return {"version": self.version,
+                "layout_id": self.layout_id,
+                "labels": self.labels,
+                "word_hash_buckets": self.word_hash_buckets,
+                "word_hash_first_column": self.word_hash_first_column}
+
+    @classmethod
+    def from_dict(cls, dictionary: dict) -> "FeatureVocabulary":
+        return cls(labels=list(dictionary["labels"]),
+                   word_hash_buckets=int(dictionary.get("word_hash_buckets", 0)),
+                   word_hash_first_column=dictionary.get("word_hash_first_column"),
+                   version=int(dictionary.get("version", 1)),
+                   layout_id=dictionary.get("layout_id", ""))
+
+    def save(self, file_path) -> None:
+        """
+        Writes the vocabulary as JSON, through a temporary file so a failure never leaves a half written vocabulary.
+        """
+        file_path = Path(file_path)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = file_path.with_name(file_path.name + ".tmp")
+        with open(temporary_path, "w", encoding="utf8") as file:
+            json.dump(self.to_dict(), file)
+        os.replace(temporary_path, file_path)
+        logging.info(f"Saved the feature vocabulary version {self.version} ({len(self)} columns) in {file_path}")
+
+    @classmethod
+    def load(cls, file_path) -> Optional["FeatureVocabulary"]:
+        """
+        :return: the vocabulary saved in file_path, None if there is no such file
+        """
+        file_path = Path(file_path)
+        if not file_path.exists():
+            return None
+        with open(file_path, "r", encoding="utf8") as file:
+            dictionary = json.load(file)
+        # Vocabularies saved before the versioning were a plain list of labels
+        if isinstance(dictionary, list):
+            dictionary = {"labels": dictionary}
+        return cls.from_dict(dictionary)
+
+    def columns_with_prefix(self, prefix: str) -> Dict[str, int]:
+        """
+        Maps the values of the labels that start with prefix to their column, e.g. {"W": 3} for "input_color_W".
+        """
+        return {label[len(prefix):]: column for label, column in self.index.items() if label.startswith(prefix)}
+
+
+def get_category_labels(colors, card_types, super_types, subtypes, words) -> List[str]:
+    labels = list(NON_CATEGORICAL_FEATURES)
+    labels += [COLOR_FEATURE_PREFIX + str(color) for color in sorted(colors)]
+    labels += [CARDTYPE_FEATURE_PREFIX + str(card_type) for card_type in sorted(card_types)]
+    labels += [SUPERTYPE_FEATURE_PREFIX + str(super_type) for super_type in sorted(super_types)]
+    labels += [SUBTYPE_FEATURE_PREFIX + str(subtype) for subtype in sorted(subtypes)]
+    labels += [WORD_FEATURE_PREFIX + str(word) for word in sorted(words)]
+    return labels
+
+
+class CardFeatureMatrix:
+    """
+    Feature vectors of the whole catalogue in CSR layout: the columns of the non zero values of the row r are
+    indices[indptr[r]:indptr[r + 1]] and their values are in data at the same positions.
+    Row r belongs to the card card_ids[r].
+
+    It is saved as a folder of .npy files so it can be loaded memory mapped.
+    """
+
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, data: np.ndarray, number_of_columns: int,
+                 card_ids: np.ndarray, vocabulary_layout_id: str = "", vocabulary_version: int = 0):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.number_of_columns = number_of_columns
+        self.card_ids = card_ids
+        self.vocabulary_layout_id = vocabulary_layout_id
+        self.vocabulary_version = vocabulary_version
+        self._row_of_card_id = None
+
+    @property
+    def number_of_rows(self) -> int:
+        return len(self.indptr) - 1
+
+    @property
+    def nbytes(self) -> int:
+        return self.indptr.nbytes + self.indices.nbytes + self.data.nbytes + self.card_ids.nbytes
+
+    def row(self, row: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: (columns, values) of the non zero values of the row
+        """
+        start, end = self.indptr[row], self.indptr[row + 1]
+        return self.indices[start:end], self.data[start:end]
+
+    def row_of_card_id(self, card_id) -> Optional[int]:
+        if self._row_of_card_id is None:
+            self._row_of_card_id = {int(card_id): row for row, card_id in enumerate(self.card_ids)}
+        return self._row_of_card_id.get(int(card_id))
+
+    def to_dense(self, rows: Optional[Iterable[int]] = None) -> np.ndarray:
+        """
+        Dense float32 array of the rows given, all the rows if None. Meant for small slices only.
+        """
+        rows = range(self.number_of_rows) if rows is None else list(rows)
+        dense = np.zeros((len(rows), self.number_of_columns), dtype=np.float32)
+        for position, row in enumerate(rows):
+            columns, values = self.row(row)
+            dense[position, columns] = values
+        return dense
+
+    def dot(self, weights: np.ndarray, rows: Optional[Iterable[int]] = None) -> np.ndarray:
+        """
+        Product of the rows given (all of them if None) by a dense weight matrix, without building the dense rows.
+        Columns beyond the number of rows of weights are ignored, so a model trained with an older version of an
+        extended vocabulary can still be applied.
+
+        :param weights: array of shape (number of features, number of outputs)
+        :param rows: rows of the matrix
+        :return: float32 array of shape (number of rows, number of outputs)
+        """
+        rows = np.arange(self.number_of_rows) if rows is None else np.asarray(list(rows), dtype=np.int64)
+        result = np.zeros((len(rows), weights.shape[1]), dtype=np.float32)
+        if len(rows) == 0:
+            return result
+        starts = np.asarray(self.indptr[rows])
+        lengths = np.asarray(self.indptr[rows + 1]) - starts
+        # Positions in indices/data of the values of all the rows, row after row
+        segment_offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        positions = np.arange(lengths.sum()) + np.repeat(starts - segment_offsets, lengths)
+        columns = np.asarray(self.indices[positions])
+        values = np.asarray(self.data[positions])
+        row_of_value = np.repeat(np.arange(len(rows)), lengths)
+
+        known_columns = columns < weights.shape[0]
+        columns, values, row_of_value = columns[known_columns], values[known_columns], row_of_value[known_columns]
+        if len(columns) == 0:
+            return result
+        contributions = values[:, None] * weights[columns]
+        # The values are sorted by row, every row is a contiguous segment that is summed with reduceat
+        values_per_row = np.bincount(row_of_value, minlength=len(rows))
+        segment_starts = np.concatenate(([0], np.cumsum(values_per_row)[:-1]))
+        non_empty_rows = values_per_row > 0
+        result[non_empty_rows] = np.add.reduceat(contributions, segment_starts[non_empty_rows], axis=0)
+        return result
+
+    def concatenate(self, other: "CardFeatureMatrix") -> "CardFeatureMatrix":
+        """
+        New matrix with the rows of other after the rows of this one. The vocabulary of other must be the same one or
+        an extension of it.
+        """
+        if self.vocabulary_layout_id and other.vocabulary_layout_id != self.vocabulary_layout_id:
+            raise ValueError("The matrices were vectorized with different vocabularies and can't be concatenated.")
+        indptr = np.concatenate([np.asarray(self.indptr), np.asarray(other.indptr[1:]) + self.indptr[-1]])
+        return CardFeatureMatrix(indptr=indptr,
+                                 indices=np.concatenate([self.indices, other.indices]),
+                                 data=np.concatenate([self.data, other.data]),
+                                 number_of_columns=max(self.number_of_columns, other.number_of_columns),
+                                 card_ids=np.concatenate([self.card_ids, other.card_ids]),
+                                 vocabulary_layout_id=other.vocabulary_layout_id,
+                                 vocabulary_version=max(self.vocabulary_version, other.vocabulary_version))
+
+    def save(self, folder_path) -> None:
+        """
+        Writes every file to a temporary file first and moves them into place with os.replace, shape.json last. The
+        processes that have the matrix memory mapped keep reading the files they opened, a file is never truncated or
+        rewritten under them.
+        """
+        folder_path = Path(folder_path)
+        folder_path.mkdir(parents=True, exist_ok=True)
+        arrays = {"indptr.npy": self.indptr, "indices.npy": self.indices, "data.npy": self.data,
+                  "card_ids.npy": self.card_ids}
+        for file_name, array in arrays.items():
+            with open(folder_path / (file_name + ".tmp"), "wb") as file:
+                np.save(file, array)
+        with open(folder_path / "shape.json.tmp", "w", encoding="utf8") as file:
+            json.dump({"number_of_rows": self.number_of_rows,
+                       "number_of_columns": self.number_of_columns,
+                       "vocabulary_layout_id": self.vocabulary_layout_id,
+                       "vocabulary_version": self.vocabulary_version}, file)
+        for file_name in list(arrays) + ["shape.json"]:
+            os.replace(folder_path / (file_name + ".tmp"), folder_path / file_name)
+        logging.info(f"Saved a card feature matrix of {self.number_of_rows} x {self.number_of_columns} "
+                     f"({self.nbytes} bytes) in {folder_path}")
+
+    @classmethod
+    def load(cls, folder_path, memory_map: bool = True) -> "CardFeatureMatrix":
+        folder_path = Path(folder_path)
+        mmap_mode = "r" if memory_map else None
+        with open(folder_path / "shape.json", "r", encoding="utf8") as file:
+            shape = json.load(file)
+        matrix = cls(indptr=np.load(folder_path / "indptr.npy", mmap_mode=mmap_mode),
+                     indices=np.load(folder_path / "indices.npy", mmap_mode=mmap_mode),
+                     data=np.load(folder_path / "data.npy", mmap_mode=mmap_mode),
+                     number_of_columns=shape["number_of_columns"],
+                     card_ids=np.load(folder_path / "card_ids.npy", mmap_mode=mmap_mode),
+                     vocabulary_layout_id=shape.get("vocabulary_layout_id", ""),
+                     vocabulary_version=shape.get("vocabulary_version", 0))
+        # Files of two different saves, read while the matrix was being replaced
+        if (matrix.number_of_rows != shape["number_of_rows"] or len(matrix.card_ids) != matrix.number_of_rows
+                or int(matrix.indptr[-1]) != len(matrix.indices) or len(matrix.indices) != len(matrix.data)):
+            raise ValueError(f"The card feature matrix in {folder_path} is being replaced, load it again.")
+        return matrix
+
+
+class CardFeatureMatrixBuilder:
+    """
+    Collects the rows of a CardFeatureMatrix one batch at a time, the row of a card is its position of arrival.
+    """
+
+    def __init__(self, number_of_columns: int, first_row: int = 0, vocabulary: Optional[FeatureVocabulary] = None):
+        """
+        :param number_of_columns: number of columns of the matrix
+        :param first_row: row given to the first card, to build rows that will be appended to an existing matrix
+        :param vocabulary: vocabulary the rows are vectorized with, its version is recorded in the matrix
+        """
+        self.number_of_columns = number_of_columns
+        self.first_row = first_row
+        self.vocabulary = vocabulary
+        self.row_lengths = []
+        self.indices = []
+        self.data = []
+        self.card_ids = []
+
+    def __len__(self):
+        return len(self.card_ids)
+
+    def add_row(self, card_id, columns: np.ndarray, values: np.ndarray) -> int:
+        """
+        :return: the row given to the card
+        """
+        self.row_lengths.append(len(columns))
+        self.indices.append(columns)
+        self.data.append(values)
+        self.card_ids.append(int(card_id))
+        return self.first_row + len(self.card_ids) - 1
+
+    def build(self) -> CardFeatureMatrix:
+        indptr = np.zeros(len(self.row_lengths) + 1, dtype=np.int64)
+        np.cumsum(self.row_lengths, out=indptr[1:])
+        indices = np.concatenate(self.indices).astype(np.int32) if self.indices else np.zeros(0, dtype=np.int32)
+        data = np.concatenate(self.data).astype(np.float32) if self.data else np.zeros(0, dtype=np.float32)
+        return CardFeatureMatrix(indptr, indices, data, self.number_of_columns,
+                                 np.array(self.card_ids, dtype=np.int64),
+                                 vocabulary_layout_id=self.vocabulary.layout_id if self.vocabulary else "",
+                                 vocabulary_version=self.vocabulary.version if self.vocabulary else 0)
@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+# Returned by LRUCache.get when the key is not cached, None can be a cached value
+CACHE_MISS = object()
+
+
+class LRUCache:
+    """
+    Bounded in-process cache: when it is full the least recently used entry is evicted, and with a ttl_seconds the
+    entries older than it are not returned anymore.
+
+    It is shared by the threads of a web worker, every operation takes the cache lock. The hit, miss and eviction
+    counters tell how much work the cache saves.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: Optional[float] = None):
+        if max_entries < 0:
+            raise ValueError("The maximum number of entries of a cache can't be negative.")
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # key -> (time it was stored, value), the least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any:
+        """
+        :return: the cached value, CACHE_MISS if the key is not cached or its entry expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, value = entry
+                if self.ttl_seconds is None or time.monotonic() - stored_at < self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return CACHE_MISS
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.max_entries == 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries),
+                    "max_entries": self.max_entries,
+                    "ttl_seconds": self.ttl_seconds,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "hit_ratio": self.hits / lookups if lookups else 0.0}
+
+
+def create_cache_from_config(config, cache_name: str, default_max_entries: int,
+                             default_ttl_seconds: Optional[float] = None) -> LRUCache:
+    """
+    Cache sized with the [cache] section of the config file: <cache_name>_size and <cache_name>_ttl_seconds
+    (0 means the entries don't expire).
+    """
+    max_entries = config.getint("cache", f"{cache_name}_size", fallback=default_max_entries)
+    ttl_seconds = config.getfloat("cache", f"{cache_name}_ttl_seconds", fallback=default_ttl_seconds or 0)
+    return LRUCache(max_entries, ttl_seconds or None)
@@ -0,0 +1,252 @@
+import argparse
+import configparser
+import logging
+import sys
+import psycopg2
+from .db_utils import execute_query, commit, rollback
+
+# uncertainty: the cards whose archetype scores are closest to 0.5 first
+# least_annotated: the cards most likely to belong to the archetypes with the fewest annotated cards first
+QUEUE_STRATEGIES = ("uncertainty", "least_annotated")
+DEFAULT_CLAIM_TIMEOUT_MINUTES = 30
+
+# Priority of a card computed from its archetype scores, score.value is the probability of one archetype
+QUEUE_PRIORITY_EXPRESSIONS = {
+    "uncertainty": "AVG(1 - ABS(2 * score.value::float8 - 1))",
+    "least_annotated": "MAX(score.value::float8 / (1 + COALESCE(archetype_counts.number_of_cards, 0)))",
+}
+
+
+# =============================
+# Create table (runs once)
+# =============================
+def create_annotation_queue_table(conn):
+    """
+    Creates the queue of cards to annotate. A card is pending until it is annotated (completed_at), and it is claimed
+    by an annotator for a while when it is handed out, so two annotators don't get the same card.
+
+    The partial index on the pending cards, in priority order, makes taking the next card an index lookup however many
+    cards were already annotated.
+    """
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS annotation_queue (
+        card_id INTEGER PRIMARY KEY REFERENCES cards (id) ON DELETE CASCADE,
+        priority DOUBLE PRECISION NOT NULL,
+        strategy TEXT NOT NULL,
+        queued_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        claimed_by TEXT,
+        claimed_at TIMESTAMP,
+        completed_at TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS annotation_queue_pending_priority_idx
+        ON annotation_queue (priority DESC, card_id) WHERE completed_at IS NULL;
+    CREATE INDEX IF NOT EXISTS annotation_queue_pending_claimed_by_idx
+        ON annotation_queue (claimed_by) WHERE completed_at IS NULL;
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute(create_table_query)
+            conn.commit()
+            logging.info("Annotation queue table created successfully.")
+    except psycopg2.Error as e:
+        logging.error(f"Database error creating the annotation queue table: {e}")
+        conn.rollback()
+        raise
+
+
+# =============================
+# Fill the queue (offline job)
+# =============================
+def get_refresh_annotation_queue_query(strategy):
+    """
+    INSERT ... SELECT that queues every card without annotations, with the priority of the strategy computed from its
+    latest archetype scores. The cards that were never scored get priority 0, so the queue works before the first
+    model is trained. The cards already annotated through the queue are left as they are.
+    """
+    if strategy not in QUEUE_STRATEGIES:
+        raise ValueError(f"Unknown annotation queue strategy {strategy}, use one of {QUEUE_STRATEGIES}")
+    return f"""
+    WITH latest_predictions AS (
+        SELECT DISTINCT ON (card_id) card_id, archetype_scores
+        FROM card_predictions
+        ORDER BY card_id, scored_at DESC
+    ), archetype_counts AS (
+        SELECT annotated.archetype, count(*) AS number_of_cards
+        FROM cards
+        CROSS JOIN LATERAL unnest(CASE WHEN cardinality(gold_standard_archetypes) > 0 THEN gold_standard_archetypes
+                                       ELSE annotated_archetypes END) AS annotated (archetype)
+        GROUP BY annotated.archetype
+    ), candidates AS (
+        SELECT cards.id AS card_id, COALESCE({QUEUE_PRIORITY_EXPRESSIONS[strategy]}, 0) AS priority
+        FROM cards
+        LEFT JOIN latest_predictions ON latest_predictions.card_id = cards.id
+        LEFT JOIN LATERAL jsonb_each_text(latest_predictions.archetype_scores) AS score (archetype, value) ON TRUE
+        LEFT JOIN archetype_counts ON archetype_counts.archetype = score.archetype
+        WHERE COALESCE(cardinality(cards.annotated_archetypes), 0) = 0
+          AND COALESCE(cardinality(cards.gold_standard_archetypes), 0) = 0
+        GROUP BY cards.id
+    )
+    INSERT INTO annotation_queue (card_id, priority, strategy)
+    SELECT card_id, priority, %s FROM candidates
+    ON CONFLICT (card_id) DO UPDATE
+    SET priority = EXCLUDED.priority,
+        strategy = EXCLUDED.strategy,
+        queued_at = CURRENT_TIMESTAMP
+    WHERE annotation_queue.completed_at IS NULL
+    """
+
+
+def refresh_annotation_queue(config, strategy="uncertainty"):
+    """
+    Recomputes the priorities of the queue from the card_predictions table (score_catalogue runs it after scoring).
+    Opens and closes its own connection, the priorities change in one transaction so the annotators keep getting
+    cards while it runs.
+
+    :param config: configparser object
+    :param strategy: one of QUEUE_STRATEGIES
+    :return: number of cards queued or requeued
+    """
+    query = get_refresh_annotation_queue_query(strategy)
+    conn = None
+    try:
+        conn = psycopg2.connect(dbname=config["postgresql"]["database"],
+                                user=config["database_user"]["user"],
+                                password=config["database_user"]["password"],
+                                host=config["postgresql"]["host"],
+                                port=config["postgresql"]["port"])
+        with conn.cursor() as cur:
+            cur.execute(query, (strategy,))
+            number_of_cards_queued = cur.rowcount
+            conn.commit()
+            # Keeps the statistics of the partial index up to date for the planner
+            cur.execute("ANALYZE annotation_queue")
+            conn.commit()
+        logging.info(f"Queued {number_of_cards_queued} cards to annotate with the {strategy} strategy.")
+        return number_of_cards_queued
+    except psycopg2.Error as e:
+        logging.error(f"Failed to refresh the annotation queue: {e}")
+        if conn:
+            conn.rollback()
+        raise
+    finally:
+        if conn:
+            conn.close()
+
+
+# =============================
+# Hand out the next card
+# =============================
+def claim_next_card_to_annotate(annotator, claim_timeout_minutes=DEFAULT_CLAIM_TIMEOUT_MINUTES):
+    """
+    The card the annotator should annotate next. The annotator gets back the card they already claimed if they
+    didn't annotate it yet, otherwise the pending card with the highest priority that nobody else holds is claimed.
+
+    The claim locks the queue row with FOR UPDATE SKIP LOCKED, so concurrent annotators skip each other's rows instead
+    of waiting or getting the same card. Claims older than claim_timeout_minutes are handed out again.
+
+    :param annotator: username of the annotator
+    :param claim_timeout_minutes: minutes a card stays reserved for the annotator who claimed it
+    :return: id of the card, None if the queue is empty
+    """
+    try:
+        rows = execute_query("""
+        SELECT card_id FROM annotation_queue
+        WHERE claimed_by = %s
+          AND completed_at IS NULL
+          AND claimed_at >= CURRENT_TIMESTAMP - %s * INTERVAL '1 minute'
+        ORDER BY claimed_at DESC
+        LIMIT 1
+        """, (annotator, claim_timeout_minutes), fetch=True)
+        if rows:
+            return rows[0][0]
+
+        rows = execute_query("""
+        WITH next_card AS (
+            SELECT card_id FROM annotation_queue
+            WHERE completed_at IS NULL
+              AND (claimed_at IS NULL OR claimed_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 minute')
+            ORDER BY priority DESC, card_id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE annotation_queue
+        SET claimed_by = %s,
+            claimed_at = CURRENT_TIMESTAMP
+        FROM next_card
+        WHERE annotation_queue.card_id = next_card.card_id
+        RETURNING annotation_queue.card_id
+        """, (claim_timeout_minutes, annotator), fetch=True)
+        commit()
+        if not rows:
+            logging.info("The annotation queue is empty.")
+            return None
+        logging.debug(f"The card {rows[0][0]} was claimed by {annotator}")
+        return rows[0][0]
+    except Exception as e:
+        rollback()
+        logging.error(f"Failed to claim the next card to annotate for {annotator}: {e}")
+        raise
+
+
+def release_card_claim(annotator, card_id):
+    """
+    Gives a card the annotator skipped back to the queue: the claim is cleared and the card goes after the pending
+    cards it was ahead of, so the annotator gets a different card next. refresh_annotation_queue restores its
+    priority.
+
+    :param annotator: username of the annotator
+    :param card_id: id of the card
+    :return: True if the annotator held the claim of the card
+    """
+    try:
+        rows = execute_query("""
+        UPDATE annotation_queue
+        SET claimed_by = NULL,
+            claimed_at = NULL,
+            priority = priority - 1
+        WHERE card_id = %s
+          AND claimed_by = %s
+          AND completed_at IS NULL
+        RETURNING card_id
+        """, (card_id, annotator), fetch=True)
+        commit()
+        if rows:
+            logging.debug(f"The card {card_id} was skipped by {annotator}")
+        return bool(rows)
+    except Exception as e:
+        rollback()
+        logging.error(f"Failed to release the card {card_id} claimed by {annotator}: {e}")
+        raise
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fills the annotation queue from the archetype scores of the cards.")
+    parser.add_argument(
+        "--log-level","-l",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        help="Set the logging level (default: INFO)."
+    )
+    parser.add_argument(
+        "--config","-c",
+        help="Path to config file.",
+        type = str,
+        required = True,
+    )
+    parser.add_argument(
+        "--strategy",
+        default=None,
+        choices=QUEUE_STRATEGIES,
+        help="uncertainty: the cards the model is least sure about first, least_annotated: the cards of the archetypes "
+             "with the fewest annotations first (default: [annotation_queue] strategy, or uncertainty)"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, level=getattr(logging, args.log_level.upper()), format='%(asctime)s %(message)s',datefmt='%m/%d/%Y %I:%M:%S %p')
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    refresh_annotation_queue(config, args.strategy or config.get("annotation_queue", "strategy", fallback="uncertainty"))
+
+
+if __name__ == "__main__":
+    main()
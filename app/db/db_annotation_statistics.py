@@ -0,0 +1,162 @@
+import argparse
+import configparser
+import logging
+import sys
+import psycopg2
+from .db_utils import execute_query
+
+# Counters of annotation_counters
+ANNOTATED_CARDS_COUNTER = "annotated_cards"
+ANNOTATION_CHANGES_COUNTER = "annotation_changes"
+
+
+# =============================
+# Create tables (runs once)
+# =============================
+def create_annotation_statistics_tables(conn):
+    """
+    Creates the counters read by the dashboard: the number of cards annotated with every archetype and the global
+    annotation counters. update_card_annotation adds the changes of every annotation to them in the same statement
+    that writes the card, so the dashboard reads a few small rows instead of counting the cards table.
+    """
+    create_tables_query = """
+    CREATE TABLE IF NOT EXISTS archetype_annotation_counts (
+        archetype TEXT PRIMARY KEY,
+        number_of_cards BIGINT NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS annotation_counters (
+        counter_name TEXT PRIMARY KEY,
+        value BIGINT NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute(create_tables_query)
+            conn.commit()
+            logging.info("Annotation statistics tables created successfully.")
+    except psycopg2.Error as e:
+        logging.error(f"Database error creating the annotation statistics tables: {e}")
+        conn.rollback()
+        raise
+
+
+# =============================
+# Backfill (offline job)
+# =============================
+def rebuild_annotation_statistics(conn):
+    """
+    Recomputes the counters from the cards table, for a database annotated before the counters existed or to check
+    them. The counter tables are locked while they are rebuilt: the annotations saved meanwhile wait for the lock and
+    add their changes on top of the rebuilt counters, so none is counted twice or lost.
+
+    The lock only holds inside a transaction, a connection in autocommit mode (e.g. the one of initialize_db) is taken
+    out of it while the counters are rebuilt.
+
+    :param conn: A psycopg2 connection object
+    """
+    autocommit = conn.autocommit
+    try:
+        if autocommit:
+            conn.autocommit = False
+        with conn.cursor() as cur:
+            cur.execute("LOCK TABLE archetype_annotation_counts, annotation_counters IN EXCLUSIVE MODE")
+            cur.execute("DELETE FROM archetype_annotation_counts")
+            cur.execute("""
+                INSERT INTO archetype_annotation_counts (archetype, number_of_cards)
+                SELECT annotated.archetype, count(*)
+                FROM cards
+                CROSS JOIN LATERAL unnest(cards.annotated_archetypes) AS annotated (archetype)
+                GROUP BY annotated.archetype
+            """)
+            cur.execute("""
+                INSERT INTO annotation_counters (counter_name, value)
+                SELECT %s, count(*) FROM cards WHERE cardinality(annotated_archetypes) > 0
+                ON CONFLICT (counter_name) DO UPDATE
+                SET value = EXCLUDED.value,
+                    updated_at = CURRENT_TIMESTAMP
+            """, (ANNOTATED_CARDS_COUNTER,))
+            # Every annotation that changes a card leaves an entry in card_history
+            cur.execute("""
+                INSERT INTO annotation_counters (counter_name, value, updated_at)
+                SELECT %s, count(*), COALESCE(max(timestamp), CURRENT_TIMESTAMP)
+                FROM card_history WHERE action = 'annotated'
+                ON CONFLICT (counter_name) DO UPDATE
+                SET value = EXCLUDED.value,
+                    updated_at = EXCLUDED.updated_at
+            """, (ANNOTATION_CHANGES_COUNTER,))
+        conn.commit()
+        logging.info("Rebuilt the annotation statistics.")
+    except psycopg2.Error as e:
+        logging.error(f"Failed to rebuild the annotation statistics: {e}")
+        conn.rollback()
+        raise
+    finally:
+        if autocommit:
+            conn.autocommit = True
+
+
+def annotation_statistics_are_empty(conn):
+    """
+    :param conn: A psycopg2 connection object
+    :return: True if the counters were never computed, e.g. the rebuild of a new database failed
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT NOT EXISTS (SELECT 1 FROM annotation_counters)")
+        return cur.fetchone()[0]
+
+
+# =============================
+# Dashboard
+# =============================
+def get_annotation_statistics():
+    """
+    Everything the dashboard shows, read from the counter tables and the catalogue size estimated by the planner, so
+    it takes the same time however many cards are annotated.
+
+    :return: dict with annotated_cards, annotation_changes, last_annotation_at, estimated_number_of_cards and
+    archetype_counts (dict archetype -> number of cards)
+    """
+    counters = {counter_name: (value, updated_at) for counter_name, value, updated_at
+                in execute_query("SELECT counter_name, value, updated_at FROM annotation_counters", fetch=True)}
+    archetype_counts = dict(execute_query("SELECT archetype, number_of_cards FROM archetype_annotation_counts",
+                                          fetch=True))
+    estimated_number_of_cards = execute_query("SELECT reltuples::bigint FROM pg_class WHERE relname = 'cards'",
+                                              fetch=True)
+    annotated_cards, _ = counters.get(ANNOTATED_CARDS_COUNTER, (0, None))
+    annotation_changes, last_annotation_at = counters.get(ANNOTATION_CHANGES_COUNTER, (0, None))
+    return {"annotated_cards": annotated_cards,
+            "annotation_changes": annotation_changes,
+            "last_annotation_at": last_annotation_at,
+            # reltuples is -1 for a table that was never analyzed
+            "estimated_number_of_cards": max(estimated_number_of_cards[0][0], 0) if estimated_number_of_cards else 0,
+            "archetype_counts": archetype_counts}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recomputes the annotation counters of the dashboard from the cards.")
+    parser.add_argument(
+        "--config","-c",
+        help="Path to config file.",
+        type = str,
+        required = True,
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s %(message)s',datefmt='%m/%d/%Y %I:%M:%S %p')
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    conn = psycopg2.connect(dbname=config["postgresql"]["database"],
+                            user=config["database_user"]["user"],
+                            password=config["database_user"]["password"],
+                            host=config["postgresql"]["host"],
+                            port=config["postgresql"]["port"])
+    try:
+        rebuild_annotation_statistics(conn)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import logging
+import psycopg2
+from .db_utils import execute_query
+from app.db.db_cards import CARD_SOURCE_COLUMNS
+
+# Generation of the cached search result pages
+SEARCH_RESULTS_GENERATION = "search_results"
+
+
+# =============================
+# Create table (runs once)
+# =============================
+def create_cache_generations_table(conn):
+    """
+    Creates the generations of the caches of the web workers whose entries depend on many rows, and the trigger that
+    bumps the generation of the search results whenever a statement inserts, deletes or changes the source columns of
+    cards. The trigger runs in the transaction of the write, so every process (web workers, API, import jobs) sees the
+    new generation as soon as the cards are committed and the cached pages of the old generation are never read again.
+
+    The annotations are not shown in the search results, writing them doesn't bump the generation.
+    Runs on every initialization, so a database created by an older version gets the trigger too.
+    """
+    create_table_query = f"""
+    CREATE TABLE IF NOT EXISTS cache_generations (
+        cache_name TEXT PRIMARY KEY,
+        generation BIGINT NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    INSERT INTO cache_generations (cache_name) VALUES ('{SEARCH_RESULTS_GENERATION}')
+    ON CONFLICT (cache_name) DO NOTHING;
+
+    CREATE OR REPLACE FUNCTION bump_search_results_generation() RETURNS trigger AS $$
+    BEGIN
+        UPDATE cache_generations
+        SET generation = generation + 1,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE cache_name = '{SEARCH_RESULTS_GENERATION}';
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS cards_search_results_generation ON cards;
+    CREATE TRIGGER cards_search_results_generation
+        AFTER INSERT OR DELETE OR TRUNCATE OR UPDATE OF {", ".join(CARD_SOURCE_COLUMNS)}, display_html ON cards
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_search_results_generation();
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute(create_table_query)
+            conn.commit()
+            logging.info("Cache generations table created successfully.")
+    except psycopg2.Error as e:
+        logging.error(f"Database error creating the cache generations table: {e}")
+        conn.rollback()
+        raise
+
+
+def get_cache_generation(cache_name):
+    """
+    :return: current generation of the cache, 0 if it has none
+    """
+    rows = execute_query("SELECT generation FROM cache_generations WHERE cache_name = %s", (cache_name,), fetch=True)
+    return rows[0][0] if rows else 0
@@ -22,7 +22,7 @@ def create_card_history_table(conn):
 
         # Create the card_history table
         cur.execute("""
-            CREATE TABLE card_history (
+            CREATE TABLE IF NOT EXISTS card_history (
                 id SERIAL PRIMARY KEY,
                 card_id INTEGER NOT NULL,
                 action TEXT NOT NULL,
@@ -32,6 +32,12 @@ def create_card_history_table(conn):
                 timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        # get_last_card_history_entries reads the last entries of a card
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS card_history_card_id_timestamp_idx
+                ON card_history (card_id, timestamp DESC)
+        """)
+        conn.commit()
 
         logging.info("Successfully created the card_history table.")
         cur.close()
@@ -1,8 +1,22 @@
+import copy
 import logging
 import pickle
 import psycopg2
+from flask import g, current_app
 from psycopg2.extras import execute_values
 from .db_utils import execute_query, bulk_insert_values, commit, rollback
+from app.classes.lru_cache import CACHE_MISS
+from app.classes.card_object import (MagicCard, render_cards_display_html, pack_archetype_vector, unpack_archetype_bits,
+                                     DISPLAY_HTML_NOT_RENDERED)
+from app.setup.parse_card_data import iter_card_batches
+from app.db.db_search import TEXT_SEARCH_CONFIGURATION
+from app.db.db_annotation_statistics import ANNOTATED_CARDS_COUNTER, ANNOTATION_CHANGES_COUNTER
+
+
+# Words of the name (weight A) and of the card text (weight B) for the full text search. PostgreSQL computes the column
+# on every insert and update of the row, so it is always up to date
+CARD_TEXT_SEARCH_EXPRESSION = (f"setweight(to_tsvector('{TEXT_SEARCH_CONFIGURATION}', coalesce(name, '')), 'A') || "
+                               f"setweight(to_tsvector('{TEXT_SEARCH_CONFIGURATION}', coalesce(card_text, '')), 'B')")
 
 
 # =============================
@@ -29,10 +43,13 @@ def create_cards_table(conn):
         predicted_archetypes TEXT[],
         annotated_archetypes TEXT[],
         gold_standard_archetypes TEXT[],
+        feature_row INTEGER,
+        archetype_bits BYTEA,
         display_html TEXT,
-        magic_card_object BYTEA
+        magic_card_object BYTEA,
+        card_text_search TSVECTOR GENERATED ALWAYS AS (CARD_TEXT_SEARCH_EXPRESSION) STORED
     );
-    """
+    """.replace("CARD_TEXT_SEARCH_EXPRESSION", CARD_TEXT_SEARCH_EXPRESSION)
 
     try:
         with conn.cursor() as cur:
@@ -46,45 +63,66 @@ def create_cards_table(conn):
         conn.close()
         raise
 
+# Columns a MagicCard is rebuilt from, in the order of get_magic_card_from_row
+CARD_DATA_COLUMNS = """
+    id, mtg_arena_id, name, color, mana_cost, converted_mana_cost, card_type, subtypes, super_types,
+    card_text, power, toughness, mcm_meta_id, card_market_link, tcg_player_link,
+    predicted_archetypes, annotated_archetypes, gold_standard_archetypes,
+    feature_row, archetype_bits, display_html
+"""
+# Columns written by the inserts, in the order of get_magic_card_row
+CARD_COLUMNS = CARD_DATA_COLUMNS + ", magic_card_object"
+# Columns that come from the source file, in the order of get_card_source_row. A new version of the source file can
+# change them (errata), the other columns are computed or written by the annotators
+CARD_SOURCE_COLUMNS = (
+    "mtg_arena_id", "name", "color", "mana_cost", "converted_mana_cost", "card_type", "subtypes", "super_types",
+    "card_text", "power", "toughness", "mcm_meta_id", "card_market_link", "tcg_player_link",
+)
+# Placeholders of the id and the CARD_SOURCE_COLUMNS of a card in a VALUES list, the casts give them the types of the
+# cards table (the source file has the ids as strings)
+CARD_SOURCE_VALUES_TEMPLATE = ("%s::integer, %s::integer, %s, %s::text[], %s, %s::integer, %s::text[], %s::text[], "
+                               "%s::text[], %s, %s::integer, %s::integer, %s::integer, %s, %s")
+
+
+def upgrade_cards_table(conn):
+    """
+    Adds the columns of the pickle-free storage to a cards table created by an older version.
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                ALTER TABLE cards
+                    ADD COLUMN IF NOT EXISTS feature_row INTEGER,
+                    ADD COLUMN IF NOT EXISTS archetype_bits BYTEA,
+                    ADD COLUMN IF NOT EXISTS card_text_search TSVECTOR
+                        GENERATED ALWAYS AS (CARD_TEXT_SEARCH_EXPRESSION) STORED;
+            """.replace("CARD_TEXT_SEARCH_EXPRESSION", CARD_TEXT_SEARCH_EXPRESSION))
+            conn.commit()
+    except psycopg2.Error as e:
+        logging.error(f"Database error upgrading the cards table: {e}")
+        conn.rollback()
+        raise
+
+
+def get_store_pickled_cards(config) -> bool:
+    """
+    The pickled MagicCard is only written to magic_card_object if [appdata] store_pickled_cards is true, by default
+    the cards are rebuilt from the typed columns.
+    """
+    return config.getboolean("appdata", "store_pickled_cards", fallback=False)
+
+
 # =============================
 # Insert a single card
 # =============================
 def insert_magic_card(card):
     try:
-        serialized_card = pickle.dumps(card)
-
-        query = """
-        INSERT INTO cards (
-            id, mtg_arena_id, name, color, mana_cost, converted_mana_cost, card_type, subtypes, super_types,
-            card_text, power, toughness, mcm_meta_id, card_market_link, tcg_player_link,
-            predicted_archetypes, annotated_archetypes, gold_standard_archetypes,
-            display_html, magic_card_object
-        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        query = f"""
+        INSERT INTO cards ({CARD_COLUMNS})
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
         ON CONFLICT (id) DO NOTHING;
         """
-
-        params = (
-            card.id,
-            getattr(card, "mtg_arena_id", 0),
-            card.name,
-            card.color,
-            card.mana_cost,
-            card.converted_mana_cost,
-            card.card_type,
-            card.subtypes,
-            card.super_types,
-            card.card_text,
-            card.power,
-            card.toughness,
-            card.mcm_meta_id,
-            card.card_market_link,
-            card.tcg_player_link,
-            card.predicted_archetypes,
-            card.annotated_archetypes,
-            card.gold_standard_archetypes,
-            card.display_html,
-            serialized_card
-        )
+        params = get_magic_card_row(card, current_app.config.get("STORE_PICKLED_CARDS", False))
 
         execute_query(query, params)
         commit()
@@ -93,17 +131,65 @@ def insert_magic_card(card):
         rollback()
         logging.error(f"Failed to insert card {card.name}: {e}")
         raise
+    finally:
+        invalidate_cached_card(card.id)
 
 # =============================
 # Bulk insert (fast)
 # =============================
 
-def insert_magic_cards_bulk(config, cards):
+INSERT_BULK_BATCH_SIZE = 1000
+
+
+def get_magic_card_row(card, store_pickled_card=False):
+    """
+    Converts a MagicCard into the tuple of values of a row of the cards table, in the order of CARD_COLUMNS.
+
+    :param store_pickled_card: if False magic_card_object is NULL, the card is rebuilt from the other columns
     """
-    Insert a list of MagicCard objects into the database in bulk.
+    display_html = card.get_display_html()
+    # Rendered before pickling so the stored object carries its display_html too
+    serialized_card = pickle.dumps(card) if store_pickled_card else None
+    return (
+        card.id,
+        getattr(card, "mtg_arena_id", 0),
+        card.name,
+        card.color,
+        card.mana_cost,
+        card.converted_mana_cost,
+        card.card_type,
+        card.subtypes,
+        card.super_types,
+        card.card_text,
+        card.power,
+        card.toughness,
+        card.mcm_meta_id,
+        card.card_market_link,
+        card.tcg_player_link,
+        card.predicted_archetypes,
+        card.annotated_archetypes,
+        card.gold_standard_archetypes,
+        card.feature_row,
+        pack_archetype_vector(card.vector_output),
+        display_html,
+        serialized_card
+    )
+
+
+def insert_magic_cards_bulk(config, cards, batch_size=INSERT_BULK_BATCH_SIZE):
+    """
+    Insert MagicCard objects into the database in bulk.
     Opens and closes its own connection (used for initialization).
+
+    The cards can be a list or any iterable (e.g. the generator returned by vectorize_card_stream), they are
+    serialized and sent to the database batch by batch, so only batch_size rows are kept in memory at a time.
+    Everything is committed in one transaction at the end.
+
+    The cards already in the table are not overwritten, only their feature_row is set to the one of the loaded card:
+    a full import without hard reset builds the feature matrix again from the first row.
     """
     conn = None
+    number_of_cards_inserted = 0
     try:
         dbname = config["postgresql"]["database"]
         host = config["postgresql"]["host"]
@@ -115,46 +201,24 @@ def insert_magic_cards_bulk(config, cards):
                               password=password,
                               host=host,
                               port=port)
+        store_pickled_cards = get_store_pickled_cards(config)
         with conn.cursor() as cur:
-            rows = []
-            for card in cards:
-                serialized_card = pickle.dumps(card)
-                rows.append((
-                    card.id,
-                    getattr(card, "mtg_arena_id", 0),
-                    card.name,
-                    card.color,
-                    card.mana_cost,
-                    card.converted_mana_cost,
-                    card.card_type,
-                    card.subtypes,
-                    card.super_types,
-                    card.card_text,
-                    card.power,
-                    card.toughness,
-                    card.mcm_meta_id,
-                    card.card_market_link,
-                    card.tcg_player_link,
-                    card.predicted_archetypes,
-                    card.annotated_archetypes,
-                    card.gold_standard_archetypes,
-                    card.display_html,
-                    serialized_card
-                ))
-
-            insert_sql = """
-            INSERT INTO cards (
-                id, mtg_arena_id, name, color, mana_cost, converted_mana_cost, card_type, subtypes, super_types,
-                card_text, power, toughness, mcm_meta_id, card_market_link, tcg_player_link,
-                predicted_archetypes, annotated_archetypes, gold_standard_archetypes,
-                display_html, magic_card_object
-            ) VALUES %s
-            ON CONFLICT (id) DO NOTHING;
+            # A card already in the table keeps its data but takes the row of the feature matrix that was just built
+            insert_sql = f"""
+            INSERT INTO cards ({CARD_COLUMNS}) VALUES %s
+            ON CONFLICT (id) DO UPDATE SET feature_row = EXCLUDED.feature_row
+            WHERE cards.feature_row IS DISTINCT FROM EXCLUDED.feature_row;
             """
 
-            execute_values(cur, insert_sql, rows)
+            for card_batch in iter_card_batches(cards, batch_size):
+                # All the cards of the batch are rendered with the same compiled template
+                render_cards_display_html(card_batch)
+                rows = [get_magic_card_row(card, store_pickled_cards) for card in card_batch]
+                execute_values(cur, insert_sql, rows, page_size=batch_size)
+                number_of_cards_inserted += len(rows)
+                logging.debug(f"Sent {number_of_cards_inserted} cards to the database.")
         conn.commit()
-        logging.info(f"Successfully inserted {len(cards)} cards in bulk.")
+        logging.info(f"Successfully inserted {number_of_cards_inserted} cards in bulk.")
     except Exception as e:
         logging.error(f"Bulk insert failed: {e}")
         if conn:
@@ -162,24 +226,289 @@ def insert_magic_cards_bulk(config, cards):
                 conn.rollback()
             except Exception:
                 logging.error("Rollback failed.")
+        raise
+    finally:
+        if conn:
+            try:
+                conn.close()
+            except Exception:
+                logging.error("Failed to close connection.")
+
+
+def get_card_source_row(card):
+    """
+    Values of the CARD_SOURCE_COLUMNS of a MagicCard, in the same order.
+    """
+    return (
+        getattr(card, "mtg_arena_id", 0),
+        card.name,
+        card.color,
+        card.mana_cost,
+        card.converted_mana_cost,
+        card.card_type,
+        card.subtypes,
+        card.super_types,
+        card.card_text,
+        card.power,
+        card.toughness,
+        card.mcm_meta_id,
+        card.card_market_link,
+        card.tcg_player_link,
+    )
+
+
+def get_loaded_card_changes(config, cards, batch_size=INSERT_BULK_BATCH_SIZE):
+    """
+    Compares cards with the ones already in the cards table, the values of the source columns are converted to the
+    types of the table by the database, as the updates would write them.
+    Opens and closes its own connection (used by the incremental import).
+
+    :param config: configparser object
+    :param cards: list of MagicCard
+    :return: (set of the ids of the cards already loaded, set of the ids of the ones whose source columns changed)
+    """
+    source_columns = ", ".join(CARD_SOURCE_COLUMNS)
+    compare_sql = f"""
+    SELECT data.id, ({", ".join(f"cards.{column}" for column in CARD_SOURCE_COLUMNS)})
+           IS DISTINCT FROM ({", ".join(f"data.{column}" for column in CARD_SOURCE_COLUMNS)})
+    FROM (VALUES %s) AS data (id, {source_columns})
+    JOIN cards ON cards.id = data.id
+    """
+    loaded_card_ids = set()
+    changed_card_ids = set()
+    conn = psycopg2.connect(dbname=config["postgresql"]["database"],
+                            user=config["database_user"]["user"],
+                            password=config["database_user"]["password"],
+                            host=config["postgresql"]["host"],
+                            port=config["postgresql"]["port"])
+    try:
+        with conn.cursor() as cur:
+            for card_batch in iter_card_batches(cards, batch_size):
+                rows = execute_values(cur, compare_sql, [(card.id,) + get_card_source_row(card) for card in card_batch],
+                                      template=f"({CARD_SOURCE_VALUES_TEMPLATE})", page_size=batch_size, fetch=True)
+                for card_id, changed in rows:
+                    loaded_card_ids.add(card_id)
+                    if changed:
+                        changed_card_ids.add(card_id)
+        return loaded_card_ids, changed_card_ids
+    finally:
+        conn.close()
+
+
+def update_magic_cards_source_data_bulk(config, cards, batch_size=INSERT_BULK_BATCH_SIZE):
+    """
+    Writes the CARD_SOURCE_COLUMNS, the feature row and the display_html of cards already in the database (e.g. the
+    errata of a new version of the source file), one UPDATE ... FROM (VALUES ...) statement per batch, everything in
+    one transaction. The annotations and the predictions of the cards are kept.
+    Opens and closes its own connection (used by the incremental import).
+
+    :param config: configparser object
+    :param cards: iterable of vectorized MagicCard
+    :param batch_size: number of cards updated per statement
+    :return: number of cards updated
+    """
+    conn = None
+    number_of_cards_updated = 0
+    try:
+        dbname = config["postgresql"]["database"]
+        host = config["postgresql"]["host"]
+        port = config["postgresql"]["port"]
+        user = config["database_user"]["user"]
+        password = config["database_user"]["password"]
+        conn = psycopg2.connect(dbname=dbname,
+                              user=user,
+                              password=password,
+                              host=host,
+                              port=port)
+        columns = CARD_SOURCE_COLUMNS + ("feature_row", "display_html")
+        update_sql = f"""
+        UPDATE cards
+        SET {", ".join(f"{column} = data.{column}" for column in columns)}
+        FROM (VALUES %s) AS data (id, {", ".join(columns)})
+        WHERE cards.id = data.id;
+        """
+        template = f"({CARD_SOURCE_VALUES_TEMPLATE}, %s::integer, %s)"
+        with conn.cursor() as cur:
+            for card_batch in iter_card_batches(cards, batch_size):
+                render_cards_display_html(card_batch)
+                rows = [(card.id,) + get_card_source_row(card) + (card.feature_row, card.display_html)
+                        for card in card_batch]
+                execute_values(cur, update_sql, rows, template=template, page_size=batch_size)
+                number_of_cards_updated += len(rows)
+        conn.commit()
+        logging.info(f"Successfully updated the source data of {number_of_cards_updated} cards.")
+    except Exception as e:
+        logging.error(f"Bulk update of the source data of the cards failed: {e}")
+        if conn:
+            try:
+                conn.rollback()
+            except Exception:
+                logging.error("Rollback failed.")
+        raise
     finally:
         if conn:
             try:
                 conn.close()
             except Exception:
                 logging.error("Failed to close connection.")
+    return number_of_cards_updated
+
+
+def update_predicted_archetypes_bulk(config, predictions, batch_size=INSERT_BULK_BATCH_SIZE):
+    """
+    Writes the predicted archetypes of many cards, one UPDATE ... FROM (VALUES ...) statement per batch.
+    Opens and closes its own connection (used by the scoring job).
+
+    :param config: configparser object
+    :param predictions: iterable of (card_id, list of archetypes)
+    :param batch_size: number of cards updated per statement
+    :return: number of cards updated
+    """
+    conn = None
+    number_of_cards_updated = 0
+    try:
+        dbname = config["postgresql"]["database"]
+        host = config["postgresql"]["host"]
+        port = config["postgresql"]["port"]
+        user = config["database_user"]["user"]
+        password = config["database_user"]["password"]
+        conn = psycopg2.connect(dbname=dbname,
+                              user=user,
+                              password=password,
+                              host=host,
+                              port=port)
+        with conn.cursor() as cur:
+            update_sql = """
+            UPDATE cards
+            SET predicted_archetypes = data.predicted_archetypes
+            FROM (VALUES %s) AS data (id, predicted_archetypes)
+            WHERE cards.id = data.id;
+            """
+            for prediction_batch in iter_card_batches(predictions, batch_size):
+                execute_values(cur, update_sql, prediction_batch, template="(%s, %s::text[])", page_size=batch_size)
+                number_of_cards_updated += len(prediction_batch)
+        conn.commit()
+        logging.info(f"Successfully updated the predicted archetypes of {number_of_cards_updated} cards.")
+    except Exception as e:
+        logging.error(f"Bulk update of the predicted archetypes failed: {e}")
+        number_of_cards_updated = 0
+        if conn:
+            try:
+                conn.rollback()
+            except Exception:
+                logging.error("Rollback failed.")
+    finally:
+        if conn:
+            try:
+                conn.close()
+            except Exception:
+                logging.error("Failed to close connection.")
+    return number_of_cards_updated
 
 
 # =============================
 # Retrieve a single card by ID
 # =============================
+def get_magic_card_from_row(row, archetype_labels):
+    """
+    Rebuilds a MagicCard from the typed columns of its row, without unpickling anything.
+
+    :param row: the columns selected by get_magic_card, without magic_card_object
+    :param archetype_labels: labels of the output vector, the archetype_bits are unpacked in this order
+    """
+    (card_id, mtg_arena_id, name, color, mana_cost, converted_mana_cost, card_type, subtypes, super_types,
+     card_text, power, toughness, mcm_meta_id, card_market_link, tcg_player_link,
+     predicted_archetypes, annotated_archetypes, gold_standard_archetypes,
+     feature_row, archetype_bits, display_html) = row
+    card = MagicCard.create(
+        render_html=False,
+        id=card_id,
+        converted_mana_cost=converted_mana_cost,
+        mtg_arena_id=mtg_arena_id,
+        name=name,
+        color=color or [],
+        mana_cost=mana_cost,
+        card_type=card_type or [],
+        subtypes=subtypes or [],
+        super_types=super_types or [],
+        card_text=card_text,
+        power=power,
+        toughness=toughness,
+        mcm_meta_id=mcm_meta_id,
+        card_market_link=card_market_link,
+        tcg_player_link=tcg_player_link,
+        predicted_archetypes=predicted_archetypes or [],
+        annotated_archetypes=annotated_archetypes or [],
+        gold_standard_archetypes=gold_standard_archetypes or [],
+        display_html=display_html or DISPLAY_HTML_NOT_RENDERED,
+    )
+    vector_output = unpack_archetype_bits(archetype_bits or b"", len(archetype_labels))
+    card.update_vectors(feature_row, dict(zip(archetype_labels, vector_output)))
+    return card
+
+
+def invalidate_cached_card(card_id):
+    """
+    Removes a card from the caches of the web worker that wrote it. The other processes see that the version of the
+    card changed (see get_card_version), and the cached search pages of every process are dropped by the generation
+    bumped by the cards_search_results_generation trigger.
+    """
+    for cache_name in ("CARD_CACHE", "ANNOTATE_VIEW_CACHE"):
+        cache = current_app.config.get(cache_name)
+        if cache is not None:
+            cache.invalidate(card_id)
+    g.get("card_versions", {}).pop(card_id, None)
+
+
+def get_card_version(card_id):
+    """
+    Version of the row of a card: its xmin, the transaction that wrote it last. It changes whenever the card is
+    written, by any process, so the caches store it with the card and compare it with the current one (a primary key
+    lookup) before returning a cached entry.
+
+    The version is read at most once per request: the annotate view and the card it shows are checked with the same
+    lookup.
+
+    :return: the version, None if the card doesn't exist
+    """
+    card_versions = g.setdefault("card_versions", {})
+    if card_id not in card_versions:
+        rows = execute_query("SELECT xmin::text FROM cards WHERE id = %s", (card_id,), fetch=True)
+        card_versions[card_id] = rows[0][0] if rows else None
+    return card_versions[card_id]
+
+
 def get_magic_card(card_id):
+    card_cache = current_app.config.get("CARD_CACHE")
+    if card_cache is not None:
+        cached_entry = card_cache.get(card_id)
+        if cached_entry is not CACHE_MISS:
+            version, card = cached_entry
+            if get_card_version(card_id) == version:
+                # A copy, so the cached card is not changed by the caller (annotate_card changes the card it receives)
+                return copy.copy(card)
+            # Written by another process since it was cached
+            card_cache.invalidate(card_id)
     try:
-        query = "SELECT magic_card_object FROM cards WHERE id = %s"
+        # The pickle is only transferred for the rows stored before the typed columns existed
+        query = f"""
+        SELECT {CARD_DATA_COLUMNS},
+               CASE WHEN archetype_bits IS NULL THEN magic_card_object END,
+               xmin::text
+        FROM cards WHERE id = %s
+        """
         rows = execute_query(query, (card_id,), fetch=True)
-        if rows and rows[0][0]:
-            return pickle.loads(rows[0][0])
-        return None
+        if not rows:
+            return None
+        row = rows[0]
+        if row[-2]:
+            card = pickle.loads(row[-2])
+        else:
+            card = get_magic_card_from_row(row[:-2], current_app.config["ARCHETYPE_LABELS"])
+        g.setdefault("card_versions", {})[card_id] = row[-1]
+        if card_cache is not None:
+            card_cache.set(card_id, (row[-1], copy.copy(card)))
+        return card
     except Exception as e:
         logging.error(f"Failed to retrieve card {card_id}: {e}")
         return "<div><p>Query Failed</p></div>"
@@ -230,7 +559,7 @@ def search_cards_by_name(partial_name):
 # =============================
 def update_magic_card(card):
     try:
-        serialized_card = pickle.dumps(card)
+        serialized_card = pickle.dumps(card) if current_app.config.get("STORE_PICKLED_CARDS", False) else None
         query = """
         UPDATE cards
         SET mtg_arena_id = %s,
@@ -250,6 +579,8 @@ def update_magic_card(card):
             predicted_archetypes = %s,
             annotated_archetypes = %s,
             gold_standard_archetypes = %s,
+            feature_row = %s,
+            archetype_bits = %s,
             display_html = %s,
             magic_card_object = %s
         WHERE id = %s
@@ -272,6 +603,8 @@ def update_magic_card(card):
             card.predicted_archetypes,
             card.annotated_archetypes,
             card.gold_standard_archetypes,
+            card.feature_row,
+            pack_archetype_vector(card.vector_output),
             card.display_html,
             serialized_card,
             card.id
@@ -283,6 +616,94 @@ def update_magic_card(card):
         rollback()
         logging.error(f"Failed to update card {card.name}: {e}")
         raise
+    finally:
+        invalidate_cached_card(card.id)
+
+
+# Writes the annotation of a card and everything that depends on it, see update_card_annotation.
+# Parameters: card id, annotated archetypes, archetype bits, ANNOTATION_CHANGES_COUNTER, ANNOTATED_CARDS_COUNTER
+UPDATE_CARD_ANNOTATION_QUERY = """
+    WITH previous AS (
+        SELECT id, annotated_archetypes FROM cards WHERE id = %s FOR UPDATE
+    ), updated AS (
+        UPDATE cards
+        SET annotated_archetypes = %s,
+            archetype_bits = %s
+        FROM previous
+        WHERE cards.id = previous.id
+        RETURNING cards.id, previous.annotated_archetypes AS previous_value, cards.annotated_archetypes AS new_value
+    ), changed AS (
+        SELECT * FROM updated WHERE previous_value IS DISTINCT FROM new_value
+    ), history AS (
+        INSERT INTO card_history (card_id, action, attribute_that_changed, previous_value, new_value)
+        SELECT id, 'annotated', 'annotated_archetypes',
+               array_to_string(previous_value, ','), array_to_string(new_value, ',')
+        FROM changed
+    ), archetype_count_changes AS (
+        INSERT INTO archetype_annotation_counts (archetype, number_of_cards)
+        SELECT archetype, sum(difference)
+        FROM (
+            SELECT unnest(new_value) AS archetype, 1 AS difference FROM changed
+            UNION ALL
+            SELECT unnest(previous_value), -1 FROM changed
+        ) AS differences
+        GROUP BY archetype
+        HAVING sum(difference) <> 0
+        ON CONFLICT (archetype) DO UPDATE
+        SET number_of_cards = archetype_annotation_counts.number_of_cards + EXCLUDED.number_of_cards,
+            updated_at = CURRENT_TIMESTAMP
+    ), counter_changes AS (
+        INSERT INTO annotation_counters (counter_name, value)
+        SELECT %s::text, 1 FROM changed
+        UNION ALL
+        SELECT %s::text, (COALESCE(cardinality(new_value), 0) > 0)::int - (COALESCE(cardinality(previous_value), 0) > 0)::int
+        FROM changed
+        ON CONFLICT (counter_name) DO UPDATE
+        SET value = annotation_counters.value + EXCLUDED.value,
+            updated_at = CURRENT_TIMESTAMP
+    ), dequeued AS (
+        UPDATE annotation_queue
+        SET completed_at = CURRENT_TIMESTAMP
+        FROM updated
+        WHERE annotation_queue.card_id = updated.id
+          AND annotation_queue.completed_at IS NULL
+    )
+    SELECT count(*) FROM updated
+"""
+
+
+# =============================
+# Update the annotation of a card
+# =============================
+def update_card_annotation(card_id, annotated_archetypes, archetype_bits):
+    """
+    Writes only the annotated archetypes and the packed output vector of a card, records the change in card_history,
+    adds it to the annotation counters of the dashboard and marks the card as done in the annotation queue, in one
+    statement (so in one transaction).
+    Nothing is added to card_history or to the counters if the annotated archetypes didn't change.
+
+    :param card_id: id of the card
+    :param annotated_archetypes: list of archetype names
+    :param archetype_bits: output vector packed with pack_archetype_vector
+    :return: True if the card exists and was updated
+    """
+    try:
+        rows = execute_query(UPDATE_CARD_ANNOTATION_QUERY, (card_id, annotated_archetypes, archetype_bits,
+                                                            ANNOTATION_CHANGES_COUNTER, ANNOTATED_CARDS_COUNTER),
+                             fetch=True)
+        commit()
+        card_updated = rows[0][0] > 0
+        if card_updated:
+            logging.info(f"Updated the annotation of the card {card_id}")
+        else:
+            logging.warning(f"Tried to annotate the card {card_id}, but it doesn't exist")
+        return card_updated
+    except Exception as e:
+        rollback()
+        logging.error(f"Failed to update the annotation of the card {card_id}: {e}")
+        raise
+    finally:
+        invalidate_cached_card(card_id)
 
 # =============================
 # Delete a card by ID
@@ -297,3 +718,5 @@ def delete_magic_card(card_id):
         rollback()
         logging.error(f"Failed to delete card {card_id}: {e}")
         raise
+    finally:
+        invalidate_cached_card(card_id)
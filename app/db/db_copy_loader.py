@@ -0,0 +1,218 @@
+import io
+import logging
+import time
+from itertools import islice
+import psycopg2
+from app.classes.card_object import render_cards_display_html
+from app.db.db_cards import CARD_COLUMNS, get_magic_card_row, get_store_pickled_cards
+from app.setup.parse_card_data import iter_card_batches
+
+COPY_BATCH_SIZE = 5000
+DEFAULT_LOAD_NAME = "catalogue"
+
+
+# =============================
+# Create table (runs once)
+# =============================
+def create_card_load_checkpoints_table(conn):
+    """
+    Creates the table with the progress of the card loads, one row per load name. A load that fails can be resumed
+    after the last batch committed.
+    """
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS card_load_checkpoints (
+        load_name TEXT PRIMARY KEY,
+        cards_loaded BIGINT NOT NULL DEFAULT 0,
+        last_card_id INTEGER,
+        completed BOOLEAN NOT NULL DEFAULT FALSE,
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute(create_table_query)
+            conn.commit()
+            logging.info("Card load checkpoints table created successfully.")
+    except psycopg2.Error as e:
+        logging.error(f"Database error creating the card load checkpoints table: {e}")
+        conn.rollback()
+        raise
+
+
+def get_cards_loaded(cur, load_name):
+    """
+    :return: (number of cards, id of the last card) committed by a previous run of the load that didn't complete,
+    (0, None) otherwise
+    """
+    cur.execute("SELECT cards_loaded, last_card_id, completed FROM card_load_checkpoints WHERE load_name = %s",
+                (load_name,))
+    row = cur.fetchone()
+    if row is None or row[2]:
+        return 0, None
+    return row[0], row[1]
+
+
+def skip_loaded_cards(cards, cards_already_loaded, last_card_id):
+    """
+    Skips the cards committed by a previous run of the load. The last card skipped has to be the last card of the
+    checkpoint, otherwise the cards don't come in the same order as in the previous run (e.g. the source file
+    changed) and skipping them by position would leave cards out.
+
+    :raise ValueError: if the last card skipped is not the last card of the checkpoint
+    :return: iterator over the cards that were not loaded yet
+    """
+    cards = iter(cards)
+    number_of_cards_skipped = 0
+    last_card_skipped = None
+    for last_card_skipped in islice(cards, cards_already_loaded):
+        number_of_cards_skipped += 1
+    if number_of_cards_skipped < cards_already_loaded:
+        raise ValueError(f"Can't resume the load: the checkpoint has {cards_already_loaded} cards but there are only "
+                         f"{number_of_cards_skipped}. Run the load without resuming it.")
+    # The source file has the ids as strings, the checkpoint as integers
+    if last_card_skipped is not None and int(last_card_skipped.id) != last_card_id:
+        raise ValueError(f"Can't resume the load: card {cards_already_loaded} is {last_card_skipped.id} but the "
+                         f"checkpoint ends with the card {last_card_id}. Load the cards in the same order, or run "
+                         f"the load without resuming it.")
+    return cards
+
+
+def save_checkpoint(cur, load_name, cards_loaded, last_card_id, completed=False):
+    cur.execute("""
+        INSERT INTO card_load_checkpoints (load_name, cards_loaded, last_card_id, completed)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (load_name) DO UPDATE
+        SET cards_loaded = EXCLUDED.cards_loaded,
+            last_card_id = EXCLUDED.last_card_id,
+            completed = EXCLUDED.completed,
+            updated_at = CURRENT_TIMESTAMP
+    """, (load_name, cards_loaded, last_card_id, completed))
+
+
+# =============================
+# COPY text format
+# =============================
+def escape_copy_text(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def format_array_literal(values) -> str:
+    elements = []
+    for value in values:
+        if value is None:
+            elements.append("NULL")
+        else:
+            elements.append('"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"')
+    return "{" + ",".join(elements) + "}"
+
+
+def format_copy_value(value) -> str:
+    """
+    A value of a row in the text format of COPY: tab separated columns, \\N for NULL.
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return escape_copy_text("\\x" + bytes(value).hex())
+    if isinstance(value, (list, tuple)):
+        return escape_copy_text(format_array_literal(value))
+    return escape_copy_text(str(value))
+
+
+def write_copy_rows(buffer, rows) -> None:
+    for row in rows:
+        buffer.write("\t".join(format_copy_value(value) for value in row))
+        buffer.write("\n")
+
+
+# =============================
+# COPY loader
+# =============================
+def copy_magic_cards_bulk(config, cards, batch_size=COPY_BATCH_SIZE, load_name=DEFAULT_LOAD_NAME, resume=True):
+    """
+    Loads MagicCard objects with COPY ... FROM STDIN, batch by batch. Every batch is copied into a temporary staging
+    table and moved to the cards table, then it is committed together with the checkpoint of the load. The cards
+    already in the table are not overwritten, only their feature_row is set to the one of the loaded card: a full
+    import without hard reset builds the feature matrix again from the first row.
+
+    If a previous run of the same load failed, the cards it committed are skipped (the cards have to come in the same
+    order, as they do from the source file), so a failure only loses the batch that was being loaded. The load fails
+    if the last card skipped is not the last card of the checkpoint.
+
+    :param config: configparser object
+    :param cards: iterable of MagicCard (e.g. the generator returned by vectorize_card_stream)
+    :param batch_size: number of cards per COPY and per commit
+    :param load_name: name of the checkpoint of the load
+    :param resume: if False the cards committed by a previous run are not skipped, for callers that already leave out
+    the cards in the database
+    :return: number of cards sent to the database in this run
+    """
+    conn = None
+    number_of_cards_copied = 0
+    try:
+        dbname = config["postgresql"]["database"]
+        host = config["postgresql"]["host"]
+        port = config["postgresql"]["port"]
+        user = config["database_user"]["user"]
+        password = config["database_user"]["password"]
+        conn = psycopg2.connect(dbname=dbname,
+                              user=user,
+                              password=password,
+                              host=host,
+                              port=port)
+        store_pickled_cards = get_store_pickled_cards(config)
+        with conn.cursor() as cur:
+            cards_already_loaded, last_card_id = get_cards_loaded(cur, load_name) if resume else (0, None)
+            if cards_already_loaded:
+                logging.info(f"Resuming the load {load_name} after the {cards_already_loaded} cards already loaded "
+                             f"(last card {last_card_id}).")
+                cards = skip_loaded_cards(cards, cards_already_loaded, last_card_id)
+            # The staging table is emptied by every commit
+            cur.execute(f"""
+                CREATE TEMP TABLE cards_staging ON COMMIT DELETE ROWS AS
+                SELECT {CARD_COLUMNS} FROM cards WITH NO DATA
+            """)
+            conn.commit()
+
+            start_time = time.perf_counter()
+            for card_batch in iter_card_batches(cards, batch_size):
+                batch_start_time = time.perf_counter()
+                render_cards_display_html(card_batch)
+                buffer = io.StringIO()
+                write_copy_rows(buffer, (get_magic_card_row(card, store_pickled_cards) for card in card_batch))
+                buffer.seek(0)
+                cur.copy_expert(f"COPY cards_staging ({CARD_COLUMNS}) FROM STDIN", buffer)
+                cur.execute(f"""
+                    INSERT INTO cards ({CARD_COLUMNS})
+                    SELECT {CARD_COLUMNS} FROM cards_staging
+                    ON CONFLICT (id) DO UPDATE SET feature_row = EXCLUDED.feature_row
+                    WHERE cards.feature_row IS DISTINCT FROM EXCLUDED.feature_row
+                """)
+                number_of_cards_copied += len(card_batch)
+                last_card_id = card_batch[-1].id
+                save_checkpoint(cur, load_name, cards_already_loaded + number_of_cards_copied, last_card_id)
+                conn.commit()
+                batch_time = time.perf_counter() - batch_start_time
+                logging.debug(f"Loaded {len(card_batch)} cards in {batch_time:.2f} seconds "
+                              f"({len(card_batch) / max(batch_time, 1e-9):.0f} rows per second).")
+
+            save_checkpoint(cur, load_name, cards_already_loaded + number_of_cards_copied, last_card_id, completed=True)
+            conn.commit()
+            elapsed_time = time.perf_counter() - start_time
+        logging.info(f"Successfully loaded {number_of_cards_copied} cards with COPY in {elapsed_time:.2f} seconds "
+                     f"({number_of_cards_copied / max(elapsed_time, 1e-9):.0f} rows per second).")
+    except Exception as e:
+        logging.error(f"COPY load failed after {number_of_cards_copied} cards, run it again to resume it: {e}")
+        if conn:
+            try:
+                conn.rollback()
+            except Exception:
+                logging.error("Rollback failed.")
+        raise
+    finally:
+        if conn:
+            try:
+                conn.close()
+            except Exception:
+                logging.error("Failed to close connection.")
+    return number_of_cards_copied
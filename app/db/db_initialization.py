@@ -5,8 +5,17 @@ import psycopg2
 from psycopg2 import sql
 import json
 import psycopg2.pool
-from app.db.db_cards import create_cards_table
+from app.db.db_cards import create_cards_table, upgrade_cards_table
 from app.db.db_users import create_users_table
+from app.db.db_predictions import create_card_predictions_table
+from app.db.db_card_history import create_card_history_table
+from app.db.db_search import create_cards_search_indexes
+from app.db.db_copy_loader import create_card_load_checkpoints_table
+from app.db.db_set_manifest import create_card_set_manifest_table
+from app.db.db_annotation_queue import create_annotation_queue_table
+from app.db.db_annotation_statistics import (create_annotation_statistics_tables, rebuild_annotation_statistics,
+                                             annotation_statistics_are_empty)
+from app.db.db_cache_generations import create_cache_generations_table
 
 
 
@@ -22,11 +31,38 @@ def initialize_db(config,hard_reset):
     connection.close()
     connection = connect_to_db_with_user(config)
     if hard_reset:
+        drop_table(connection, "annotation_queue")
+        drop_table(connection, "archetype_annotation_counts")
+        drop_table(connection, "annotation_counters")
+        drop_table(connection, "card_predictions")
+        drop_table(connection, "card_history")
+        drop_table(connection, "card_load_checkpoints")
+        drop_table(connection, "card_set_manifest")
+        drop_table(connection, "cache_generations")
         drop_table(connection, "cards")
         drop_table(connection, "users")
     if not table_exists(connection, "cards"):
         create_cards_table(connection)
+    else:
+        upgrade_cards_table(connection)
+    create_cards_search_indexes(connection)
+    create_cache_generations_table(connection)
     check_table_entries_number(connection, "cards")
+    if not table_exists(connection, "card_predictions"):
+        create_card_predictions_table(connection)
+    if not table_exists(connection, "card_history"):
+        create_card_history_table(connection)
+    if not table_exists(connection, "card_load_checkpoints"):
+        create_card_load_checkpoints_table(connection)
+    if not table_exists(connection, "card_set_manifest"):
+        create_card_set_manifest_table(connection)
+    if not table_exists(connection, "annotation_queue"):
+        create_annotation_queue_table(connection)
+    if not table_exists(connection, "annotation_counters"):
+        create_annotation_statistics_tables(connection)
+    if annotation_statistics_are_empty(connection):
+        # The cards annotated before the counters existed
+        rebuild_annotation_statistics(connection)
     if not table_exists(connection, "users"):
         create_users_table(connection)
     connection.close()
@@ -124,7 +160,7 @@ def connect_to_db_with_user(config):
 
 def get_conn():
     # Create a connection pool
-    connection_pool = psycopg2.pool.SimpleConnectionPool(
+    connection_pool = psycopg2.pool.ThreadedConnectionPool(
         minconn=1,
         maxconn=10,
         host="your_host",
@@ -0,0 +1,205 @@
+import logging
+import threading
+import time
+from collections import deque
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+
+DEFAULT_POOL_MIN_CONNECTIONS = 1
+DEFAULT_POOL_MAX_CONNECTIONS = 10
+DEFAULT_CHECKOUT_TIMEOUT_SECONDS = 5.0
+# A connection idle for longer than this is checked with a query before it is handed out
+DEFAULT_VALIDATION_INTERVAL_SECONDS = 30.0
+
+
+class PoolTimeoutError(PoolError):
+    """
+    No connection was returned to the pool before the checkout timeout.
+    """
+
+
+class BoundedConnectionPool:
+    """
+    Pool of PostgreSQL connections shared by the threads of a web worker. It opens up to max_connections connections;
+    when all of them are checked out, getconn waits until one is returned, for at most checkout_timeout_seconds.
+
+    Connections are validated on checkout: closed ones are discarded, and the ones idle for more than
+    validation_interval_seconds are tested with SELECT 1 and replaced if the server dropped them.
+
+    stats() returns the gauges and counters needed to size the pool: connections in use and idle, threads waiting,
+    timeouts and the time spent waiting for a connection.
+    """
+
+    def __init__(self, min_connections=DEFAULT_POOL_MIN_CONNECTIONS, max_connections=DEFAULT_POOL_MAX_CONNECTIONS,
+                 checkout_timeout_seconds=DEFAULT_CHECKOUT_TIMEOUT_SECONDS,
+                 validation_interval_seconds=DEFAULT_VALIDATION_INTERVAL_SECONDS, **connection_parameters):
+        if max_connections < 1 or min_connections < 0 or min_connections > max_connections:
+            raise ValueError("The pool needs 0 <= min_connections <= max_connections and max_connections >= 1.")
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.checkout_timeout_seconds = checkout_timeout_seconds
+        self.validation_interval_seconds = validation_interval_seconds
+        self._connection_parameters = connection_parameters
+        # (time it was returned, connection), the most recently returned last
+        self._idle = deque()
+        self._in_use = set()
+        # Connections being opened count against max_connections too
+        self._opening = 0
+        self._condition = threading.Condition(threading.Lock())
+        self._closed = False
+        self.threads_waiting = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.connections_opened = 0
+        self.connections_discarded = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        for _ in range(min_connections):
+            self._idle.append((time.monotonic(), psycopg2.connect(**self._connection_parameters)))
+            self.connections_opened += 1
+
+    def _number_of_connections(self):
+        return len(self._idle) + len(self._in_use) + self._opening
+
+    def _is_usable(self, connection, idle_since) -> bool:
+        if connection.closed:
+            return False
+        if time.monotonic() - idle_since < self.validation_interval_seconds:
+            return True
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SELECT 1")
+            connection.rollback()
+            return True
+        except psycopg2.Error as e:
+            logging.warning(f"Discarding a pooled connection that failed the validation query: {e}")
+            return False
+
+    def _discard(self, connection):
+        self.connections_discarded += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def getconn(self, timeout=None):
+        """
+        Checks out a connection, waiting for one to be returned if all of them are in use.
+
+        :param timeout: seconds to wait, checkout_timeout_seconds if None
+        :raise PoolTimeoutError: if no connection was available before the timeout
+        """
+        timeout = self.checkout_timeout_seconds if timeout is None else timeout
+        start_time = time.monotonic()
+        deadline = start_time + timeout
+        while True:
+            with self._condition:
+                if self._closed:
+                    raise PoolError("The connection pool is closed.")
+                self.threads_waiting += 1
+                try:
+                    while not self._idle and self._number_of_connections() >= self.max_connections:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.timeouts += 1
+                            raise PoolTimeoutError(f"No database connection was available after {timeout} seconds "
+                                                   f"({self.max_connections} connections in use).")
+                        self._condition.wait(remaining)
+                finally:
+                    self.threads_waiting -= 1
+                if self._idle:
+                    idle_since, connection = self._idle.pop()
+                    self._in_use.add(connection)
+                else:
+                    idle_since, connection = None, None
+                    self._opening += 1
+
+            # Validating or opening a connection talks to the server, it is done without holding the lock
+            if connection is None:
+                try:
+                    connection = psycopg2.connect(**self._connection_parameters)
+                except Exception:
+                    with self._condition:
+                        self._opening -= 1
+                        self._condition.notify()
+                    raise
+                with self._condition:
+                    self._opening -= 1
+                    self.connections_opened += 1
+                    self._in_use.add(connection)
+            elif not self._is_usable(connection, idle_since):
+                with self._condition:
+                    self._in_use.discard(connection)
+                    self._discard(connection)
+                    self._condition.notify()
+                continue
+
+            wait_seconds = time.monotonic() - start_time
+            with self._condition:
+                self.checkouts += 1
+                self.total_wait_seconds += wait_seconds
+                self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+            return connection
+
+    def putconn(self, connection, close=False):
+        """
+        Returns a connection to the pool. A connection left inside a transaction is rolled back first.
+        """
+        if not close and not connection.closed:
+            try:
+                if connection.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+            except psycopg2.Error:
+                close = True
+        with self._condition:
+            if connection not in self._in_use:
+                raise PoolError("Trying to return a connection that was not checked out from this pool.")
+            self._in_use.discard(connection)
+            if close or connection.closed or self._closed:
+                self._discard(connection)
+            else:
+                self._idle.append((time.monotonic(), connection))
+            self._condition.notify()
+
+    def closeall(self):
+        with self._condition:
+            self._closed = True
+            while self._idle:
+                self._discard(self._idle.pop()[1])
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {"max_connections": self.max_connections,
+                    "in_use": len(self._in_use),
+                    "idle": len(self._idle),
+                    "opening": self._opening,
+                    "threads_waiting": self.threads_waiting,
+                    "checkouts": self.checkouts,
+                    "timeouts": self.timeouts,
+                    "connections_opened": self.connections_opened,
+                    "connections_discarded": self.connections_discarded,
+                    "total_wait_seconds": self.total_wait_seconds,
+                    "average_wait_seconds": self.total_wait_seconds / self.checkouts if self.checkouts else 0.0,
+                    "max_wait_seconds": self.max_wait_seconds}
+
+
+def create_connection_pool_from_config(config) -> BoundedConnectionPool:
+    """
+    Pool sized with the [db_pool] section of the config file: min_connections, max_connections,
+    checkout_timeout_seconds and validation_interval_seconds.
+    """
+    return BoundedConnectionPool(
+        min_connections=config.getint("db_pool", "min_connections", fallback=DEFAULT_POOL_MIN_CONNECTIONS),
+        max_connections=config.getint("db_pool", "max_connections", fallback=DEFAULT_POOL_MAX_CONNECTIONS),
+        checkout_timeout_seconds=config.getfloat("db_pool", "checkout_timeout_seconds",
+                                                 fallback=DEFAULT_CHECKOUT_TIMEOUT_SECONDS),
+        validation_interval_seconds=config.getfloat("db_pool", "validation_interval_seconds",
+                                                    fallback=DEFAULT_VALIDATION_INTERVAL_SECONDS),
+        host=config["postgresql"]["host"],
+        port=config.get("postgresql", "port", fallback="5432"),
+        database=config["postgresql"]["database"],
+        user=config["database_user"]["user"],
+        password=config["database_user"]["password"],
+    )
@@ -0,0 +1,129 @@
+import logging
+import psycopg2
+from psycopg2.extras import execute_values, Json
+from .db_utils import execute_query
+from app.setup.parse_card_data import iter_card_batches
+
+UPSERT_PREDICTIONS_BATCH_SIZE = 1000
+
+
+# =============================
+# Create table (runs once)
+# =============================
+def create_card_predictions_table(conn):
+    """
+    Creates the table with the archetype scores of every card, one row per card and model version.
+    The index on (card_id, scored_at DESC) lets the annotate view read the latest scores of a card with one index
+    lookup.
+    """
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS card_predictions (
+        card_id INTEGER NOT NULL REFERENCES cards (id) ON DELETE CASCADE,
+        model_version TEXT NOT NULL,
+        archetype_scores JSONB NOT NULL,
+        scored_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (card_id, model_version)
+    );
+    CREATE INDEX IF NOT EXISTS card_predictions_card_id_scored_at_idx
+        ON card_predictions (card_id, scored_at DESC);
+    """
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute(create_table_query)
+            conn.commit()
+            logging.info("Card predictions table created successfully.")
+
+    except psycopg2.Error as e:
+        logging.error(f"Database error creating the card predictions table: {e}")
+        conn.rollback()
+        raise
+
+
+# =============================
+# Bulk upsert (scoring job)
+# =============================
+def upsert_card_predictions_bulk(config, predictions, model_version, batch_size=UPSERT_PREDICTIONS_BATCH_SIZE):
+    """
+    Stores the archetype scores of many cards, one INSERT ... ON CONFLICT statement per batch.
+    Opens and closes its own connection (used by the scoring job), everything is committed at the end so the
+    annotate view never sees a half scored catalogue.
+
+    :param config: configparser object
+    :param predictions: iterable of (card_id, {archetype: score})
+    :param model_version: version of the model that computed the scores
+    :param batch_size: number of cards sent per statement
+    :return: number of cards stored
+    """
+    conn = None
+    number_of_cards_stored = 0
+    try:
+        dbname = config["postgresql"]["database"]
+        host = config["postgresql"]["host"]
+        port = config["postgresql"]["port"]
+        user = config["database_user"]["user"]
+        password = config["database_user"]["password"]
+        conn = psycopg2.connect(dbname=dbname,
+                              user=user,
+                              password=password,
+                              host=host,
+                              port=port)
+        with conn.cursor() as cur:
+            upsert_sql = """
+            INSERT INTO card_predictions (card_id, model_version, archetype_scores)
+            VALUES %s
+            ON CONFLICT (card_id, model_version) DO UPDATE
+            SET archetype_scores = EXCLUDED.archetype_scores,
+                scored_at = CURRENT_TIMESTAMP;
+            """
+            for prediction_batch in iter_card_batches(predictions, batch_size):
+                rows = [(card_id, model_version, Json(archetype_scores))
+                        for card_id, archetype_scores in prediction_batch]
+                execute_values(cur, upsert_sql, rows, page_size=batch_size)
+                number_of_cards_stored += len(rows)
+                logging.debug(f"Stored the predictions of {number_of_cards_stored} cards.")
+        conn.commit()
+        logging.info(f"Successfully stored the predictions of {number_of_cards_stored} cards "
+                     f"for the model {model_version}.")
+    except Exception as e:
+        logging.error(f"Bulk upsert of the card predictions failed: {e}")
+        number_of_cards_stored = 0
+        if conn:
+            try:
+                conn.rollback()
+            except Exception:
+                logging.error("Rollback failed.")
+    finally:
+        if conn:
+            try:
+                conn.close()
+            except Exception:
+                logging.error("Failed to close connection.")
+    return number_of_cards_stored
+
+
+# =============================
+# Latest scores of a card
+# =============================
+def get_card_prediction(card_id):
+    """
+    The most recent archetype scores of a card, read with the (card_id, scored_at DESC) index.
+
+    :return: dict with model_version, archetype_scores and scored_at, None if the card was never scored
+    """
+    try:
+        query = """
+        SELECT model_version, archetype_scores, scored_at
+        FROM card_predictions
+        WHERE card_id = %s
+        ORDER BY scored_at DESC
+        LIMIT 1
+        """
+        rows = execute_query(query, (card_id,), fetch=True)
+        if not rows:
+            return None
+        model_version, archetype_scores, scored_at = rows[0]
+        return {"model_version": model_version, "archetype_scores": archetype_scores, "scored_at": scored_at}
+    except Exception as e:
+        logging.error(f"Failed to retrieve the predictions of the card {card_id}: {e}")
+        return None
@@ -0,0 +1,351 @@
+import argparse
+import base64
+import binascii
+import configparser
+import json
+import logging
+import sys
+import psycopg2
+
+# Columns of the cards table shown in the search results, in the order of get_search_result_row
+SEARCH_RESULT_COLUMNS = """
+    id, mtg_arena_id, name, color, mana_cost, card_type, subtypes, super_types,
+    card_text, power, toughness, mcm_meta_id, card_market_link, tcg_player_link,
+    predicted_archetypes, annotated_archetypes, gold_standard_archetypes
+"""
+
+# Indexes used by the search predicates, created with the cards table
+CARDS_SEARCH_INDEXES = {
+    "cards_name_trgm_idx": "CREATE INDEX IF NOT EXISTS cards_name_trgm_idx ON cards USING GIN (name gin_trgm_ops)",
+    "cards_card_text_trgm_idx": "CREATE INDEX IF NOT EXISTS cards_card_text_trgm_idx ON cards USING GIN (card_text gin_trgm_ops)",
+    "cards_color_idx": "CREATE INDEX IF NOT EXISTS cards_color_idx ON cards USING GIN (color)",
+    "cards_card_type_idx": "CREATE INDEX IF NOT EXISTS cards_card_type_idx ON cards USING GIN (card_type)",
+    "cards_subtypes_idx": "CREATE INDEX IF NOT EXISTS cards_subtypes_idx ON cards USING GIN (subtypes)",
+    "cards_super_types_idx": "CREATE INDEX IF NOT EXISTS cards_super_types_idx ON cards USING GIN (super_types)",
+    "cards_converted_mana_cost_idx": "CREATE INDEX IF NOT EXISTS cards_converted_mana_cost_idx ON cards (converted_mana_cost)",
+    # Order of the result pages
+    "cards_name_id_idx": "CREATE INDEX IF NOT EXISTS cards_name_id_idx ON cards (name, id)",
+    # Full text search
+    "cards_card_text_search_idx": "CREATE INDEX IF NOT EXISTS cards_card_text_search_idx ON cards USING GIN (card_text_search)",
+}
+
+# Text search configuration of the card_text_search column, the queries have to use the same one
+TEXT_SEARCH_CONFIGURATION = "english"
+
+DEFAULT_SEARCH_PAGE_SIZE = 50
+MAX_SEARCH_PAGE_SIZE = 500
+
+# One filter per index, used by check_search_indexes
+SAMPLE_SEARCH_FILTERS = {
+    "name": {"name": "dragon"},
+    "card_text": {"card_text": "sacrifice a creature"},
+    "full_text": {"full_text": "sacrifice a creature"},
+    "colors": {"colors": ["R"]},
+    "card_type": {"card_type": ["Planeswalker"]},
+    "converted_mana_cost": {"converted_mana_cost": 9},
+}
+
+
+def create_cards_search_indexes(conn):
+    """
+    Creates the pg_trgm extension and the indexes the search predicates of build_search_query can use:
+    trigram GIN indexes for the partial matches on name and card_text, GIN indexes for the overlap (&&) of the array
+    columns and a btree on converted_mana_cost.
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+            for index_name, create_index_query in CARDS_SEARCH_INDEXES.items():
+                cur.execute(create_index_query)
+                logging.info(f"Index {index_name} ready.")
+            cur.execute("ANALYZE cards;")
+            conn.commit()
+    except psycopg2.Error as e:
+        logging.error(f"Database error creating the search indexes: {e}")
+        conn.rollback()
+        raise
+
+
+def get_search_filters(args):
+    """
+    Reads the search filters from the query string of the /cards route.
+
+    :param args: request.args
+    :return: dict with the filters that have a value
+    """
+    filters = {}
+    name = args.get("name", "").strip()
+    if name:
+        filters["name"] = name
+    card_text = args.get("card_text", "").strip()
+    if card_text:
+        # "partial" matches the text as it is written, "full_text" matches the words (stemmed) and ranks the results
+        if args.get("search_mode", "partial") == "full_text":
+            filters["full_text"] = card_text
+        else:
+            filters["card_text"] = card_text
+    colors = [color for color in args.getlist("colors") if color]
+    if colors:
+        filters["colors"] = colors
+    card_type = args.get("card_type", "").strip()
+    if card_type:
+        filters["card_type"] = [card_type]
+    # The search form sends "cmc"
+    converted_mana_cost = (args.get("cmc", "") or args.get("converted_mana_cost", "")).strip()
+    if converted_mana_cost.lstrip("-").isdigit():
+        filters["converted_mana_cost"] = int(converted_mana_cost)
+    return filters
+
+
+def get_search_cache_key(filters, after=None, page_size=None):
+    """
+    Normalized form of a search, the searches that return the same page have the same key: the order of the colors
+    and card types doesn't matter, and the text filters are matched case insensitively.
+    """
+    return (filters.get("name", "").lower(),
+            filters.get("card_text", "").lower(),
+            " ".join(filters.get("full_text", "").lower().split()),
+            tuple(sorted(set(filters.get("colors", [])))),
+            tuple(sorted(set(filters.get("card_type", [])))),
+            filters.get("converted_mana_cost"),
+            after,
+            page_size)
+
+
+def get_search_page_size(config) -> int:
+    """
+    Number of cards per page of search results, [search] page_size in the config file, capped to MAX_SEARCH_PAGE_SIZE.
+    """
+    page_size = config.getint("search", "page_size", fallback=DEFAULT_SEARCH_PAGE_SIZE)
+    return max(1, min(page_size, MAX_SEARCH_PAGE_SIZE))
+
+
+def encode_search_cursor(sort_key, card_id) -> str:
+    """
+    Token of the position after the last card of a page, the next page starts after (sort_key, card_id).
+    The sort key is the name of the card, or its rank in the full text search mode.
+    """
+    return base64.urlsafe_b64encode(json.dumps([sort_key, card_id]).encode("utf-8")).decode("ascii")
+
+
+def decode_search_cursor(token):
+    """
+    :return: (sort_key, card_id) of the token, None if the token is missing or not valid
+    """
+    if not token:
+        return None
+    try:
+        sort_key, card_id = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        if not isinstance(sort_key, (str, int, float)):
+            raise TypeError("The sort key of a search cursor has to be a name or a rank")
+        return sort_key, int(card_id)
+    except (ValueError, TypeError, binascii.Error, UnicodeError):
+        logging.warning(f"Ignoring the search cursor {token}, it is not valid")
+        return None
+
+
+def is_search_cursor_of_filters(filters, after) -> bool:
+    """
+    True if the sort key of a decoded cursor is the one of the search mode of the filters: a rank in the full text
+    mode, a name otherwise. The cursor of a page of the other mode can't be compared with the sort key of the query.
+    """
+    sort_key = after[0]
+    if "full_text" in filters:
+        return isinstance(sort_key, (int, float)) and not isinstance(sort_key, bool)
+    return isinstance(sort_key, str)
+
+
+def get_next_search_cursor(filters, last_result) -> str:
+    """
+    Cursor of the page after the one that ends with last_result (a dict of get_search_result_row).
+    """
+    if "full_text" in filters:
+        return encode_search_cursor(last_result["rank"], last_result["id"])
+    return encode_search_cursor(last_result["name"], last_result["id"])
+
+
+def build_search_query(filters, after=None, limit=None):
+    """
+    Builds the search query with predicates that can use the indexes of create_cards_search_indexes:
+    ILIKE with the trigram indexes, && (overlap) with the GIN indexes of the arrays and = with the btree.
+
+    With a limit the results are ordered by (name, id) and paginated with a keyset: the page starts after the
+    (name, id) of the cursor, so every page costs the same however deep it is.
+    In the full text mode the cards are matched with the GIN index of card_text_search and ordered by ts_rank (best
+    first), then id, the rank is returned as an extra column.
+
+    :param filters: dict returned by get_search_filters
+    :param after: (sort key, id) returned by decode_search_cursor, None for the first page
+    :param limit: maximum number of rows, None for all of them (unordered)
+    :return: (query, params)
+    """
+    conditions = []
+    params = []
+
+    if "name" in filters:
+        conditions.append("name ILIKE %s")
+        params.append(f"%{filters['name']}%")
+
+    if "card_text" in filters:
+        conditions.append("card_text ILIKE %s")
+        params.append(f"%{filters['card_text']}%")
+
+    if "colors" in filters:
+        # Any of the colors
+        conditions.append("color && %s::text[]")
+        params.append(list(filters["colors"]))
+
+    if "card_type" in filters:
+        # Any of the card types
+        conditions.append("card_type && %s::text[]")
+        params.append(list(filters["card_type"]))
+
+    if "converted_mana_cost" in filters:
+        conditions.append("converted_mana_cost = %s")
+        params.append(filters["converted_mana_cost"])
+
+    if "full_text" in filters:
+        return build_full_text_search_query(filters["full_text"], conditions, params, after, limit)
+
+    if after is not None:
+        conditions.append("(name, id) > (%s, %s)")
+        params.extend(after)
+
+    query = f"SELECT {SEARCH_RESULT_COLUMNS} FROM cards"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    if limit is not None:
+        query += " ORDER BY name, id LIMIT %s"
+        params.append(limit)
+    return query, params
+
+
+def build_full_text_search_query(text_query, conditions, params, after=None, limit=None):
+    """
+    Full text part of build_search_query, the text_query accepts the web search syntax ("quoted phrases", or, -word).
+    """
+    ts_query = f"websearch_to_tsquery('{TEXT_SEARCH_CONFIGURATION}', %s)"
+    conditions = [f"card_text_search @@ {ts_query}"] + conditions
+    query = f"""
+    SELECT * FROM (
+        SELECT {SEARCH_RESULT_COLUMNS}, ts_rank(card_text_search, {ts_query})::float8 AS rank
+        FROM cards
+        WHERE {" AND ".join(conditions)}
+    ) AS ranked_cards
+    """
+    params = [text_query, text_query] + params
+    if after is not None:
+        query += " WHERE rank < %s::float8 OR (rank = %s::float8 AND id > %s)"
+        params.extend([float(after[0]), float(after[0]), after[1]])
+    if limit is not None:
+        query += " ORDER BY rank DESC, id LIMIT %s"
+        params.append(limit)
+    return query, params
+
+
+def get_estimated_row_count(explain_output) -> int:
+    """
+    Number of rows the planner expects, from the output of EXPLAIN (FORMAT JSON). It is an approximation that doesn't
+    need to read the matching rows.
+    """
+    if isinstance(explain_output, str):
+        explain_output = json.loads(explain_output)
+    return int(explain_output[0]["Plan"]["Plan Rows"])
+
+
+def get_search_result_row(row):
+    return {
+        "id": row[0],
+        "mtg_arena_id": row[1],
+        "name": row[2],
+        "color": row[3],
+        "mana_cost": row[4],
+        "card_type": row[5],
+        "subtypes": row[6],
+        "super_types": row[7],
+        "card_text": row[8],
+        "power": row[9],
+        "toughness": row[10],
+        "mcm_meta_id": row[11],
+        "card_market_link": row[12],
+        "tcg_player_link": row[13],
+        "predicted_archetypes": row[14],
+        "annotated_archetypes": row[15],
+        "gold_standard_archetypes": row[16],
+        # Only in the full text search mode
+        "rank": row[17] if len(row) > 17 else None
+    }
+
+
+def get_plan_index_names(plan):
+    """
+    Names of the indexes used by a plan node of EXPLAIN (FORMAT JSON) and all its children.
+    """
+    index_names = set()
+    if "Index Name" in plan:
+        index_names.add(plan["Index Name"])
+    for child_plan in plan.get("Plans", []):
+        index_names |= get_plan_index_names(child_plan)
+    return index_names
+
+
+def explain_search_query(cur, filters):
+    """
+    :return: the plan chosen by PostgreSQL for the search query of the filters (EXPLAIN (FORMAT JSON), not executed)
+    """
+    query, params = build_search_query(filters)
+    cur.execute("EXPLAIN (FORMAT JSON) " + query, params)
+    explain_output = cur.fetchone()[0]
+    if isinstance(explain_output, str):
+        explain_output = json.loads(explain_output)
+    return explain_output[0]["Plan"]
+
+
+def check_search_indexes(config, search_filters=None):
+    """
+    Runs EXPLAIN on the search query of every sample filter and reports which indexes the planner uses.
+    On a small table PostgreSQL may prefer a sequential scan, the check is meaningful once the catalogue is loaded.
+
+    :param config: configparser object
+    :param search_filters: dict filter name -> filters, SAMPLE_SEARCH_FILTERS by default
+    :return: dict filter name -> set of index names used (empty if the search is a sequential scan)
+    """
+    search_filters = search_filters or SAMPLE_SEARCH_FILTERS
+    conn = psycopg2.connect(dbname=config["postgresql"]["database"],
+                            user=config["database_user"]["user"],
+                            password=config["database_user"]["password"],
+                            host=config["postgresql"]["host"],
+                            port=config["postgresql"]["port"])
+    indexes_used = {}
+    try:
+        with conn.cursor() as cur:
+            for filter_name, filters in search_filters.items():
+                indexes_used[filter_name] = get_plan_index_names(explain_search_query(cur, filters))
+                if indexes_used[filter_name]:
+                    logging.info(f"The search by {filter_name} uses the indexes: " + ", ".join(sorted(indexes_used[filter_name])))
+                else:
+                    logging.warning(f"The search by {filter_name} doesn't use any index (sequential scan).")
+    finally:
+        conn.close()
+    return indexes_used
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks with EXPLAIN that the card searches use the indexes.")
+    parser.add_argument(
+        "--config","-c",
+        help="Path to config file.",
+        type = str,
+        required = True,
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s %(message)s',datefmt='%m/%d/%Y %I:%M:%S %p')
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    indexes_used = check_search_indexes(config)
+    sys.exit(0 if all(indexes_used.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
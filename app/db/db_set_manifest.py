@@ -0,0 +1,77 @@
+import logging
+import psycopg2
+from psycopg2.extras import execute_values
+
+
+# =============================
+# Create table (runs once)
+# =============================
+def create_card_set_manifest_table(conn):
+    """
+    Creates the table with the sets of the source file already imported and the hash of their content, used by the
+    incremental import to skip the sets that didn't change.
+    """
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS card_set_manifest (
+        set_code TEXT PRIMARY KEY,
+        content_hash TEXT NOT NULL,
+        number_of_cards INTEGER NOT NULL,
+        imported_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute(create_table_query)
+            conn.commit()
+            logging.info("Card set manifest table created successfully.")
+    except psycopg2.Error as e:
+        logging.error(f"Database error creating the card set manifest table: {e}")
+        conn.rollback()
+        raise
+
+
+def connect_with_user(config):
+    return psycopg2.connect(dbname=config["postgresql"]["database"],
+                            user=config["database_user"]["user"],
+                            password=config["database_user"]["password"],
+                            host=config["postgresql"]["host"],
+                            port=config["postgresql"]["port"])
+
+
+def get_set_manifest(config):
+    """
+    :return: dict set_code -> content_hash of the sets already imported
+    """
+    conn = connect_with_user(config)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT set_code, content_hash FROM card_set_manifest")
+            return dict(cur.fetchall())
+    finally:
+        conn.close()
+
+
+def save_set_manifest(config, set_entries):
+    """
+    Stores the content hash of the sets imported.
+
+    :param set_entries: iterable of (set_code, content_hash, number_of_cards)
+    """
+    conn = connect_with_user(config)
+    try:
+        with conn.cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO card_set_manifest (set_code, content_hash, number_of_cards)
+                VALUES %s
+                ON CONFLICT (set_code) DO UPDATE
+                SET content_hash = EXCLUDED.content_hash,
+                    number_of_cards = EXCLUDED.number_of_cards,
+                    imported_at = CURRENT_TIMESTAMP
+            """, list(set_entries))
+        conn.commit()
+    except psycopg2.Error as e:
+        logging.error(f"Failed to save the card set manifest: {e}")
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
@@ -1,19 +1,51 @@
 import logging
+import os
+import threading
 from flask import g, current_app
 from psycopg2.extras import execute_values
 
+_db_pool_lock = threading.Lock()
+
 # Acquire and return pooled connections via Flask's app context
 
+def get_db_pool():
+    """
+    The DB pool of the current process, created with DB_POOL_FACTORY the first time it is needed. A process forked
+    after the pool was created (e.g. a WSGI worker of a preloaded app) creates its own, connections can't be shared
+    between processes.
+    """
+    if current_app.config.get('DB_POOL_PID') != os.getpid():
+        with _db_pool_lock:
+            if current_app.config.get('DB_POOL_PID') != os.getpid():
+                current_app.config['DB_POOL'] = current_app.config['DB_POOL_FACTORY']()
+                current_app.config['DB_POOL_PID'] = os.getpid()
+                logging.info(f"Created the DB pool of the process {os.getpid()}")
+    return current_app.config['DB_POOL']
+
+
+def get_db_pool_stats():
+    """
+    :return: the gauges of the DB pool of the current process, None if it didn't need one yet
+    """
+    if current_app.config.get('DB_POOL_PID') != os.getpid():
+        return None
+    return current_app.config['DB_POOL'].stats()
+
+
 def get_db_connection():
+    """
+    The connection of the current request, checked out from the pool on the first call (the pool waits up to its
+    checkout timeout if all the connections are in use) and returned when the request ends.
+    """
     if 'db_conn' not in g:
-        g.db_conn = current_app.config['DB_POOL'].getconn()
+        g.db_conn = get_db_pool().getconn()
     return g.db_conn
 
 
 def return_db_connection():
     db_conn = g.pop('db_conn', None)
     if db_conn:
-        current_app.config['DB_POOL'].putconn(db_conn)
+        get_db_pool().putconn(db_conn)
 
 
 # Core helpers
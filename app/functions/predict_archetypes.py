@@ -0,0 +1,224 @@
+import argparse
+import configparser
+import logging
+import os
+import sys
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable, List
+import numpy as np
+
+from app.classes.feature_matrix import CardFeatureMatrix
+from app.db.db_cards import update_predicted_archetypes_bulk
+from app.db.db_predictions import upsert_card_predictions_bulk
+from app.db.db_annotation_queue import refresh_annotation_queue
+from app.setup.vectorize_cards import get_feature_matrix_path
+
+PREDICTION_BATCH_SIZE = 4096
+DEFAULT_TOP_K = 3
+DEFAULT_THRESHOLD = 0.5
+
+
+class ArchetypeModel:
+    """
+    Multi-label archetype classifier: one hidden ReLU layer and one sigmoid output per archetype, evaluated with numpy
+    on the sparse card features.
+
+    The weights are stored in a .npz file with the arrays W1, b1, W2, b2, input_scale, archetype_labels and the
+    vocabulary the model was trained with (vocabulary_layout_id, vocabulary_version).
+    """
+
+    def __init__(self, W1, b1, W2, b2, archetype_labels, input_scale=None, vocabulary_layout_id="",
+                 vocabulary_version=0, model_version=""):
+        if input_scale is None:
+            input_scale = np.ones(W1.shape[0], dtype=np.float32)
+        # The input scale is folded in the first layer, so the raw feature values can be used as they are
+        self.W1 = (W1 * input_scale[:, None]).astype(np.float32)
+        self.b1 = b1.astype(np.float32)
+        self.W2 = W2.astype(np.float32)
+        self.b2 = b2.astype(np.float32)
+        self.archetype_labels = list(archetype_labels)
+        self.vocabulary_layout_id = vocabulary_layout_id
+        self.vocabulary_version = vocabulary_version
+        self.model_version = model_version
+
+    @property
+    def number_of_features(self) -> int:
+        return self.W1.shape[0]
+
+    @classmethod
+    def load(cls, weights_path) -> "ArchetypeModel":
+        with np.load(weights_path, allow_pickle=False) as weights:
+            model = cls(W1=weights["W1"], b1=weights["b1"], W2=weights["W2"], b2=weights["b2"],
+                        archetype_labels=[str(label) for label in weights["archetype_labels"]],
+                        input_scale=weights["input_scale"] if "input_scale" in weights else None,
+                        vocabulary_layout_id=str(weights["vocabulary_layout_id"]) if "vocabulary_layout_id" in weights else "",
+                        vocabulary_version=int(weights["vocabulary_version"]) if "vocabulary_version" in weights else 0,
+                        model_version=str(weights["model_version"]) if "model_version" in weights else Path(weights_path).stem)
+        logging.info(f"Loaded the archetype model {model.model_version} with {model.number_of_features} features and "
+                     f"{len(model.archetype_labels)} archetypes")
+        return model
+
+    def check_matrix(self, matrix: CardFeatureMatrix) -> None:
+        """
+        The columns of the matrix have to be the same ones the model was trained with (or an extension of them).
+        """
+        if self.vocabulary_layout_id and matrix.vocabulary_layout_id != self.vocabulary_layout_id:
+            raise ValueError("The card feature matrix was vectorized with a different vocabulary than the model, "
+                             "the model has to be trained again.")
+
+    def predict_proba(self, matrix: CardFeatureMatrix, rows: Iterable[int]) -> np.ndarray:
+        """
+        Archetype probabilities of a batch of rows of the feature matrix.
+
+        :return: float32 array of shape (number of rows, number of archetypes)
+        """
+        hidden = matrix.dot(self.W1, rows) + self.b1
+        np.maximum(hidden, 0, out=hidden)
+        logits = hidden @ self.W2 + self.b2
+        return 1.0 / (1.0 + np.exp(-logits))
+
+
+@lru_cache(maxsize=4)
+def get_archetype_model(weights_path: str) -> ArchetypeModel:
+    """
+    The model is loaded only once per process (web worker or scoring job).
+    """
+    return ArchetypeModel.load(weights_path)
+
+
+# Feature matrix memory mapped by the process per path, with the version of shape.json it was loaded from
+_card_feature_matrices = {}
+
+
+def get_card_feature_matrix(feature_matrix_path: str) -> CardFeatureMatrix:
+    """
+    The feature matrix is memory mapped once per process, and again only when it is saved again (import, errata):
+    CardFeatureMatrix.save replaces shape.json last, so a new inode or modification time of shape.json means new files.
+    """
+    shape_stat = os.stat(Path(feature_matrix_path) / "shape.json")
+    matrix_version = (shape_stat.st_ino, shape_stat.st_mtime_ns)
+    loaded_version, matrix = _card_feature_matrices.get(feature_matrix_path, (None, None))
+    if loaded_version != matrix_version:
+        matrix = CardFeatureMatrix.load(feature_matrix_path, memory_map=True)
+        _card_feature_matrices[feature_matrix_path] = (matrix_version, matrix)
+    return matrix
+
+
+def get_weights_path(config) -> Path:
+    return Path(config["model"]["weights_filepath"])
+
+
+def get_top_archetypes(probabilities: np.ndarray, archetype_labels: List[str], top_k: int = DEFAULT_TOP_K,
+                       threshold: float = DEFAULT_THRESHOLD) -> List[List[str]]:
+    """
+    For every row of probabilities, the labels of the top_k archetypes with a probability of at least threshold,
+    most probable first.
+    """
+    top_k = min(top_k, probabilities.shape[1])
+    best_columns = np.argsort(-probabilities, axis=1)[:, :top_k]
+    return [[archetype_labels[column] for column in row_columns if row_probabilities[column] >= threshold]
+            for row_columns, row_probabilities in zip(best_columns, probabilities)]
+
+
+def predict_cards(card_ids: Iterable[int], model: ArchetypeModel, matrix: CardFeatureMatrix) -> dict:
+    """
+    Archetype probabilities of a batch of cards.
+
+    :param card_ids: ids of the cards
+    :return: dict card_id -> {archetype: probability}, cards that are not in the feature matrix are left out
+    """
+    model.check_matrix(matrix)
+    card_rows = [(card_id, matrix.row_of_card_id(card_id)) for card_id in card_ids]
+    card_rows = [(card_id, row) for card_id, row in card_rows if row is not None]
+    if not card_rows:
+        return {}
+    probabilities = model.predict_proba(matrix, [row for card_id, row in card_rows])
+    return {card_id: dict(zip(model.archetype_labels, card_probabilities.tolist()))
+            for (card_id, row), card_probabilities in zip(card_rows, probabilities)}
+
+
+def iter_catalogue_predictions(model: ArchetypeModel, matrix: CardFeatureMatrix,
+                               batch_size: int = PREDICTION_BATCH_SIZE):
+    """
+    Scores every card of the feature matrix, batch by batch. A card vectorized again by the incremental import
+    (errata) is only scored with its latest row.
+
+    :return: generator of (card_ids, probabilities) per batch
+    """
+    model.check_matrix(matrix)
+    for first_row in range(0, matrix.number_of_rows, batch_size):
+        rows = np.arange(first_row, min(first_row + batch_size, matrix.number_of_rows))
+        card_ids = np.asarray(matrix.card_ids[rows])
+        latest_rows = np.array([matrix.row_of_card_id(card_id) == row for card_id, row in zip(card_ids, rows)],
+                               dtype=bool)
+        rows, card_ids = rows[latest_rows], card_ids[latest_rows]
+        if len(rows):
+            yield card_ids, model.predict_proba(matrix, rows)
+
+
+def score_catalogue(config) -> int:
+    """
+    Predicts the archetypes of all the cards, stores the scores of every archetype in the card_predictions table (the
+    hints of the annotate view) and writes the top ones to the predicted_archetypes column.
+
+    :param config: configparser object
+    :return: number of cards scored
+    """
+    model = get_archetype_model(str(get_weights_path(config)))
+    matrix = get_card_feature_matrix(str(get_feature_matrix_path(config)))
+    batch_size = config.getint("model", "prediction_batch_size", fallback=PREDICTION_BATCH_SIZE)
+    top_k = config.getint("model", "top_k", fallback=DEFAULT_TOP_K)
+    threshold = config.getfloat("model", "threshold", fallback=DEFAULT_THRESHOLD)
+
+    def iter_archetype_scores():
+        for card_ids, probabilities in iter_catalogue_predictions(model, matrix, batch_size):
+            for card_id, card_probabilities in zip(card_ids.tolist(), probabilities.tolist()):
+                yield card_id, dict(zip(model.archetype_labels, card_probabilities))
+
+    def iter_predicted_archetypes():
+        for card_ids, probabilities in iter_catalogue_predictions(model, matrix, batch_size):
+            yield from zip(card_ids.tolist(), get_top_archetypes(probabilities, model.archetype_labels, top_k, threshold))
+
+    start_time = time.perf_counter()
+    number_of_cards_scored = upsert_card_predictions_bulk(config, iter_archetype_scores(), model.model_version, batch_size)
+    elapsed_time = time.perf_counter() - start_time
+    logging.info(f"Stored the scores of {number_of_cards_scored} cards in {elapsed_time:.2f} seconds "
+                 f"({number_of_cards_scored / max(elapsed_time, 1e-9):.0f} cards per second)")
+
+    start_time = time.perf_counter()
+    number_of_cards_updated = update_predicted_archetypes_bulk(config, iter_predicted_archetypes(), batch_size)
+    elapsed_time = time.perf_counter() - start_time
+    logging.info(f"Updated the predicted archetypes of {number_of_cards_updated} cards in {elapsed_time:.2f} seconds "
+                 f"({number_of_cards_updated / max(elapsed_time, 1e-9):.0f} cards per second)")
+
+    # The annotation queue is ordered by these scores
+    refresh_annotation_queue(config, config.get("annotation_queue", "strategy", fallback="uncertainty"))
+    return number_of_cards_scored
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Predicts the archetypes of all the cards with the trained model.")
+    parser.add_argument(
+        "--log-level","-l",
+        default="ERROR",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        help="Set the logging level (default: ERROR)."
+    )
+    parser.add_argument(
+        "--config","-c",
+        help="Path to config file.",
+        type = str,
+        required = True,
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, level=getattr(logging, args.log_level.upper()), format='%(asctime)s %(message)s',datefmt='%m/%d/%Y %I:%M:%S %p')
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    score_catalogue(config)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,30 @@
 import logging
+from itertools import chain
 import numpy as np
-from app.db.db_cards import update_magic_card
+from app.db.db_cards import update_card_annotation
+from app.classes.card_object import ARCHETYPE_OUTPUT_PREFIX, pack_archetype_vector
 
-def annotate_card(form_data,card_object):
-    logging.info(f"Annotating the card: {card_object.name}")
-    print(form_data)
-    for i,j in form_data.items():
-        print(i,j)
+def get_annotation_of_labels(checked_labels, vector_output_labels):
+    """
+    :param checked_labels: set of the output labels (output_archetype_<name>) chosen by the annotator
+    :param vector_output_labels: output labels of the card, in the order of its output vector
+    :return: (output vector, list of the annotated archetype names)
+    """
+    new_vec = [1 if label in checked_labels else 0 for label in vector_output_labels]
+    # The archetype names (without the output_archetype_ prefix) are what the trainer reads from the cards table
+    annotated_archetypes = [label[len(ARCHETYPE_OUTPUT_PREFIX):]
+                            for label, annotated in zip(vector_output_labels, new_vec) if annotated]
+    return np.array(new_vec,dtype=float), annotated_archetypes
 
-    for i in form_data:
-        print(i)
 
-    print("####################################")
-    new_vec = []
-    for label in card_object.vector_output_labels:
-        print(label)
-        for category, archetype in form_data.items():
-            print("--" + archetype)
-            if label == archetype:
-                print("found")
-                new_vec.append(1)
-                break
-        else:
-            print("nofound")
-            new_vec.append(0)
+def annotate_card(form_data,card_object):
+    logging.info(f"Annotating the card: {card_object.name}")
+    logging.debug(f"Received the annotation form: {dict(form_data)}")
 
-    print(new_vec)
-    card_object.vector_output = np.array(new_vec,dtype=float)
-    update_magic_card(card_object)
+    # Several checkboxes share the same name, so every value of every field is read
+    checked_labels = set(chain.from_iterable(form_data.listvalues()))
+    card_object.vector_output, card_object.annotated_archetypes = get_annotation_of_labels(
+        checked_labels, card_object.vector_output_labels)
+    # Only the annotation columns are written, not the whole row
+    update_card_annotation(card_object.id, card_object.annotated_archetypes, pack_archetype_vector(card_object.vector_output))
     return card_object
@@ -1,5 +1,25 @@
 import configparser
-from flask import render_template
+from flask import render_template, current_app
+from app.db.db_predictions import get_card_prediction
+from app.db.db_cards import get_magic_card, get_card_version
+from app.classes.lru_cache import CACHE_MISS
+
+# Number of archetypes suggested by the model in the annotate view
+ANNOTATION_HINTS_TOP_K = 5
+
+
+def get_prediction_hints(card_id, top_k=ANNOTATION_HINTS_TOP_K):
+    """
+    The top_k archetypes of the precomputed scores of the card, most probable first.
+
+    :return: (model_version, list of (archetype, score)), (None, []) if the card has not been scored yet
+    """
+    prediction = get_card_prediction(card_id)
+    if prediction is None:
+        return None, []
+    best_archetypes = sorted(prediction["archetype_scores"].items(), key=lambda item: item[1], reverse=True)[:top_k]
+    return prediction["model_version"], best_archetypes
+
 
 def get_annotate_view(card_object):
     archetype_label_checkbox_status_pair_dict = {}
@@ -8,4 +28,31 @@ def get_annotate_view(card_object):
             archetype_label_checkbox_status_pair_dict[archetype_labels] = ""
         else:
             archetype_label_checkbox_status_pair_dict[archetype_labels] = "checked"
-    return render_template("annotate_view.html", card_display=card_object.display_html,archetype_data=archetype_label_checkbox_status_pair_dict)
+    model_version, prediction_hints = get_prediction_hints(card_object.id)
+    return render_template("annotate_view.html", card_display=card_object.get_display_html(),archetype_data=archetype_label_checkbox_status_pair_dict,
+                           model_version=model_version, prediction_hints=prediction_hints, card_id=card_object.id)
+
+
+def get_annotate_view_of_card(card_id):
+    """
+    Annotate view of a card, from the annotate view cache of the web worker when it was rendered recently and the
+    card was not written since, by this process or any other (see get_card_version).
+
+    :return: the HTML of the view, None if the card doesn't exist
+    """
+    annotate_view_cache = current_app.config.get("ANNOTATE_VIEW_CACHE")
+    # Read before the card, a write made while the view is rendered makes the cached view outdated
+    version = get_card_version(card_id)
+    if version is None:
+        return None
+    if annotate_view_cache is not None:
+        cached_entry = annotate_view_cache.get(card_id)
+        if cached_entry is not CACHE_MISS and cached_entry[0] == version:
+            return cached_entry[1]
+    card_object = get_magic_card(card_id)
+    if not card_object:
+        return None
+    annotate_view = get_annotate_view(card_object)
+    if annotate_view_cache is not None:
+        annotate_view_cache.set(card_id, (version, annotate_view))
+    return annotate_view
@@ -0,0 +1,20 @@
+from flask import render_template, current_app
+from app.db.db_annotation_statistics import get_annotation_statistics
+from app.classes.card_object import ARCHETYPE_OUTPUT_PREFIX
+
+
+def get_dashboard():
+    """
+    Annotation progress and number of annotated cards per archetype, read from the counters kept up to date by every
+    annotation. All the archetypes of the config file are listed, the ones without annotations with 0.
+    """
+    statistics = get_annotation_statistics()
+    archetype_counts = statistics["archetype_counts"]
+    archetypes = [label[len(ARCHETYPE_OUTPUT_PREFIX):] for label in current_app.config["ARCHETYPE_LABELS"]]
+    archetype_rows = sorted(((archetype, archetype_counts.get(archetype, 0)) for archetype in archetypes),
+                            key=lambda row: row[1], reverse=True)
+    estimated_number_of_cards = statistics["estimated_number_of_cards"]
+    annotated_percentage = (100 * statistics["annotated_cards"] / estimated_number_of_cards
+                            if estimated_number_of_cards else 0)
+    return render_template("dashboard.html", statistics=statistics, archetype_rows=archetype_rows,
+                           annotated_percentage=min(annotated_percentage, 100))
@@ -8,8 +8,8 @@ def get_feature_showcase():
         "description":"Get insight on the data charactersitics in the dashboard"
     },{
         "image": "annotate.jpg",
-        "title": "Annotate a random card",
-        "link": "/annotate_random_card",
-        "description": "Get a random card to be annotated."
+        "title": "Annotate the next card",
+        "link": "/annotate",
+        "description": "Get the next card to be annotated, the ones the model is least sure about come first."
     }]
     return render_template("showcase_features_template.html",cards=feature_cards)
\ No newline at end of file
@@ -1,94 +1,70 @@
-
+from urllib.parse import urlencode
 from app.db.db_utils import execute_query
+from app.db.db_cache_generations import get_cache_generation, SEARCH_RESULTS_GENERATION
+from app.db.db_search import (get_search_filters, build_search_query, get_search_result_row, get_next_search_cursor,
+                              decode_search_cursor, is_search_cursor_of_filters, get_estimated_row_count,
+                              get_search_cache_key)
+from app.classes.lru_cache import CACHE_MISS
 import logging
-from flask import render_template
-
-
-def search_cards(request):
-    try:
-        name = request.args.get("name", "").strip()
-        colors = request.args.getlist("colors")  # multiple checkboxes
-        card_type = request.args.get("card_type", "").strip()
-        if card_type:
-            card_type = [request.args.get("card_type", "").strip()]
-        else:
-            card_type = []
-        cmc = request.args.get("converted_mana_cost", "").strip()
-        card_text = request.args.get("card_text", "").strip()
-
-        # Base query
-        query = """
-        SELECT id, mtg_arena_id, name, color, mana_cost, card_type, subtypes, super_types,
-               card_text, power, toughness, mcm_meta_id, card_market_link, tcg_player_link,
-               predicted_archetypes, annotated_archetypes, gold_standard_archetypes
-        FROM cards
-        WHERE 1=1
-        """
-
-        params = []
+from flask import render_template, current_app
 
-        # Add conditions dynamically
-        if name:
-            query += " AND name ILIKE %s"
-            params.append(f"%{name}%")
 
-        if card_text:
-            query += " AND card_text ILIKE %s"
-            params.append(f"%{card_text}%")
+def get_search_page_url(args, after=None):
+    """
+    URL of a page of the same search, the first one if after is None.
+    """
+    page_args = {key: values for key, values in args.lists() if key != "after"}
+    if after is not None:
+        page_args["after"] = after
+    return "/cards?" + urlencode(page_args, doseq=True)
 
-        if colors:
-            # Match any color in the array
-            query += " AND ("
-            query += " OR ".join(["%s = ANY(color)" for _ in colors])
-            query += ")"
-            params.extend(colors)
 
-        if card_type:
-            # Match any color in the array
-            query += " AND ("
-            # here we have to fake that the source is coming from a list of card_types, it is not, but I don't want to make a very advance search, only something easy.
-            query += " OR ".join(["%s = ANY(card_type)" for _ in card_type])
-            query += ")"
-            params.extend(card_type)
-
-        if cmc:
-            query += " AND converted_mana_cost = %s"
-            params.append(cmc)
-
-        print(query)
+def search_cards(request):
+    try:
+        filters = get_search_filters(request.args)
+        after = decode_search_cursor(request.args.get("after"))
+        if after is not None and not is_search_cursor_of_filters(filters, after):
+            logging.warning(f"Ignoring the search cursor {request.args.get('after')}, it belongs to the other search mode")
+            after = None
+        page_size = current_app.config["SEARCH_PAGE_SIZE"]
+
+        # Repeated searches skip the query and the render, the generation changes whenever a process writes the
+        # cards shown in the results
+        search_result_cache = current_app.config.get("SEARCH_RESULT_CACHE")
+        if search_result_cache is not None:
+            cache_key = (get_cache_generation(SEARCH_RESULTS_GENERATION), get_search_cache_key(filters, after, page_size))
+            search_results_html = search_result_cache.get(cache_key)
+            if search_results_html is not CACHE_MISS:
+                return search_results_html
+
+        # One more row than the page size tells if there is a next page
+        query, params = build_search_query(filters, after, page_size + 1)
+        logging.debug(f"Searching cards with the filters: {filters}")
 
         # Execute
         rows = execute_query(query, params, fetch=True)
+        result = [get_search_result_row(row) for row in rows[:page_size]]
 
-        result = []
-        for row in rows:
-            result.append({
-                "id": row[0],
-                "mtg_arena_id": row[1],
-                "name": row[2],
-                "color": row[3],
-                "mana_cost": row[4],
-                "card_type": row[5],
-                "subtypes": row[6],
-                "super_types": row[7],
-                "card_text": row[8],
-                "power": row[9],
-                "toughness": row[10],
-                "mcm_meta_id": row[11],
-                "card_market_link": row[12],
-                "tcg_player_link": row[13],
-                "predicted_archetypes": row[14],
-                "annotated_archetypes": row[15],
-                "gold_standard_archetypes": row[16]
-            })
+        next_page_url = None
+        if len(rows) > page_size:
+            next_page_url = get_search_page_url(request.args, get_next_search_cursor(filters, result[-1]))
+        first_page_url = get_search_page_url(request.args) if after is not None else None
+
+        approximate_count = None
+        if current_app.config["SEARCH_APPROXIMATE_COUNT"] and after is None and next_page_url:
+            count_query, count_params = build_search_query(filters)
+            approximate_count = get_estimated_row_count(
+                execute_query("EXPLAIN (FORMAT JSON) " + count_query, count_params, fetch=True)[0][0])
 
         data_consult_form = render_template("card_data_consultation_form.html")
         color_emojis = {'W': '☀️', 'U': '💧', 'B': '💀', 'R': '🔥', 'G': '🌳'}
-        return render_template("search_results.html", data_consultation_form=data_consult_form, results=result,
-                               color_emojis=color_emojis)
+        search_results_html = render_template("search_results.html", data_consultation_form=data_consult_form,
+                                              results=result, color_emojis=color_emojis, next_page_url=next_page_url,
+                                              first_page_url=first_page_url, approximate_count=approximate_count)
+        if search_result_cache is not None:
+            search_result_cache.set(cache_key, search_results_html)
+        return search_results_html
 
     except Exception as e:
         logging.error(f"Advanced search failed: {e}")
         return "<div><p>Query Failed</p></div>"
-
-
@@ -1,11 +1,14 @@
-from flask import request, session, redirect, g, render_template, url_for
+from flask import request, session, redirect, render_template, url_for
 from app.html_elements.navbar import get_navbar
 from app.html_elements.feature_showcase import get_feature_showcase
 from app.html_elements.search_cards import search_cards
-from app.html_elements.annotate_view import get_annotate_view
+from app.html_elements.annotate_view import get_annotate_view, get_annotate_view_of_card
+from app.html_elements.dashboard import get_dashboard
 from app.functions.update_archetypes import annotate_card
 from app.db.db_users import authenticate_user
 from app.db.db_cards import get_magic_card
+from app.db.db_annotation_queue import claim_next_card_to_annotate, release_card_claim
+from app.db.db_utils import get_db_connection, get_db_pool_stats
 from flask import request
 import configparser
 
@@ -17,7 +20,7 @@ def register_routes(app,config):
         if request.method == "POST":
             username = request.form.get("username")
             password = request.form.get("password")
-            if authenticate_user(g.db_conn, username, password):
+            if authenticate_user(get_db_connection(), username, password):
                 session["authenticated"] = True
                 session["username"] = username
                 session["active_page"] = "home"
@@ -37,7 +40,8 @@ def register_routes(app,config):
         if not session.get("authenticated", False):
             return redirect("/login")
         if request.method == "GET":
-            if any(value for value in request.args.values()):
+            # The search mode radio is always sent, it is not a filter
+            if any(value for key, value in request.args.items(multi=True) if key != "search_mode"):
                 page_content = search_cards(request)
                 return get_navbar(session,page_content)
             else:
@@ -45,10 +49,21 @@ def register_routes(app,config):
                 return get_navbar(session, data_consult_form)
 
     @app.route('/annotate', methods=['GET'])
-    def get_random_card():
+    def get_next_card_to_annotate():
         if not session.get("authenticated", False):
             return redirect("/login")
-        return redirect("/annotate/423")
+        session["active_page"] = "annotate_random_card"
+        card_id = claim_next_card_to_annotate(session.get("username"), app.config["ANNOTATION_CLAIM_TIMEOUT_MINUTES"])
+        if card_id is None:
+            return get_navbar(session, "<div><p>There are no cards left to annotate</p></div>")
+        return redirect(f"/annotate/{card_id}")
+
+    @app.route('/annotate/<int:card_id>/skip', methods=['POST'])
+    def skip_card_annotation(card_id):
+        if not session.get("authenticated", False):
+            return redirect("/login")
+        release_card_claim(session.get("username"), card_id)
+        return redirect("/annotate")
 
 
     @app.route('/annotate/<int:card_id>', methods=['POST', 'GET'])
@@ -61,9 +76,9 @@ def register_routes(app,config):
             return get_navbar(session, get_annotate_view(card_object))
 
         elif request.method == 'GET':
-            card_object = get_magic_card(card_id)
-            if card_object:
-                return get_navbar(session, get_annotate_view(card_object))
+            annotate_view = get_annotate_view_of_card(card_id)
+            if annotate_view:
+                return get_navbar(session, annotate_view)
             else:
                 return get_navbar(session, "<div><p>Card not found</p></div>")
         else:
@@ -78,10 +93,25 @@ def register_routes(app,config):
         page_content = get_feature_showcase()
         return get_navbar(session,page_content)
 
+    @app.route("/dashboard")
+    def dashboard():
+        if not session.get("authenticated", False):
+            return redirect("/login")
+        session["active_page"] = "dashboard"
+        return get_navbar(session, get_dashboard())
+
     @app.route("/health")
     def health():
         return {"status": "ok"}
 
+    @app.route("/metrics")
+    def metrics():
+        # Counters of this web worker only
+        return {"db_pool": get_db_pool_stats(),
+                "card_cache": app.config["CARD_CACHE"].stats(),
+                "annotate_view_cache": app.config["ANNOTATE_VIEW_CACHE"].stats(),
+                "search_result_cache": app.config["SEARCH_RESULT_CACHE"].stats()}
+
     @app.route("/logout")
     def logout():
         session.pop("authenticated", None)
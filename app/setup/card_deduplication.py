@@ -0,0 +1,95 @@
+import logging
+from collections import Counter
+
+# Which printing of a card is kept when the same card (same mcmMetaId) appears in several sets
+# first: the first printing found in the source file
+# newest: the printing of the set with the most recent release date
+# oracle_text: the first printing that has oracle text ("text" in the source file)
+DUPLICATE_POLICIES = ("first", "newest", "oracle_text")
+
+
+class CardDeduplicationIndex:
+    """
+    Hash index of the printings found in the source file, keyed by mcmMetaId.
+
+    Every lookup is a dictionary lookup, so deduplicating the whole source file is linear in the number of printings.
+    For the "first" policy only the ids are kept, for the other ones the card parsed from the winning printing is kept
+    until all the sets have been seen (not the source entry, so every printing is parsed once and the raw sets are
+    freed as they are read).
+    """
+
+    def __init__(self, policy="first"):
+        if policy not in DUPLICATE_POLICIES:
+            raise ValueError(f"Unknown duplicate policy '{policy}', use one of: " + ", ".join(DUPLICATE_POLICIES))
+        self.policy = policy
+        # mcmMetaId -> (set_code, release_date, whether the printing has oracle text, card parsed from it)
+        self.printings = {}
+        # set_code -> number of printings of that set dropped because they were duplicates
+        self.duplicates_per_set = Counter()
+
+    def __contains__(self, card_id):
+        return card_id in self.printings
+
+    def __len__(self):
+        return len(self.printings)
+
+    def would_keep(self, card_id, card_found, release_date=""):
+        """
+        :return: True if add would keep this printing for the card, without registering it
+        """
+        current = self.printings.get(card_id)
+        if current is None:
+            return True
+        current_set_code, current_release_date, current_has_text, current_card = current
+        return self._replaces(current_release_date, current_has_text, release_date, card_found)
+
+    def add(self, card_id, card_found, set_code, release_date="", card=None):
+        """
+        Registers one printing of a card.
+
+        :param card_id: the mcmMetaId of the card
+        :param card_found: dictionary of the card as it comes in the source file
+        :param set_code: code of the set the printing belongs to
+        :param release_date: release date of the set, ISO formatted so it can be compared as a string
+        :param card: the MagicCard parsed from the printing, returned by items if the printing is kept
+        :return: True if this printing is now the one kept for the card, False if it was dropped
+        """
+        has_text = bool(card_found.get("text"))
+        current = self.printings.get(card_id)
+        if current is None:
+            # With the "first" policy the printing never changes, so there is no need to keep the card
+            self.printings[card_id] = (set_code, release_date, has_text, None if self.policy == "first" else card)
+            return True
+
+        current_set_code, current_release_date, current_has_text, current_card = current
+        if self._replaces(current_release_date, current_has_text, release_date, card_found):
+            self.printings[card_id] = (set_code, release_date, has_text, card)
+            self.duplicates_per_set[current_set_code] += 1
+            return True
+
+        self.duplicates_per_set[set_code] += 1
+        return False
+
+    def _replaces(self, current_release_date, current_has_text, release_date, card_found):
+        if self.policy == "newest":
+            return release_date > current_release_date
+        if self.policy == "oracle_text":
+            return not current_has_text and bool(card_found.get("text"))
+        return False
+
+    def items(self):
+        """
+        Yields (card_id, card) of the printings kept, in the order the cards were first found.
+        Not available for the "first" policy, the cards are not stored for it.
+        """
+        if self.policy == "first":
+            raise ValueError("The \"first\" duplicate policy does not keep the cards.")
+        for card_id, (set_code, release_date, has_text, card) in self.printings.items():
+            yield card_id, card
+
+    def log_report(self):
+        total_duplicates = sum(self.duplicates_per_set.values())
+        logging.info(f"Deduplication with the \"{self.policy}\" policy kept {len(self.printings)} cards and "
+                     f"collapsed {total_duplicates} duplicated printings.")
+        for set_code, number_of_duplicates in self.duplicates_per_set.most_common():
+            logging.debug(f"The set {set_code} collapsed {number_of_duplicates} duplicated printings.")
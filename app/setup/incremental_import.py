@@ -0,0 +1,102 @@
+import hashlib
+import json
+import logging
+import time
+from app.classes.feature_matrix import CardFeatureMatrix
+from app.db.db_cards import get_loaded_card_changes, update_magic_cards_source_data_bulk
+from app.db.db_set_manifest import get_set_manifest, save_set_manifest
+from app.setup.parse_card_data import iter_json_sets, iter_cards_of_sets
+from app.setup.vectorize_cards import (vectorize_card_data, vectorize_additional_cards, get_feature_matrix_path,
+                                       get_output_vector)
+
+
+def get_set_content_hash(set_dict) -> str:
+    """
+    Hash of the content of a set of the source file, it changes if any card of the set changes.
+    """
+    return hashlib.sha256(json.dumps(set_dict, sort_keys=True, separators=(",", ":")).encode("utf8")).hexdigest()
+
+
+def iter_sets_marking_changes(json_data_filepath, set_manifest, changed_set_entries, changed_set_codes):
+    """
+    Yields every (set_code, set_dict) of the source file. Before yielding a set that is new or whose content changed
+    since it was imported, adds its code to changed_set_codes and appends (set_code, content_hash, number_of_cards) to
+    changed_set_entries.
+    """
+    number_of_sets_unchanged = 0
+    for set_code, set_dict in iter_json_sets(json_data_filepath):
+        content_hash = get_set_content_hash(set_dict)
+        if set_manifest.get(set_code) == content_hash:
+            number_of_sets_unchanged += 1
+        else:
+            changed_set_codes.add(set_code)
+            changed_set_entries.append((set_code, content_hash, len(set_dict.get("cards", []))))
+        yield set_code, set_dict
+    logging.info(f"Skipped {number_of_sets_unchanged} sets that were already imported and didn't change.")
+
+
+def import_new_cards(config, load_cards, extend_vocabulary=False):
+    """
+    Incremental import: only the sets that are new or changed since the last import are converted into cards. The
+    cards whose id is not in the cards table yet are vectorized and loaded, and the cards already in the database whose
+    source data changed (errata) are vectorized again and updated, keeping their annotations.
+
+    The unchanged sets are read too, only for the deduplication: a card of a changed set is imported only if the
+    duplicate policy keeps that printing over all the sets, as a full import would, so a reprint in a new set doesn't
+    overwrite the printing already loaded unless the policy prefers it.
+
+    :param config: configparser object
+    :param load_cards: callable that receives the list of new vectorized cards and sends them to the database, it has
+    to raise if the cards were not loaded
+    :param extend_vocabulary: if True the new categories and words are appended to the feature vocabulary
+    :return: number of cards loaded or updated
+    """
+    start_time = time.perf_counter()
+    json_data_filepath = config["source_data"]["json_data_filepath"]
+    duplicate_policy = config.get("source_data", "duplicate_policy", fallback="first")
+    set_manifest = get_set_manifest(config)
+
+    changed_set_entries = []
+    changed_set_codes = set()
+    cards_of_changed_sets = list(iter_cards_of_sets(iter_sets_marking_changes(json_data_filepath, set_manifest,
+                                                                              changed_set_entries, changed_set_codes),
+                                                    duplicate_policy, changed_set_codes))
+    loaded_card_ids, changed_card_ids = get_loaded_card_changes(config, cards_of_changed_sets)
+    # The source file has the ids as strings
+    new_cards = [card for card in cards_of_changed_sets if int(card.id) not in loaded_card_ids]
+    changed_cards = [card for card in cards_of_changed_sets if int(card.id) in changed_card_ids]
+    logging.info(f"Found {len(changed_set_entries)} new or changed sets with {len(new_cards)} new cards and "
+                 f"{len(changed_cards)} changed cards.")
+
+    if new_cards or changed_cards:
+        feature_matrix_path = get_feature_matrix_path(config)
+        if not (feature_matrix_path / "shape.json").exists():
+            # Nothing was vectorized yet, this is the first import
+            vectorize_card_data(new_cards + changed_cards, config, "extend" if extend_vocabulary else "frozen")
+        else:
+            # The cards vectorized by an import that failed before loading them keep their feature rows
+            existing_matrix = CardFeatureMatrix.load(feature_matrix_path, memory_map=True)
+            output_vector = get_output_vector(config)
+            cards_to_vectorize = []
+            for card in new_cards:
+                feature_row = existing_matrix.row_of_card_id(card.id)
+                if feature_row is None:
+                    cards_to_vectorize.append(card)
+                else:
+                    card.update_vectors(feature_row, output_vector)
+            # The features of the changed cards changed, they get a new row
+            cards_to_vectorize.extend(changed_cards)
+            if cards_to_vectorize:
+                vectorize_additional_cards(cards_to_vectorize, config, extend_vocabulary)
+        if new_cards:
+            load_cards(new_cards)
+        if changed_cards:
+            update_magic_cards_source_data_bulk(config, changed_cards)
+
+    # Only once the cards are in the database, so a failed import processes the same sets again
+    if changed_set_entries:
+        save_set_manifest(config, changed_set_entries)
+    number_of_cards_imported = len(new_cards) + len(changed_cards)
+    logging.info(f"Incremental import of {number_of_cards_imported} cards done in "
+                 f"{time.perf_counter() - start_time:.2f} seconds.")
+    return number_of_cards_imported
@@ -2,17 +2,24 @@ import configparser
 import logging
 import os
 import sys
-from app.setup.vectorize_cards import vectorize_card_data
+from app.setup.vectorize_cards import vectorize_card_data, vectorize_card_stream, STREAMING_BATCH_SIZE, VOCABULARY_MODES
 import pickle
-from app.db.db_cards import insert_magic_cards_bulk
+from app.db.db_cards import insert_magic_cards_bulk, INSERT_BULK_BATCH_SIZE
+from app.db.db_copy_loader import copy_magic_cards_bulk, COPY_BATCH_SIZE, DEFAULT_LOAD_NAME
 from app.db.db_initialization import initialize_db
-from app.setup.parse_card_data import retrieve_source_json_data
+from app.db.db_annotation_queue import refresh_annotation_queue
+from app.setup.parse_card_data import retrieve_source_json_data, iter_source_json_data
+from app.setup.pipelined_import import import_card_data_pipelined
+from app.setup.incremental_import import import_new_cards
 import argparse
 import logging
 from pathlib import Path
 from typing import Optional,Literal
 
 
+# copy: COPY FROM STDIN, one commit per batch and resumable; execute_values: INSERT ... VALUES, one commit at the end
+CARD_LOADERS = ("copy", "execute_values")
+
 STAGE_TO_FILENAME_MAPPING = {"dev":"config_dev.ini",
                              "DEV":"config_dev.ini",
                              "test":"config_test.ini",
@@ -46,7 +53,9 @@ def get_config_path(filename: str = "config.ini") -> Optional[Path]:
 
 
 
-def initialize_mtg_archetype_predictor(config_file_path,hard_reset: bool) -> None:
+def initialize_mtg_archetype_predictor(config_file_path,hard_reset: bool, streaming: bool = False,
+                                       vocabulary_mode: str = "frozen", loader: str = "copy",
+                                       pipelined: bool = False, incremental: bool = False) -> None:
     # Read Config file
     config = configparser.ConfigParser()
     config.read(config_file_path)
@@ -56,12 +65,56 @@ def initialize_mtg_archetype_predictor(config_file_path,hard_reset: bool) -> Non
         raise Exception("Something went wrong while initializing the database.")
     # Load the DB with the card data, that contains some card metadata and the MagicCard classes and its vector data for
     # the machine learning model
-    logging.debug("Parsing card data from source file")
-    card_list = retrieve_source_json_data(config["source_data"]["json_data_filepath"])
-    logging.debug("Vectorizing card data obtained")
-    card_list = vectorize_card_data(card_list,config)
-    logging.debug("Loading the whole card data in the db")
-    insert_magic_cards_bulk(config,card_list)
+    if incremental:
+        import_new_cards(config, lambda cards: load_cards(config, cards, loader, load_name="incremental", resume=False),
+                         extend_vocabulary=vocabulary_mode == "extend")
+    elif pipelined:
+        import_card_data_pipelined(config, lambda cards: load_cards(config, cards, loader), vocabulary_mode)
+    elif streaming:
+        load_card_data_streaming(config, vocabulary_mode, loader)
+    else:
+        logging.debug("Parsing card data from source file")
+        card_list = retrieve_source_json_data(config["source_data"]["json_data_filepath"],
+                                              config.get("source_data", "duplicate_policy", fallback="first"))
+        logging.debug("Vectorizing card data obtained")
+        card_list = vectorize_card_data(card_list,config,vocabulary_mode)
+        logging.debug("Loading the whole card data in the db")
+        load_cards(config, card_list, loader)
+    # The new cards can be annotated before the first model scores them
+    refresh_annotation_queue(config, config.get("annotation_queue", "strategy", fallback="uncertainty"))
+
+
+def load_cards(config, cards, loader: str = "copy", batch_size: Optional[int] = None,
+               load_name: str = DEFAULT_LOAD_NAME, resume: bool = True) -> None:
+    """
+    Sends the cards to the database with the loader chosen, one of CARD_LOADERS.
+    The batch size of the copy loader is [source_data] copy_batch_size.
+    """
+    if loader == "copy":
+        copy_magic_cards_bulk(config, cards,
+                              config.getint("source_data", "copy_batch_size", fallback=batch_size or COPY_BATCH_SIZE),
+                              load_name, resume)
+    else:
+        insert_magic_cards_bulk(config, cards, batch_size or INSERT_BULK_BATCH_SIZE)
+
+
+def load_card_data_streaming(config, vocabulary_mode: str = "frozen", loader: str = "copy") -> None:
+    """
+    Same as the load done in initialize_mtg_archetype_predictor, but the source file is parsed set by set and the
+    cards flow from the parser to the vectorizer and to the database in batches, the whole card list is never in
+    memory.
+
+    :param config: configparser object
+    :param vocabulary_mode: one of VOCABULARY_MODES
+    :param loader: one of CARD_LOADERS
+    """
+    json_data_filepath = config["source_data"]["json_data_filepath"]
+    batch_size = config.getint("source_data", "streaming_batch_size", fallback=STREAMING_BATCH_SIZE)
+    duplicate_policy = config.get("source_data", "duplicate_policy", fallback="first")
+    logging.debug("Parsing, vectorizing and loading the card data in batches of " + str(batch_size) + " cards")
+    vectorized_cards = vectorize_card_stream(lambda: iter_source_json_data(json_data_filepath, duplicate_policy), config,
+                                             batch_size, vocabulary_mode)
+    load_cards(config, vectorized_cards, loader, batch_size)
 
 
 
@@ -91,13 +144,51 @@ def main():
         help='Deletes all tables for ever, be careful'
     )
 
+    parser.add_argument(
+        '--streaming',
+        action='store_true',
+        help='Parses the source file set by set and loads the cards in batches, uses bounded memory'
+    )
+
+    parser.add_argument(
+        '--pipelined',
+        action='store_true',
+        help='Parses, vectorizes and loads the cards at the same time in separate stages connected by bounded queues, '
+             'logs the time every stage spends working and waiting'
+    )
+
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Only imports the sets that are new or changed since the last import: loads the cards that are not in '
+             'the database yet and updates the ones whose source data changed (errata), keeping their annotations '
+             '(use --vocabulary extend to add their new words to the features)'
+    )
+
+    parser.add_argument(
+        '--vocabulary',
+        default="frozen",
+        choices=VOCABULARY_MODES,
+        help='frozen: vectorize with the saved feature vocabulary (built if there is none), extend: append the new '
+             'categories and words to it, rebuild: build a new one, this changes the feature layout (default: frozen)'
+    )
+
+    parser.add_argument(
+        '--loader',
+        default="copy",
+        choices=CARD_LOADERS,
+        help='copy: loads the cards with COPY, committing every batch, a failed load is resumed by running it again, '
+             'execute_values: loads them with INSERT statements in a single transaction (default: copy)'
+    )
+
     args = parser.parse_args()
 
     # --- Logging Configuration ---
     logging.basicConfig(stream=sys.stdout, level=getattr(logging, args.log_level.upper()), format='%(asctime)s %(message)s',datefmt='%m/%d/%Y %I:%M:%S %p')
     if args.hard_reset:
         logging.warning(f"Be careful, you are doing a hard reset, you are deleting all your cards,users,everything")
-    initialize_mtg_archetype_predictor(args.config,args.hard_reset)
+    initialize_mtg_archetype_predictor(args.config,args.hard_reset,args.streaming,args.vocabulary,args.loader,
+                                       args.pipelined,args.incremental)
 
 
 
@@ -3,6 +3,9 @@ import logging
 import sys
 import configparser
 from app.classes.card_object import MagicCard
+from app.setup.card_deduplication import CardDeduplicationIndex
+
+STREAMING_READ_CHUNK_SIZE = 1024 * 1024
 
 def read_json_file(file_path):
     with open(file_path, 'r', encoding="utf8") as file:
@@ -12,50 +15,256 @@ def read_json_file(file_path):
         dictionary = json.loads(data)
         return dictionary
 
-def retrieve_source_json_data(file_path):
+
+class _StreamingJsonReader:
+    """
+    Minimal incremental reader over a JSON file. It only keeps in memory the part of the file that has not been
+    decoded yet, so a big object can be walked entry by entry instead of loading the whole document at once.
+    """
+
+    def __init__(self, file, chunk_size=STREAMING_READ_CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.end_of_file = False
+
+    def _read_more(self, minimum_size=0):
+        chunk = self.file.read(max(self.chunk_size, minimum_size))
+        if not chunk:
+            self.end_of_file = True
+            return False
+        # Drop everything that was already decoded before growing the buffer
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def peek(self):
+        """
+        Skips whitespace and returns the next significant character without consuming it, "" at the end of the file.
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in " \t\n\r":
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._read_more():
+                return ""
+
+    def expect(self, character):
+        found = self.peek()
+        if found != character:
+            raise ValueError(f"Malformed JSON, expected '{character}' but found '{found}' at offset {self.position}.")
+        self.position += 1
+
+    def decode_value(self):
+        """
+        Decodes the next JSON value. When the value is not complete in the buffer yet, the buffer is grown
+        (doubling the read size so big values are not re-decoded too many times) and the decoding is retried.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # A number at the end of the buffer may still continue in the next chunk
+                if end < len(self.buffer) or self.end_of_file:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.end_of_file:
+                    raise
+            self._read_more(minimum_size=len(self.buffer) - self.position)
+
+    def iterate_object(self):
+        """
+        Yields (key, value) pairs of the JSON object that starts at the current position.
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.position += 1
+            return
+        while True:
+            key = self.decode_value()
+            self.expect(":")
+            yield key, self.decode_value()
+            if self.peek() == ",":
+                self.position += 1
+                continue
+            self.expect("}")
+            return
+
+    def iterate_object_of_key(self, wanted_key):
+        """
+        Walks the top level object skipping every entry until wanted_key is found, then yields the (key, value) pairs
+        of that entry one by one.
+        """
+        self.expect("{")
+        while self.peek() not in ("}", ""):
+            key = self.decode_value()
+            self.expect(":")
+            if key == wanted_key:
+                yield from self.iterate_object()
+                return
+            self.decode_value()
+            if self.peek() == ",":
+                self.position += 1
+        raise ValueError(f"The key '{wanted_key}' was not found in the file.")
+
+
+def iter_json_sets(file_path, chunk_size=STREAMING_READ_CHUNK_SIZE):
+    """
+    Streams the sets of an MTGJSON AllPrintings file. Only one set is decoded and kept in memory at a time.
+
+    :param file_path: path to the MTGJSON file
+    :param chunk_size: number of characters read from the file on every read
+    :return: generator of (set_code, set_dictionary)
+    """
+    with open(file_path, 'r', encoding="utf8") as file:
+        reader = _StreamingJsonReader(file, chunk_size)
+        if not reader.peek():
+            raise ValueError("The file is empty.")
+        yield from reader.iterate_object_of_key("data")
+
+
+def create_magic_card_from_source(card_found, card_id):
+    """
+    Creates a MagicCard from one card entry of the MTGJSON file.
+
+    :param card_found: dictionary of the card as it comes in the source file
+    :param card_id: the id given to the card, the mcmMetaId
+    :return: MagicCard
+    """
+    card_text = card_found.get("originalText","")
+    if not card_text:
+        card_text = str(card_found.get("text",""))
+    # The display_html is rendered later, in bulk, when the cards are stored
+    return MagicCard.create(
+        render_html=False,
+        id=card_id,
+        name=card_found.get("name",""),
+        color=card_found.get("colors",[]),
+        converted_mana_cost=int(card_found.get("convertedManaCost",0)),
+        mana_cost=normalize_curly_braces(card_found.get("manaCost","")),
+        card_type=card_found.get("types",[]),
+        power=ensure_int(card_found.get("power",0)),
+        toughness=ensure_int(card_found.get("toughness", 0)),
+        card_text=card_text,
+        subtypes=card_found.get("subtypes",[]),
+        mcm_meta_id=card_found.get("mcm_meta_id",0),
+        mtg_arena_id=card_found.get("identifiers", {}).get("mtgArenaId", 0),
+        super_types=card_found.get("supertypes", []),
+        tcg_player_link= card_found.get("links", {}).get("tcgplayer", ""),
+        card_market_link=card_found.get("links", {}).get("cardmarket", "")
+        )
+
+
+def iter_cards_of_sets(sets_iterable, duplicate_policy="first", imported_set_codes=None):
+    """
+    Converts the sets of the source file into MagicCard objects, set by set, skipping cards without mcmMetaId and
+    repeated printings of the same card.
+
+    With the "first" duplicate policy the cards are yielded as soon as they are found. With the other policies a later
+    printing can replace an earlier one, so the cards are yielded once all the sets have been read.
+
+    :param sets_iterable: iterable of (set_code, set_dictionary)
+    :param duplicate_policy: one of card_deduplication.DUPLICATE_POLICIES
+    :param imported_set_codes: if given, only the printings of these sets are converted into cards. The printings of
+    the other sets are only registered in the deduplication, without being parsed, so a card is only yielded if the
+    printing a full import would keep for it belongs to one of these sets. It is checked when a set is read, the
+    caller can fill it while the sets are iterated
+    :return: generator of MagicCard
+    """
+    deduplication_index = CardDeduplicationIndex(duplicate_policy)
+    for key1, value1 in sets_iterable:
+        release_date = value1.get("releaseDate", "")
+        is_imported_set = imported_set_codes is None or key1 in imported_set_codes
+        for card_found in value1["cards"]:
+            if "mcmMetaId" not in card_found["identifiers"]:
+                continue
+            current_mcm_meta_id = card_found.get("identifiers", {}).get("mcmMetaId", "")
+            if not current_mcm_meta_id:
+                continue
+            if not is_imported_set or not deduplication_index.would_keep(current_mcm_meta_id, card_found,
+                                                                         release_date):
+                # Counted as a duplicate of the printing kept, or kept without a card if it is not imported
+                deduplication_index.add(current_mcm_meta_id, card_found, key1, release_date)
+                continue
+            # A printing is only registered once it parses, so a broken printing doesn't hide the valid ones after it
+            new_card = parse_source_card(card_found, current_mcm_meta_id)
+            if new_card is None:
+                continue
+            deduplication_index.add(current_mcm_meta_id, card_found, key1, release_date, new_card)
+            if duplicate_policy == "first":
+                yield new_card
+
+    if duplicate_policy != "first":
+        for current_mcm_meta_id, new_card in deduplication_index.items():
+            if new_card is not None:
+                yield new_card
+    deduplication_index.log_report()
+
+
+def parse_source_card(card_found, card_id):
+    """
+    create_magic_card_from_source that logs and returns None when the entry can't be parsed.
+    """
+    try:
+        return create_magic_card_from_source(card_found, card_id)
+    except Exception as e:
+        logging.warning("An error happened while trying to parse the source data, we couldn't parse the following entry:\n" + str(
+                card_found) + "\n" + "Receives the following error message:\n" + str(e))
+        return None
+
+
+def iter_source_json_data(file_path, duplicate_policy="first"):
+    """
+    Streaming version of retrieve_source_json_data, the source file is decoded set by set and the cards are yielded
+    as soon as they are created, so the memory needed does not depend on the size of the file.
+
+    :param file_path: path to the MTGJSON file
+    :param duplicate_policy: which printing is kept for repeated cards, see card_deduplication.DUPLICATE_POLICIES
+    :return: generator of MagicCard
+    :raise ValueError: if the file is truncated or not valid, or the duplicate policy is unknown. The cards already
+    yielded are not enough to be a complete import, so the error is not swallowed
+    """
+    number_of_cards_found = 0
+    try:
+        for card in iter_cards_of_sets(iter_json_sets(file_path), duplicate_policy):
+            number_of_cards_found += 1
+            yield card
+    except ValueError as e:
+        logging.error(f"The file {file_path} couldn't be read after {number_of_cards_found} cards because of the "
+                      f"following error:\n" + str(e))
+        raise
+    logging.info(f"In the file {file_path} we found " + str(number_of_cards_found) + " cards.")
+
+
+def iter_card_batches(cards, batch_size):
+    """
+    Groups an iterable of cards in lists of at most batch_size cards.
+
+    :param cards: iterable of MagicCard
+    :param batch_size: maximum number of cards per batch
+    :return: generator of lists of MagicCard
+    """
+    batch = []
+    for card in cards:
+        batch.append(card)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def retrieve_source_json_data(file_path, duplicate_policy="first"):
     try:
         card_dictionary = read_json_file(file_path)
     except ValueError as e:
         logging.error(f"The file {file_path} couldn't be opened because of the following error:\n" + str(e))
         return []
-    card_data = []
-    mcm_meta_ids_found_list = []
-    for key1, value1 in card_dictionary["data"].items():
-        for card_found in value1["cards"]:
-            if "mcmMetaId" not in card_found["identifiers"]:
-                continue
-            try:
-                current_mcm_meta_id = card_found.get("identifiers", {}).get("mcmMetaId", "")
-                if not current_mcm_meta_id:
-                    continue
-                card_text = card_found.get("originalText","")
-                if not card_text:
-                    card_text = str(card_found.get("text",""))
-                if current_mcm_meta_id not in mcm_meta_ids_found_list:
-                    new_card = MagicCard.create(
-                        id=current_mcm_meta_id,
-                        name=card_found.get("name",""),
-                        color=card_found.get("colors",[]),
-                        converted_mana_cost=int(card_found.get("convertedManaCost",0)),
-                        mana_cost=normalize_curly_braces(card_found.get("manaCost","")),
-                        card_type=card_found.get("types",[]),
-                        power=ensure_int(card_found.get("power",0)),
-                        toughness=ensure_int(card_found.get("toughness", 0)),
-                        card_text=card_text,
-                        subtypes=card_found.get("subtypes",[]),
-                        mcm_meta_id=card_found.get("mcm_meta_id",0),
-                        mtg_arena_id=card_found.get("identifiers", {}).get("mtgArenaId", 0),
-                        super_types=card_found.get("supertypes", []),
-                        tcg_player_link= card_found.get("links", {}).get("tcgplayer", ""),
-                        card_market_link=card_found.get("links", {}).get("cardmarket", "")
-                        )
-
-                    card_data.append(new_card)
-                    mcm_meta_ids_found_list.append(current_mcm_meta_id)
-
-            except Exception as e:
-                logging.warning("An error happened while trying to parse the source data, we couldn't parse the following entry:\n" + str(
-                        card_found) + "\n" + "Receives the following error message:\n" + str(e))
+    card_data = list(iter_cards_of_sets(card_dictionary["data"].items(), duplicate_policy))
 
     number_of_cards_found = len(card_data)
     logging.info(f"In the file {file_path} we found " + str(number_of_cards_found) + " cards.")
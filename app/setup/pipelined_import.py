@@ -0,0 +1,236 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from app.classes.feature_matrix import CardFeatureMatrixBuilder
+from app.setup.parse_card_data import iter_source_json_data, iter_card_batches
+from app.setup.vectorize_cards import (prepare_feature_vocabulary, get_number_of_cpu_cores, get_feature_executor,
+                                       get_output_vector, get_feature_matrix_path, get_card_feature_fields,
+                                       get_card_feature_rows, add_card_feature_rows, STREAMING_BATCH_SIZE)
+
+PIPELINE_QUEUE_SIZE = 4
+# Put on a queue after the last batch
+_END_OF_STREAM = object()
+
+
+class PipelineStageTimer:
+    """
+    Time a stage of the pipeline spends working and waiting for the stage before it (input) or after it (output).
+    A stage that is mostly waiting for input is not the bottleneck, the one that is mostly working is.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.number_of_cards = 0
+        self.working_seconds = 0.0
+        self.input_wait_seconds = 0.0
+        self.output_wait_seconds = 0.0
+
+    def log_report(self):
+        total_seconds = self.working_seconds + self.input_wait_seconds + self.output_wait_seconds
+        logging.info(f"Stage {self.name}: {self.number_of_cards} cards, working {self.working_seconds:.2f} s, "
+                     f"waiting for input {self.input_wait_seconds:.2f} s, waiting for output "
+                     f"{self.output_wait_seconds:.2f} s ({self.number_of_cards / max(self.working_seconds, 1e-9):.0f} "
+                     f"cards per working second, busy {100 * self.working_seconds / max(total_seconds, 1e-9):.0f}%)")
+
+
+class _PipelineAborted(Exception):
+    pass
+
+
+class CardImportPipeline:
+    """
+    Import with overlapping stages: a parser thread, a vectorizer thread that keeps several batches in the worker
+    processes at the same time, and the database writer in the calling thread. The stages are connected by queues of
+    at most queue_size batches, so the memory used does not depend on the size of the source file.
+    """
+
+    def __init__(self, config, vocabulary, batch_size=STREAMING_BATCH_SIZE, queue_size=PIPELINE_QUEUE_SIZE):
+        self.config = config
+        self.vocabulary = vocabulary
+        self.batch_size = batch_size
+        self.number_of_cpu_cores = get_number_of_cpu_cores(config)
+        self.parsed_batches = queue.Queue(maxsize=queue_size)
+        self.vectorized_batches = queue.Queue(maxsize=queue_size)
+        self.parser_timer = PipelineStageTimer("parse")
+        self.vectorizer_timer = PipelineStageTimer("vectorize")
+        self.writer_timer = PipelineStageTimer("load")
+        self.matrix_builder = CardFeatureMatrixBuilder(len(vocabulary), vocabulary=vocabulary)
+        self._stop = threading.Event()
+        self._errors = []
+
+    def _put(self, batch_queue, item, timer):
+        start_time = time.perf_counter()
+        while True:
+            if self._stop.is_set():
+                raise _PipelineAborted()
+            try:
+                batch_queue.put(item, timeout=0.5)
+                break
+            except queue.Full:
+                continue
+        timer.output_wait_seconds += time.perf_counter() - start_time
+
+    def _get(self, batch_queue, timer):
+        start_time = time.perf_counter()
+        while True:
+            if self._stop.is_set():
+                raise _PipelineAborted()
+            try:
+                item = batch_queue.get(timeout=0.5)
+                break
+            except queue.Empty:
+                continue
+        timer.input_wait_seconds += time.perf_counter() - start_time
+        return item
+
+    def _run_stage(self, stage):
+        try:
+            stage()
+        except _PipelineAborted:
+            pass
+        except Exception as e:
+            logging.error(f"The import pipeline stopped because of an error: {e}")
+            self._errors.append(e)
+            self._stop.set()
+
+    def _parse(self):
+        json_data_filepath = self.config["source_data"]["json_data_filepath"]
+        duplicate_policy = self.config.get("source_data", "duplicate_policy", fallback="first")
+        card_batches = iter_card_batches(iter_source_json_data(json_data_filepath, duplicate_policy), self.batch_size)
+        while True:
+            start_time = time.perf_counter()
+            card_batch = next(card_batches, None)
+            self.parser_timer.working_seconds += time.perf_counter() - start_time
+            if card_batch is None:
+                break
+            self.parser_timer.number_of_cards += len(card_batch)
+            self._put(self.parsed_batches, card_batch, self.parser_timer)
+        self._put(self.parsed_batches, _END_OF_STREAM, self.parser_timer)
+
+    def _vectorize(self):
+        output_vector = get_output_vector(self.config)
+        # Batches in the worker processes, the oldest first so the rows are added in the order the cards came
+        batches_in_flight = deque()
+
+        def finish_oldest_batch():
+            card_batch, feature_rows_future = batches_in_flight.popleft()
+            feature_rows = feature_rows_future.result()
+            start_time = time.perf_counter()
+            add_card_feature_rows(card_batch, feature_rows, self.matrix_builder, output_vector)
+            self.vectorizer_timer.working_seconds += time.perf_counter() - start_time
+            self.vectorizer_timer.number_of_cards += len(card_batch)
+            self._put(self.vectorized_batches, card_batch, self.vectorizer_timer)
+
+        with get_feature_executor(self.number_of_cpu_cores, self.vocabulary) as executor:
+            while True:
+                card_batch = self._get(self.parsed_batches, self.vectorizer_timer)
+                if card_batch is _END_OF_STREAM:
+                    break
+                start_time = time.perf_counter()
+                card_fields_list = [get_card_feature_fields(card) for card in card_batch]
+                # The batch is split so every worker process gets a part of it
+                chunk_size = max(1, len(card_fields_list) // self.number_of_cpu_cores)
+                chunk_futures = [executor.submit(get_card_feature_rows, card_fields_list[first:first + chunk_size])
+                                 for first in range(0, len(card_fields_list), chunk_size)]
+                batches_in_flight.append((card_batch, _ChunkedResult(chunk_futures)))
+                self.vectorizer_timer.working_seconds += time.perf_counter() - start_time
+                # Enough batches to keep all the workers busy while the oldest one is finished
+                while len(batches_in_flight) > 1 and batches_in_flight[0][1].done():
+                    finish_oldest_batch()
+                if len(batches_in_flight) > 2:
+                    start_time = time.perf_counter()
+                    batches_in_flight[0][1].wait()
+                    self.vectorizer_timer.working_seconds += time.perf_counter() - start_time
+                    finish_oldest_batch()
+            while batches_in_flight:
+                start_time = time.perf_counter()
+                batches_in_flight[0][1].wait()
+                self.vectorizer_timer.working_seconds += time.perf_counter() - start_time
+                finish_oldest_batch()
+        self._put(self.vectorized_batches, _END_OF_STREAM, self.vectorizer_timer)
+
+    def _iter_vectorized_cards(self):
+        while True:
+            card_batch = self._get(self.vectorized_batches, self.writer_timer)
+            if card_batch is _END_OF_STREAM:
+                return
+            self.writer_timer.number_of_cards += len(card_batch)
+            yield from card_batch
+
+    def run(self, load_cards):
+        """
+        Runs the pipeline until the whole source file is loaded.
+
+        :param load_cards: callable that receives the iterable of vectorized cards and sends them to the database,
+        e.g. lambda cards: copy_magic_cards_bulk(config, cards)
+        :return: the CardFeatureMatrix of the cards loaded, already saved
+        """
+        start_time = time.perf_counter()
+        stage_threads = [threading.Thread(target=self._run_stage, args=(self._parse,), name="import-parse", daemon=True),
+                         threading.Thread(target=self._run_stage, args=(self._vectorize,), name="import-vectorize", daemon=True)]
+        for stage_thread in stage_threads:
+            stage_thread.start()
+
+        def load():
+            load_start_time = time.perf_counter()
+            load_cards(self._iter_vectorized_cards())
+            self.writer_timer.working_seconds += (time.perf_counter() - load_start_time
+                                                  - self.writer_timer.input_wait_seconds)
+
+        self._run_stage(load)
+        if not self._errors and self.writer_timer.number_of_cards < self.vectorizer_timer.number_of_cards:
+            self._errors.append(RuntimeError("The cards were not all loaded in the database."))
+        self._stop.set()
+        for stage_thread in stage_threads:
+            stage_thread.join()
+        if self._errors:
+            raise self._errors[0]
+
+        feature_matrix = self.matrix_builder.build()
+        feature_matrix.save(get_feature_matrix_path(self.config))
+        for timer in (self.parser_timer, self.vectorizer_timer, self.writer_timer):
+            timer.log_report()
+        logging.info(f"Imported {self.writer_timer.number_of_cards} cards in "
+                     f"{time.perf_counter() - start_time:.2f} seconds with the pipelined import.")
+        return feature_matrix
+
+
+class _ChunkedResult:
+    """
+    The futures of the chunks of a batch, seen as one result in the order of the chunks.
+    """
+
+    def __init__(self, futures):
+        self.futures = futures
+
+    def done(self):
+        return all(future.done() for future in self.futures)
+
+    def wait(self):
+        for future in self.futures:
+            future.exception()
+
+    def result(self):
+        return [feature_row for future in self.futures for feature_row in future.result()]
+
+
+def import_card_data_pipelined(config, load_cards, vocabulary_mode="frozen"):
+    """
+    Parses, vectorizes and loads the source file with a CardImportPipeline. The vocabulary is prepared first (with a
+    pass over the source file if it has to be built or extended).
+
+    :param config: configparser object
+    :param load_cards: callable that receives the iterable of vectorized cards and sends them to the database
+    :param vocabulary_mode: one of VOCABULARY_MODES
+    :return: the CardFeatureMatrix of the cards loaded
+    """
+    json_data_filepath = config["source_data"]["json_data_filepath"]
+    duplicate_policy = config.get("source_data", "duplicate_policy", fallback="first")
+    vocabulary = prepare_feature_vocabulary(lambda: iter_source_json_data(json_data_filepath, duplicate_policy), config,
+                                            get_number_of_cpu_cores(config), vocabulary_mode)
+    pipeline = CardImportPipeline(config, vocabulary,
+                                  batch_size=config.getint("source_data", "streaming_batch_size", fallback=STREAMING_BATCH_SIZE),
+                                  queue_size=config.getint("source_data", "pipeline_queue_size", fallback=PIPELINE_QUEUE_SIZE))
+    return pipeline.run(load_cards)
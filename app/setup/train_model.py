@@ -0,0 +1,241 @@
+import argparse
+import configparser
+import logging
+import shutil
+import sys
+import time
+from pathlib import Path
+import numpy as np
+import psycopg2
+
+from app.classes.feature_matrix import CardFeatureMatrix, FeatureVocabulary
+from app.setup.vectorize_cards import get_feature_matrix_path, get_vocabulary_path
+
+DB_FETCH_SIZE = 2000
+SHUFFLE_BUFFER_SIZE = 8192
+DEFAULT_HIDDEN_UNITS = 64
+DEFAULT_EPOCHS = 20
+DEFAULT_BATCH_SIZE = 256
+DEFAULT_LEARNING_RATE = 0.001
+
+
+def iter_annotated_cards(config, fetch_size=DB_FETCH_SIZE):
+    """
+    Streams the annotated cards from the cards table with a server side cursor, only fetch_size rows are in memory at
+    a time and the pickled magic_card_object is never read.
+    The gold standard archetypes are used when a card has them, the annotated archetypes otherwise.
+
+    :param config: configparser object
+    :param fetch_size: number of rows fetched from the server at a time
+    :return: generator of (card_id, list of archetypes)
+    """
+    conn = psycopg2.connect(dbname=config["postgresql"]["database"],
+                            user=config["database_user"]["user"],
+                            password=config["database_user"]["password"],
+                            host=config["postgresql"]["host"],
+                            port=config["postgresql"]["port"])
+    try:
+        # A named cursor is a server side cursor
+        with conn.cursor(name="annotated_cards_for_training") as cur:
+            cur.itersize = fetch_size
+            cur.execute("""
+                SELECT id, annotated_archetypes, gold_standard_archetypes
+                FROM cards
+                WHERE cardinality(annotated_archetypes) > 0 OR cardinality(gold_standard_archetypes) > 0
+                ORDER BY id
+            """)
+            for card_id, annotated_archetypes, gold_standard_archetypes in cur:
+                yield card_id, gold_standard_archetypes or annotated_archetypes
+    finally:
+        conn.close()
+
+
+def iter_training_batches(config, matrix, archetype_labels, batch_size, rng, shuffle_buffer_size=SHUFFLE_BUFFER_SIZE):
+    """
+    Mini-batches of (feature rows, label matrix) built from the stream of annotated cards. The cards are shuffled
+    inside a buffer of shuffle_buffer_size cards, so the memory used does not depend on the number of annotations.
+    """
+    archetype_columns = {archetype: column for column, archetype in enumerate(archetype_labels)}
+
+    def shuffled_batches(buffer):
+        order = rng.permutation(len(buffer))
+        for first in range(0, len(buffer), batch_size):
+            batch = [buffer[position] for position in order[first:first + batch_size]]
+            labels = np.zeros((len(batch), len(archetype_labels)), dtype=np.float32)
+            for position, (row, archetype_columns_of_card) in enumerate(batch):
+                labels[position, archetype_columns_of_card] = 1
+            yield [row for row, archetype_columns_of_card in batch], labels
+
+    buffer = []
+    for card_id, archetypes in iter_annotated_cards(config):
+        row = matrix.row_of_card_id(card_id)
+        if row is None:
+            continue
+        buffer.append((row, [archetype_columns[archetype] for archetype in archetypes if archetype in archetype_columns]))
+        if len(buffer) >= shuffle_buffer_size:
+            yield from shuffled_batches(buffer)
+            buffer = []
+    if buffer:
+        yield from shuffled_batches(buffer)
+
+
+def get_input_scale(matrix, number_of_features):
+    """
+    1 / maximum absolute value of every column, so the numeric features (mana cost, power...) are in [0, 1] as the
+    binary ones.
+    """
+    max_abs_value = np.zeros(number_of_features, dtype=np.float32)
+    known_columns = np.asarray(matrix.indices) < number_of_features
+    np.maximum.at(max_abs_value, np.asarray(matrix.indices)[known_columns], np.abs(np.asarray(matrix.data)[known_columns]))
+    return (1.0 / np.where(max_abs_value > 0, max_abs_value, 1.0)).astype(np.float32)
+
+
+class AdamOptimizer:
+    def __init__(self, parameters, learning_rate, beta1=0.9, beta2=0.999, epsilon=1e-8):
+        self.parameters = parameters
+        self.learning_rate = learning_rate
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+        self.first_moments = {name: np.zeros_like(value) for name, value in parameters.items()}
+        self.second_moments = {name: np.zeros_like(value) for name, value in parameters.items()}
+        self.step_number = 0
+
+    def step(self, gradients):
+        self.step_number += 1
+        for name, gradient in gradients.items():
+            self.first_moments[name] = self.beta1 * self.first_moments[name] + (1 - self.beta1) * gradient
+            self.second_moments[name] = self.beta2 * self.second_moments[name] + (1 - self.beta2) * gradient ** 2
+            first_moment = self.first_moments[name] / (1 - self.beta1 ** self.step_number)
+            second_moment = self.second_moments[name] / (1 - self.beta2 ** self.step_number)
+            self.parameters[name] -= self.learning_rate * first_moment / (np.sqrt(second_moment) + self.epsilon)
+
+
+def train_step(parameters, optimizer, inputs, labels):
+    """
+    One mini-batch of the same network ArchetypeModel evaluates, with binary cross entropy loss.
+
+    :return: mean loss of the batch
+    """
+    hidden_pre_activation = inputs @ parameters["W1"] + parameters["b1"]
+    hidden = np.maximum(hidden_pre_activation, 0)
+    logits = hidden @ parameters["W2"] + parameters["b2"]
+    probabilities = 1.0 / (1.0 + np.exp(-logits))
+
+    epsilon = 1e-7
+    loss = -np.mean(labels * np.log(probabilities + epsilon) + (1 - labels) * np.log(1 - probabilities + epsilon))
+
+    logits_gradient = (probabilities - labels) / labels.size
+    hidden_gradient = (logits_gradient @ parameters["W2"].T) * (hidden_pre_activation > 0)
+    optimizer.step({"W2": hidden.T @ logits_gradient,
+                    "b2": logits_gradient.sum(axis=0),
+                    "W1": inputs.T @ hidden_gradient,
+                    "b1": hidden_gradient.sum(axis=0)})
+    return float(loss)
+
+
+def get_next_model_path(weights_directory: Path) -> Path:
+    """
+    archetype_model_v<N>.npz with N one more than the last version saved in the folder.
+    """
+    versions = [int(path.stem.rsplit("_v", 1)[1]) for path in weights_directory.glob("archetype_model_v*.npz")
+                if path.stem.rsplit("_v", 1)[1].isdigit()]
+    return weights_directory / f"archetype_model_v{max(versions, default=0) + 1}.npz"
+
+
+def train_archetype_model(config, epochs=DEFAULT_EPOCHS, batch_size=DEFAULT_BATCH_SIZE,
+                          learning_rate=DEFAULT_LEARNING_RATE, hidden_units=DEFAULT_HIDDEN_UNITS, seed=0):
+    """
+    Trains the multi-label archetype model with the annotated cards and saves a new version of the weights.
+
+    :param config: configparser object
+    :return: path of the weights saved
+    """
+    matrix = CardFeatureMatrix.load(get_feature_matrix_path(config), memory_map=True)
+    vocabulary = FeatureVocabulary.load(get_vocabulary_path(config))
+    archetype_labels = config["fixed_data"]["archetypes"].split(",")
+    number_of_features = matrix.number_of_columns
+    input_scale = get_input_scale(matrix, number_of_features)
+
+    rng = np.random.default_rng(seed)
+    parameters = {"W1": (rng.standard_normal((number_of_features, hidden_units)) * np.sqrt(2.0 / number_of_features)).astype(np.float32),
+                  "b1": np.zeros(hidden_units, dtype=np.float32),
+                  "W2": (rng.standard_normal((hidden_units, len(archetype_labels))) * np.sqrt(2.0 / hidden_units)).astype(np.float32),
+                  "b2": np.zeros(len(archetype_labels), dtype=np.float32)}
+    optimizer = AdamOptimizer(parameters, learning_rate)
+
+    for epoch in range(1, epochs + 1):
+        start_time = time.perf_counter()
+        total_loss = 0.0
+        number_of_cards = 0
+        number_of_batches = 0
+        for rows, labels in iter_training_batches(config, matrix, archetype_labels, batch_size, rng):
+            inputs = matrix.to_dense(rows) * input_scale
+            total_loss += train_step(parameters, optimizer, inputs, labels) * len(rows)
+            number_of_cards += len(rows)
+            number_of_batches += 1
+        elapsed_time = time.perf_counter() - start_time
+        if number_of_cards == 0:
+            logging.error("There are no annotated cards in the feature matrix to train the model with.")
+            return None
+        logging.info(f"Epoch {epoch}/{epochs}: loss {total_loss / number_of_cards:.4f}, {number_of_cards} cards in "
+                     f"{number_of_batches} batches, {elapsed_time:.2f} seconds "
+                     f"({number_of_cards / max(elapsed_time, 1e-9):.0f} cards per second)")
+
+    weights_directory = Path(config.get("model", "weights_directory",
+                                        fallback=str(Path(config["model"]["weights_filepath"]).parent)))
+    weights_directory.mkdir(parents=True, exist_ok=True)
+    model_path = get_next_model_path(weights_directory)
+    np.savez(model_path,
+             archetype_labels=np.array(archetype_labels),
+             input_scale=input_scale,
+             vocabulary_layout_id=np.array(matrix.vocabulary_layout_id),
+             vocabulary_version=np.array(vocabulary.version if vocabulary else matrix.vocabulary_version),
+             model_version=np.array(model_path.stem),
+             **parameters)
+    logging.info(f"Saved the archetype model in {model_path}")
+    return model_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Trains the archetype model with the annotated cards.")
+    parser.add_argument(
+        "--log-level","-l",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        help="Set the logging level (default: INFO)."
+    )
+    parser.add_argument(
+        "--config","-c",
+        help="Path to config file.",
+        type = str,
+        required = True,
+    )
+    parser.add_argument("--epochs", type=int, help=f"Number of epochs (default: [training] epochs or {DEFAULT_EPOCHS}).")
+    parser.add_argument("--batch-size", type=int, help=f"Cards per mini-batch (default: [training] batch_size or {DEFAULT_BATCH_SIZE}).")
+    parser.add_argument("--learning-rate", type=float, help=f"Adam learning rate (default: [training] learning_rate or {DEFAULT_LEARNING_RATE}).")
+    parser.add_argument("--hidden-units", type=int, help=f"Units of the hidden layer (default: [training] hidden_units or {DEFAULT_HIDDEN_UNITS}).")
+    parser.add_argument(
+        '--activate',
+        action='store_true',
+        help='Copies the new weights to [model] weights_filepath, the file used for the predictions'
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, level=getattr(logging, args.log_level.upper()), format='%(asctime)s %(message)s',datefmt='%m/%d/%Y %I:%M:%S %p')
+    config = configparser.ConfigParser()
+    config.read(args.config)
+
+    model_path = train_archetype_model(
+        config,
+        epochs=args.epochs or config.getint("training", "epochs", fallback=DEFAULT_EPOCHS),
+        batch_size=args.batch_size or config.getint("training", "batch_size", fallback=DEFAULT_BATCH_SIZE),
+        learning_rate=args.learning_rate or config.getfloat("training", "learning_rate", fallback=DEFAULT_LEARNING_RATE),
+        hidden_units=args.hidden_units or config.getint("training", "hidden_units", fallback=DEFAULT_HIDDEN_UNITS))
+    if model_path and args.activate:
+        shutil.copyfile(model_path, config["model"]["weights_filepath"])
+        logging.info(f"The model {model_path.stem} is now the active one")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,248 +2,498 @@ import logging
 import os
 import sys
 import configparser
-from app.setup.parse_card_data import retrieve_source_json_data
+from pathlib import Path
+from app.classes.feature_matrix import (FeatureVocabulary, CardFeatureMatrix, CardFeatureMatrixBuilder, NON_CATEGORICAL_FEATURES,
+                                        COLOR_FEATURE_PREFIX, CARDTYPE_FEATURE_PREFIX, SUPERTYPE_FEATURE_PREFIX,
+                                        SUBTYPE_FEATURE_PREFIX, WORD_FEATURE_PREFIX)
+from app.classes.card_object import ARCHETYPE_OUTPUT_PREFIX
+from app.setup.parse_card_data import retrieve_source_json_data, iter_card_batches
 import pickle
+import numpy as np
 import pandas as pd
 import re
-from collections import Counter
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from typing import List, Set
+import zlib
+from collections import Counter, namedtuple
+from typing import List
 
-from concurrent.futures import ProcessPoolExecutor, wait, as_completed,ALL_COMPLETED
+from concurrent.futures import ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
 
 CHARACTERS_TO_BE_REPLACED = ["\n",".",",",":","(",")","\"","•","—"]
 NUMBER_OF_CPU_CORES = 12
+STREAMING_BATCH_SIZE = 2000
+VOCABULARY_CHUNK_SIZE = 500
+VOCABULARY_MODES = ("frozen", "extend", "rebuild")
 
-def vectorize_card_data(cards,config):
-    color_set_all_cards = set()
-    card_type_all_cards = set()
-    super_type_all_cards = set()
-    sub_type_all_cards = set()
+CardFeatureFields = namedtuple("CardFeatureFields", ["converted_mana_cost", "power", "toughness", "color", "card_type",
+                                                     "super_types", "subtypes", "card_text"])
 
+def get_number_of_cpu_cores(config):
+    """
+    Reads the number of CPU cores to use from the [host_parameters] section of the config file, 1 if it is not there.
+
+    :param config: configparser object
+    :return: int
+    """
     if not "host_parameters" in config:
         logging.warning("There are no host_parameters in the config file, therefore we are using 1 as the number of CPUs.")
-        NUMBER_OF_CPU_CORES = 1
-    else:
-        if not "number_of_cpu_cores" in config["host_parameters"]:
-            logging.warning("There are no number_of_cpu_cores in \"host_parameters\" in the config file, therefore we are using 1 as the number of CPUs.")
-            NUMBER_OF_CPU_CORES = 1
-        else:
-            if not represents_int(config["host_parameters"]["number_of_cpu_cores"]):
-                logging.warning("The number of CPUs given seems to be not an integer, received this value: " + str(config["host_parameters"]["number_of_cpu_cores"]) + "\nWe are using a 1 as the number of CPUs")
-                NUMBER_OF_CPU_CORES = 1
+        return 1
+    if not "number_of_cpu_cores" in config["host_parameters"]:
+        logging.warning("There are no number_of_cpu_cores in \"host_parameters\" in the config file, therefore we are using 1 as the number of CPUs.")
+        return 1
+    if not represents_int(config["host_parameters"]["number_of_cpu_cores"]):
+        logging.warning("The number of CPUs given seems to be not an integer, received this value: " + str(config["host_parameters"]["number_of_cpu_cores"]) + "\nWe are using a 1 as the number of CPUs")
+        return 1
+    logging.debug("Using the following number of CPU cores to process the data: " + str(config["host_parameters"]["number_of_cpu_cores"]))
+    return int(config["host_parameters"]["number_of_cpu_cores"])
+
+
+def get_feature_matrix_path(config) -> Path:
+    """
+    Folder where the card feature matrix is saved, [vectorization] feature_matrix_path in the config file or a
+    "card_feature_matrix" folder next to the source data file.
+    """
+    default_path = Path(config["source_data"]["json_data_filepath"]).parent / "card_feature_matrix"
+    return Path(config.get("vectorization", "feature_matrix_path", fallback=str(default_path)))
 
-            else:
-                logging.debug("Using the following number of CPU cores to process the data: " + str(config["host_parameters"]["number_of_cpu_cores"]))
-                NUMBER_OF_CPU_CORES = int(config["host_parameters"]["number_of_cpu_cores"])
 
+def get_card_feature_fields(card):
+    """
+    Only the attributes of the card used to vectorize it, this is what is sent to the worker processes instead of
+    the whole MagicCard.
+    """
+    return CardFeatureFields(converted_mana_cost=card.converted_mana_cost,
+                             power=card.power,
+                             toughness=card.toughness,
+                             color=card.color,
+                             card_type=card.card_type,
+                             super_types=card.super_types,
+                             subtypes=card.subtypes,
+                             card_text=card.card_text)
+
+
+def new_vocabulary_statistics():
+    return {"color": set(),
+            "card_type": set(),
+            "super_types": set(),
+            "subtypes": set(),
+            # word -> number of cards that have the word in their text
+            "document_frequency": Counter(),
+            "number_of_cards": 0}
+
+
+def get_chunk_vocabulary_statistics(card_fields_chunk, count_words=True):
+    """
+    Map step of the vocabulary building: categories and word document frequencies of a chunk of cards.
 
-    # Create a ProcessPoolExecutor with 4 worker processes
-    logging.debug("Starting card data parsing")
-    with ProcessPoolExecutor(max_workers=NUMBER_OF_CPU_CORES) as executor:
-        # Use the executor to map the function to the input data
-        card_categories_sets = executor.map(get_sets_of_data_in_card, cards)
-    logging.debug("Ended card data parsing")
-    for single_card_categories_sets in card_categories_sets:
-        color_set_all_cards.update(single_card_categories_sets["color"])
-        super_type_all_cards.update(single_card_categories_sets["supertypes"])
-        sub_type_all_cards.update(single_card_categories_sets["subtypes"])
-        card_type_all_cards.update(single_card_categories_sets["card_type"])
-    total_colors = len(color_set_all_cards)
+    :param card_fields_chunk: list of CardFeatureFields
+    :param count_words: if False the words are not counted (hashing trick)
+    :return: dictionary as the one returned by new_vocabulary_statistics
+    """
+    statistics = new_vocabulary_statistics()
+    for card_fields in card_fields_chunk:
+        statistics["color"].update(card_fields.color)
+        statistics["card_type"].update(card_fields.card_type)
+        statistics["super_types"].update(card_fields.super_types)
+        statistics["subtypes"].update(card_fields.subtypes)
+        if count_words:
+            statistics["document_frequency"].update(set(tokenize_text(card_fields.card_text or "")))
+    statistics["number_of_cards"] = len(card_fields_chunk)
+    return statistics
+
+
+def merge_vocabulary_statistics(total_statistics, chunk_statistics):
+    """
+    Reduce step of the vocabulary building.
+    """
+    for kind_of_category in ("color", "card_type", "super_types", "subtypes"):
+        total_statistics[kind_of_category].update(chunk_statistics[kind_of_category])
+    total_statistics["document_frequency"].update(chunk_statistics["document_frequency"])
+    total_statistics["number_of_cards"] += chunk_statistics["number_of_cards"]
+
+
+def collect_vocabulary_statistics(cards, number_of_cpu_cores, count_words=True, chunk_size=VOCABULARY_CHUNK_SIZE):
+    """
+    Collects the categories and the word document frequencies of all the cards in a single chunked map-reduce pass.
+    The cards can be a list or a stream, at most 2 chunks per worker are waiting to be processed at any time.
+
+    :param cards: iterable of MagicCard
+    :param number_of_cpu_cores: number of worker processes
+    :param count_words: if False the words are not counted (hashing trick)
+    :param chunk_size: number of cards sent together to a worker
+    :return: dictionary as the one returned by new_vocabulary_statistics
+    """
+    total_statistics = new_vocabulary_statistics()
+    with ProcessPoolExecutor(max_workers=number_of_cpu_cores) as executor:
+        pending_futures = set()
+        for card_chunk in iter_card_batches(cards, chunk_size):
+            card_fields_chunk = [get_card_feature_fields(card) for card in card_chunk]
+            pending_futures.add(executor.submit(get_chunk_vocabulary_statistics, card_fields_chunk, count_words))
+            if len(pending_futures) >= 2 * number_of_cpu_cores:
+                done_futures, pending_futures = wait(pending_futures, return_when=FIRST_COMPLETED)
+                for future in done_futures:
+                    merge_vocabulary_statistics(total_statistics, future.result())
+        for future in as_completed(pending_futures):
+            merge_vocabulary_statistics(total_statistics, future.result())
+    return total_statistics
+
+
+def parse_document_frequency(value):
+    """
+    Document frequency thresholds follow the usual convention: an integer is a number of cards, a float is a
+    proportion of the cards.
+    """
+    value = str(value).strip()
+    if represents_int(value):
+        return int(value)
+    return float(value)
+
+
+def get_vocabulary_pruning(config):
+    """
+    Pruning of the words of the vocabulary, from the [vectorization] section of the config file:
+    min_df (default 2), max_df (default 1.0, all the cards) and top_k_words (default 0, no limit).
+    """
+    return {"min_df": parse_document_frequency(config.get("vectorization", "min_df", fallback="2")),
+            "max_df": parse_document_frequency(config.get("vectorization", "max_df", fallback="1.0")),
+            "top_k": config.getint("vectorization", "top_k_words", fallback=0)}
+
+
+def select_vocabulary_words(document_frequency, number_of_cards, min_df=2, max_df=1.0, top_k=0):
+    """
+    Keeps the words that appear in at least min_df and at most max_df cards, and of those the top_k most frequent.
+
+    :param document_frequency: Counter word -> number of cards with the word
+    :param number_of_cards: number of cards counted
+    :return: set of words
+    """
+    min_count = min_df if isinstance(min_df, int) else min_df * number_of_cards
+    max_count = max_df if isinstance(max_df, int) else max_df * number_of_cards
+    words = [(count, word) for word, count in document_frequency.items() if min_count <= count <= max_count]
+    if top_k and len(words) > top_k:
+        words = sorted(words, key=lambda count_word: (-count_word[0], count_word[1]))[:top_k]
+    logging.info(f"Kept {len(words)} of {len(document_frequency)} words (min_df={min_df}, max_df={max_df}, top_k={top_k})")
+    return {word for count, word in words}
+
+
+def build_feature_vocabulary(statistics, word_hash_buckets=0, min_df=2, max_df=1.0, top_k=0):
+    """
+    Builds the vocabulary shared by all the card vectors from the statistics of the whole card data.
+
+    :param statistics: output of collect_vocabulary_statistics
+    :param word_hash_buckets: if bigger than 0 the words are hashed in this number of columns instead of being labels
+    :param min_df: minimum document frequency of a word, see select_vocabulary_words
+    :param max_df: maximum document frequency of a word
+    :param top_k: maximum number of words, 0 for no limit
+    :return: FeatureVocabulary
+    """
+    total_colors = len(statistics["color"])
     logging.info("In this data there are {number} different types of colors".format(number=str(total_colors)))
-    total_cardtypes = len(card_type_all_cards)
+    total_cardtypes = len(statistics["card_type"])
     logging.info("In this data there are {number} different types of cardtypes".format(number=str(total_cardtypes)))
-    total_supertypes = len(super_type_all_cards)
+    total_supertypes = len(statistics["super_types"])
     logging.info("In this data there are {number} different types of supertypes".format(number=str(total_supertypes)))
-    total_subtypes = len(sub_type_all_cards)
+    total_subtypes = len(statistics["subtypes"])
     logging.info("In this data there are {number} different types of subtypes".format(number=str(total_subtypes)))
+    if word_hash_buckets:
+        logging.info("The words of the card text are hashed in {number} columns".format(number=str(word_hash_buckets)))
+        relevant_words_in_card_text = set()
+    else:
+        relevant_words_in_card_text = select_vocabulary_words(statistics["document_frequency"],
+                                                              statistics["number_of_cards"], min_df, max_df, top_k)
+
+    vocabulary = FeatureVocabulary.from_categories(statistics["color"], statistics["card_type"],
+                                                   statistics["super_types"], statistics["subtypes"],
+                                                   relevant_words_in_card_text, word_hash_buckets)
+    logging.debug("We found the following feature labels: " + str(vocabulary.labels))
+    return vocabulary
+
 
+def get_archetype_output_labels(config) -> List[str]:
+    """
+    Labels of the output vector, one per archetype of [fixed_data] archetypes, in the order of the config file.
+    """
+    return [ARCHETYPE_OUTPUT_PREFIX + str(x) for x in config["fixed_data"]["archetypes"].split(",")]
 
-    g_labels_for_items_not_in_the_model = {"meta_name": "name",
-                                           "meta_links": "links",
-                                           "meta_mcm_meta_id": "mcm_meta_id",
-                                           "meta_sources": "sources"}
 
-    g_non_categorical_values_labels = {"input_cost": "cost",
-                                       "input_power": "power",
-                                       "input_toughness": "toughness"}
+def get_output_vector(config):
+    g_archetype_labels = get_archetype_output_labels(config)
+    logging.debug("We found the following archetype labels: " + str(g_archetype_labels))
 
-    g_color_labels = {"input_color_" + str(color) : color for color in color_set_all_cards}
-    logging.debug("We found the following color labels: " + str(g_color_labels))
+    output_vector = {}
+    for label_output in g_archetype_labels:
+        output_vector[label_output] = 0
+    return output_vector
 
-    g_cardtypes_labels = {"input_cardtypes_" + str(cardtype) : cardtype for cardtype in card_type_all_cards}
-    logging.debug("We found the following cardtype labels: " + str(g_cardtypes_labels))
 
-    g_supertypes_labels = {"input_supertypes_" + str(supertype) : supertype for supertype in super_type_all_cards}
-    logging.debug("We found the following supertype labels: " + str(g_supertypes_labels))
+def get_word_hash_buckets(config) -> int:
+    """
+    Number of columns of the hashing trick for the card text words, [vectorization] word_hash_buckets in the config
+    file. 0 (the default) means that the words found in the card data are the vocabulary.
+    """
+    return config.getint("vectorization", "word_hash_buckets", fallback=0)
 
-    g_subtypes_labels = {"input_subtypes_" + str(subtype) : subtype for subtype in sub_type_all_cards}
-    logging.debug("We found the following subtype labels: " + str(g_subtypes_labels))
 
-    relevant_words_in_card_text = count_repeated_words([card.card_text for card in cards])
-    g_word_labels = {"input_word_" + str(word) : word for word in relevant_words_in_card_text}
-    logging.debug("We found the following relevant words labels: " + str(g_subtypes_labels))
+def get_word_hash_column(word, first_column, number_of_buckets):
+    # crc32 instead of hash() because hash() changes between processes
+    return first_column + zlib.crc32(word.encode("utf8")) % number_of_buckets
 
-    logging.debug("Starting card data vectorizing")
-    card_vector_list = []
-    with ProcessPoolExecutor(max_workers=NUMBER_OF_CPU_CORES) as executor:
-        # Use the executor to map the function to the input data
-        # submit tasks and collect futures
-        futures = [executor.submit(get_card_vector, card,local_id,g_non_categorical_values_labels,g_color_labels,g_cardtypes_labels,g_supertypes_labels,g_subtypes_labels,g_word_labels) for local_id,card in enumerate(cards)]
 
-    done_futures, not_done_futures = wait(futures, return_when=ALL_COMPLETED)
-    input_card_vector_list = [future.result() for future in done_futures]
+def get_feature_columns(vocabulary):
+    """
+    Splits the vocabulary in the lookups used by get_card_feature_row, value -> column for every kind of feature.
+    """
+    return {"word_hashing": (vocabulary.word_hash_first_column, vocabulary.word_hash_buckets),
+            "non_categorical": {attribute: vocabulary.index[label] for label, attribute in NON_CATEGORICAL_FEATURES.items()
+                                if label in vocabulary.index},
+            "color": vocabulary.columns_with_prefix(COLOR_FEATURE_PREFIX),
+            "card_type": vocabulary.columns_with_prefix(CARDTYPE_FEATURE_PREFIX),
+            "super_types": vocabulary.columns_with_prefix(SUPERTYPE_FEATURE_PREFIX),
+            "subtypes": vocabulary.columns_with_prefix(SUBTYPE_FEATURE_PREFIX),
+            "word": vocabulary.columns_with_prefix(WORD_FEATURE_PREFIX)}
 
-    g_archetype_labels = {"output_archetype_" + str(x) : str(x) for x in list(config["fixed_data"]["archetypes"].split(","))}
-    logging.debug("We found the following archetype labels: " + str(g_subtypes_labels))
 
-    output_vector = {}
-    for label_output in g_archetype_labels:
-        output_vector[label_output] = 0
+# The feature columns are sent once to every worker process when the pool starts, not with every card
+_worker_feature_columns = None
 
 
-    logging.info("Number of cards successfully vectorized: " + str(len(card_vector_list)))
-    logging.debug("Ended card data vectorizing")
+def set_worker_feature_columns(feature_columns):
+    global _worker_feature_columns
+    _worker_feature_columns = feature_columns
 
 
-    card_vectors_data = sorted(card_vector_list, key=lambda x: int(x["local_id"]))
+def get_feature_executor(number_of_cpu_cores, vocabulary):
+    return ProcessPoolExecutor(max_workers=number_of_cpu_cores, initializer=set_worker_feature_columns,
+                               initargs=(get_feature_columns(vocabulary),))
 
-    for card,vector in zip(cards,input_card_vector_list):
-        card.update_vectors(vector,output_vector)
 
+def vectorize_card_batch(cards, executor, matrix_builder, output_vector, number_of_cpu_cores=1):
+    """
+    Computes the feature row of every card of the batch in the executor, adds it to the matrix builder and stores
+    the row index in the card.
+
+    :param cards: list of MagicCard
+    :param executor: executor returned by get_feature_executor
+    :param matrix_builder: CardFeatureMatrixBuilder
+    :param output_vector: output of get_output_vector
+    :param number_of_cpu_cores: workers of the executor, used to size the chunks sent to them
+    :return: the same list of cards
+    """
+    chunksize = max(1, len(cards) // (4 * number_of_cpu_cores))
+    # map returns the results in the same order the cards were submitted
+    card_fields_list = [get_card_feature_fields(card) for card in cards]
+    for card, (columns, values) in zip(cards, executor.map(get_card_feature_row, card_fields_list, chunksize=chunksize)):
+        feature_row = matrix_builder.add_row(card.id, columns, values)
+        card.update_vectors(feature_row, output_vector)
     return cards
 
 
-def get_card_vector(card,local_id,g_non_categorical_values_labels,g_color_labels,g_cardtypes_labels,g_supertypes_labels,g_subtypes_labels,g_word_labels):
+def get_card_feature_rows(card_fields_list):
     """
-    Convert card data into card data + card vector
+    Feature rows of a whole batch of cards in one worker task, used when several batches are vectorized at the same
+    time (see pipelined_import).
+    """
+    return [get_card_feature_row(card_fields) for card_fields in card_fields_list]
 
-    :param card:
-    :param local_id:
-    :param g_labels_for_items_not_in_the_model:
-            {
-               "meta_name": "name",
-               "meta_links": "links",
-               "meta_mcm_meta_id": "mcm_meta_id",
-               "meta_sources": "sources"
-           }
-    :param g_non_categorical_values_labels:
-            {
-               "input_cost": "cost",
-               "input_power": "power",
-               "input_toughness": "toughness"
-           }
-    :param g_color_labels: Dictionary of card data that we want in out reduce data and it is categorical
-        {"":""}
 
-    :param g_cardtypes_labels:
-    :param g_supertypes_labels:
-    :param g_subtypes_labels:
-    :param g_word_labels:
-    :param g_archetype_labels:
-    :return:
+def add_card_feature_rows(cards, feature_rows, matrix_builder, output_vector):
+    """
+    Adds the feature rows computed by get_card_feature_rows to the matrix builder, in the order of the cards.
     """
+    for card, (columns, values) in zip(cards, feature_rows):
+        feature_row = matrix_builder.add_row(card.id, columns, values)
+        card.update_vectors(feature_row, output_vector)
+    return cards
 
-    entry = {}
-    entry["local_id"] = local_id
 
+def get_vocabulary_path(config) -> Path:
+    """
+    File of the persisted feature vocabulary, [vectorization] vocabulary_filepath in the config file or a
+    vocabulary.json inside the feature matrix folder.
+    """
+    default_path = get_feature_matrix_path(config) / "vocabulary.json"
+    return Path(config.get("vectorization", "vocabulary_filepath", fallback=str(default_path)))
 
-    for non_categorical_data_label_output, non_categorical_data_label_indata in g_non_categorical_values_labels.items():
-        value = getattr(card, non_categorical_data_label_indata, "")
-        if value and represents_int(value):
-            entry[non_categorical_data_label_output] = int(value)
-        else:
-            entry[non_categorical_data_label_output] = 0
-
-    for label_output, label_in_data in g_color_labels.items():
-        colors = getattr(card, "color", "")
-        entry[label_output] = 1 if label_in_data in colors else 0
-
-    for label_output, label_in_data in g_cardtypes_labels.items():
-        cardtypes = getattr(card, "card_type", "")
-        entry[label_output] = 1 if label_in_data in cardtypes else 0
-
-    for label_output, label_in_data in g_supertypes_labels.items():
-        supertypes = getattr(card, "supertypes", "")
-        entry[label_output] = 1 if label_in_data in supertypes else 0
-
-    for label_output, label_in_data in g_subtypes_labels.items():
-        subtypes = getattr(card, "subtypes", "")
-        entry[label_output] = 1 if label_in_data in subtypes else 0
-
-    for label_output, label_in_data in g_word_labels.items():
-        current_text_words = getattr(card, "originalText", "")
-        entry[label_output] = 1 if label_in_data in current_text_words else 0
-
-    return entry
-
-def get_sets_of_data_in_card(card):
-    card_type_set = set(card.card_type)
-    super_type_set = set(card.super_types)
-    sub_type_set = set(card.subtypes)
-    color_set = set(card.color)
-    card_categories_set = {
-        "color" : color_set,
-        "supertypes": super_type_set,
-        "subtypes": sub_type_set,
-        "card_type": card_type_set
-    }
-    return card_categories_set
 
-def represents_int(s):
-    try:
-        int(s)
-    except ValueError:
-        return False
+def prepare_feature_vocabulary(card_stream_factory, config, number_of_cpu_cores, vocabulary_mode="frozen"):
+    """
+    Returns the vocabulary the cards have to be vectorized with, one of VOCABULARY_MODES:
+    frozen: the persisted vocabulary is used as it is, the cards are not even read. It is built if there is none.
+    extend: the categories and words of the cards that are not in the persisted vocabulary are appended as new columns.
+    rebuild: a new vocabulary is built from the cards, this changes the layout of the features.
+
+    :param card_stream_factory: callable without arguments that returns the cards, only called when the statistics
+    of the cards are needed
+    :param config: configparser object
+    :param number_of_cpu_cores: number of worker processes
+    :param vocabulary_mode: one of VOCABULARY_MODES
+    :return: FeatureVocabulary, already saved
+    """
+    if vocabulary_mode not in VOCABULARY_MODES:
+        raise ValueError(f"Unknown vocabulary mode '{vocabulary_mode}', use one of: " + ", ".join(VOCABULARY_MODES))
+    vocabulary_path = get_vocabulary_path(config)
+    previous_vocabulary = FeatureVocabulary.load(vocabulary_path)
+    if previous_vocabulary is not None and vocabulary_mode == "frozen":
+        logging.info(f"Using the frozen feature vocabulary version {previous_vocabulary.version} from {vocabulary_path}")
+        return previous_vocabulary
+
+    if previous_vocabulary is not None and vocabulary_mode == "extend":
+        word_hash_buckets = previous_vocabulary.word_hash_buckets
     else:
-        return True
+        word_hash_buckets = get_word_hash_buckets(config)
 
+    logging.debug("Starting card data parsing")
+    statistics = collect_vocabulary_statistics(card_stream_factory(), number_of_cpu_cores,
+                                               count_words=not word_hash_buckets)
+    logging.debug("Ended card data parsing")
 
-def tokenize_text(text: str) -> List[str]:
+    if previous_vocabulary is not None and vocabulary_mode == "extend":
+        vocabulary = previous_vocabulary
+        words = set() if word_hash_buckets else select_vocabulary_words(statistics["document_frequency"],
+                                                                        statistics["number_of_cards"],
+                                                                        **get_vocabulary_pruning(config))
+        number_of_new_columns = vocabulary.extend(statistics["color"], statistics["card_type"],
+                                                  statistics["super_types"], statistics["subtypes"], words)
+        logging.info(f"Extended the feature vocabulary with {number_of_new_columns} columns")
+    else:
+        vocabulary = build_feature_vocabulary(statistics, word_hash_buckets, **get_vocabulary_pruning(config))
+        if previous_vocabulary is not None:
+            vocabulary.version = previous_vocabulary.version + 1
+    vocabulary.save(vocabulary_path)
+    return vocabulary
+
+
+def vectorize_card_data(cards, config, vocabulary_mode="frozen"):
+    NUMBER_OF_CPU_CORES = get_number_of_cpu_cores(config)
+    vocabulary = prepare_feature_vocabulary(lambda: cards, config, NUMBER_OF_CPU_CORES, vocabulary_mode)
+
+    logging.debug("Starting card data vectorizing")
+    output_vector = get_output_vector(config)
+    matrix_builder = CardFeatureMatrixBuilder(len(vocabulary), vocabulary=vocabulary)
+    with get_feature_executor(NUMBER_OF_CPU_CORES, vocabulary) as executor:
+        vectorize_card_batch(cards, executor, matrix_builder, output_vector, NUMBER_OF_CPU_CORES)
+    matrix_builder.build().save(get_feature_matrix_path(config))
+
+    logging.info("Number of cards successfully vectorized: " + str(len(cards)))
+    logging.debug("Ended card data vectorizing")
+
+    return cards
+
+
+def vectorize_card_stream(card_stream_factory, config, batch_size=STREAMING_BATCH_SIZE, vocabulary_mode="frozen"):
     """
-    Split a string into words, considering spaces, newlines, punctuation, etc.
-    Converts to lowercase.
+    Bounded memory version of vectorize_card_data. The cards are never held all together: if the vocabulary has to
+    be built or extended a first pass over the stream collects the categories and the word counts, then the cards are
+    vectorized batch by batch and yielded, so they can be consumed directly by insert_magic_cards_bulk. The feature
+    matrix is saved once the stream is exhausted.
+
+    :param card_stream_factory: callable without arguments that returns a new iterable of MagicCard every time it is
+    called, e.g. lambda: iter_source_json_data(file_path)
+    :param config: configparser object
+    :param batch_size: number of cards vectorized together
+    :param vocabulary_mode: one of VOCABULARY_MODES, see prepare_feature_vocabulary
+    :return: generator of vectorized MagicCard
     """
-    return re.findall(r'\b\w+\b', text.lower())
+    NUMBER_OF_CPU_CORES = get_number_of_cpu_cores(config)
+    vocabulary = prepare_feature_vocabulary(card_stream_factory, config, NUMBER_OF_CPU_CORES, vocabulary_mode)
 
+    logging.debug("Starting card data vectorizing")
+    output_vector = get_output_vector(config)
+    matrix_builder = CardFeatureMatrixBuilder(len(vocabulary), vocabulary=vocabulary)
+    with get_feature_executor(NUMBER_OF_CPU_CORES, vocabulary) as executor:
+        for card_batch in iter_card_batches(card_stream_factory(), batch_size):
+            yield from vectorize_card_batch(card_batch, executor, matrix_builder, output_vector, NUMBER_OF_CPU_CORES)
+    matrix_builder.build().save(get_feature_matrix_path(config))
+
+    logging.info("Number of cards successfully vectorized: " + str(len(matrix_builder)))
+    logging.debug("Ended card data vectorizing")
 
-def count_words_in_chunk(texts: List[str]) -> Counter:
+
+def vectorize_additional_cards(cards, config, extend_vocabulary=False):
     """
-    Count words in a chunk of texts.
+    Vectorizes cards that are not in the feature matrix yet (e.g. a new set) and appends their rows to the saved
+    matrix, the cards already vectorized are not touched.
+
+    :param cards: list of MagicCard
+    :param config: configparser object
+    :param extend_vocabulary: if True the new categories and words of the cards are appended to the vocabulary, if
+    False the cards are vectorized with the frozen vocabulary
+    :return: the same list of cards
     """
-    counter = Counter()
-    for text in texts:
-        words = tokenize_text(text)
-        counter.update(words)
-    return counter
+    NUMBER_OF_CPU_CORES = get_number_of_cpu_cores(config)
+    feature_matrix_path = get_feature_matrix_path(config)
+    existing_matrix = CardFeatureMatrix.load(feature_matrix_path, memory_map=False)
+    vocabulary = prepare_feature_vocabulary(lambda: cards, config, NUMBER_OF_CPU_CORES,
+                                            "extend" if extend_vocabulary else "frozen")
+
+    output_vector = get_output_vector(config)
+    matrix_builder = CardFeatureMatrixBuilder(len(vocabulary), first_row=existing_matrix.number_of_rows,
+                                              vocabulary=vocabulary)
+    with get_feature_executor(NUMBER_OF_CPU_CORES, vocabulary) as executor:
+        vectorize_card_batch(cards, executor, matrix_builder, output_vector, NUMBER_OF_CPU_CORES)
+    existing_matrix.concatenate(matrix_builder.build()).save(feature_matrix_path)
+
+    logging.info(f"Appended {len(cards)} cards to the feature matrix with the vocabulary version {vocabulary.version}")
+    return cards
 
 
-def count_repeated_words(texts: List[str], max_workers: int = 4) -> Set[str]:
+def get_card_feature_row(card, feature_columns=None):
     """
-    Count words in a list of strings and return only those that appear more than once.
+    Convert card data into the sparse row of the card in the feature matrix.
 
-    :param texts: List of input strings
-    :param max_workers: Number of processes for parallelization
-    :return: Set of repeated words
+    :param card: MagicCard or CardFeatureFields
+    :param feature_columns: output of get_feature_columns, the one given to the worker process if None
+    :return: (columns, values), int32 and float32 arrays with the non zero features of the card
     """
-    if not texts:
-        return set()
+    if feature_columns is None:
+        feature_columns = _worker_feature_columns
+    row = {}
+
+    for attribute, column in feature_columns["non_categorical"].items():
+        value = getattr(card, attribute, "")
+        if value and represents_int(value):
+            row[column] = int(value)
+
+    for kind_of_feature in ("color", "card_type", "super_types", "subtypes"):
+        columns = feature_columns[kind_of_feature]
+        for value in getattr(card, kind_of_feature, []):
+            if value in columns:
+                row[columns[value]] = 1
+
+    # The text is tokenized once and every token is a dictionary lookup, the cost depends on the length of the text
+    # and not on the size of the vocabulary
+    words_in_text = set(tokenize_text(card.card_text or ""))
+    word_hash_first_column, word_hash_buckets = feature_columns["word_hashing"]
+    if word_hash_buckets:
+        for word in words_in_text:
+            row[get_word_hash_column(word, word_hash_first_column, word_hash_buckets)] = 1
+    else:
+        word_columns = feature_columns["word"]
+        for word in words_in_text:
+            column = word_columns.get(word)
+            if column is not None:
+                row[column] = 1
+
+    columns = np.fromiter(row.keys(), dtype=np.int32, count=len(row))
+    values = np.fromiter(row.values(), dtype=np.float32, count=len(row))
+    order = np.argsort(columns)
+    return columns[order], values[order]
 
-    # Split texts into chunks for parallel processing
-    chunk_size = max(1, len(texts) // max_workers)
-    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
 
-    total_counter = Counter()
+def represents_int(s):
+    try:
+        int(s)
+    except ValueError:
+        return False
+    else:
+        return True
 
-    # Parallel processing
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(count_words_in_chunk, chunk) for chunk in chunks]
-        for future in as_completed(futures):
-            total_counter.update(future.result())
 
-    # Keep only words that appear more than once
-    repeated_words = {word for word, count in total_counter.items() if count > 1}
-    return repeated_words
+def tokenize_text(text: str) -> List[str]:
+    """
+    Split a string into words, considering spaces, newlines, punctuation, etc.
+    Converts to lowercase.
+    """
+    return re.findall(r'\b\w+\b', text.lower())
 
 
 def test_vectorize_card_data():
@@ -0,0 +1,4 @@
+from app.api import create_api_app
+
+# Entry point of the JSON API: hypercorn asgi:app
+app = create_api_app()
@@ -0,0 +1,18 @@
+import multiprocessing
+from app import read_app_config
+
+# Settings of the production server, from the [server] section of the config file of the app
+_config = read_app_config()
+
+bind = _config.get("server", "bind", fallback="0.0.0.0:8000")
+# The requests mostly wait on PostgreSQL, so every worker process serves several of them with threads. Every worker
+# has its own caches, they check the version of the cards in the database so a write made through another worker is
+# seen at once (see get_card_version and create_cache_generations_table)
+worker_class = "gthread"
+workers = _config.getint("server", "workers", fallback=multiprocessing.cpu_count() * 2 + 1)
+threads = _config.getint("server", "threads", fallback=4)
+timeout = _config.getint("server", "timeout", fallback=30)
+# Imports the app and warms it up once in the master process, the workers are forked from it. The DB pool is still
+# created by every worker (see get_db_pool)
+preload_app = _config.getboolean("server", "preload", fallback=True)
+accesslog = _config.get("server", "access_log", fallback="-")
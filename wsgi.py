@@ -0,0 +1,5 @@
+from app import create_app, warm_up_app
+
+# Entry point of the production server: gunicorn -c gunicorn.conf.py wsgi:app
+app = create_app()
+warm_up_app(app)